@@ -16,19 +16,23 @@
 
 import cPickle as pickle
 import datetime
+import marshal
 import os
 import shutil
+import threading
+import time
 import xapian
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.encoding import force_unicode
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
 from haystack import indexes, sites
-from haystack.backends.xapian_backend import SearchBackend
+from haystack.backends.xapian_backend import SearchBackend, SearchQuery
 
 from xapian_haystack.tests.models import MockModel, AnotherMockModel
-from xapian_haystack.xapian_backend import DEFAULT_MAX_RESULTS
+from xapian_haystack.xapian_backend import DEFAULT_MAX_RESULTS, DATABASE_POOL, VALUE_ENCODING, XHDocumentData, XHWriteQueue, XHWriterError, XHWriterServer
 
 
 class XapianMockSearchIndex(indexes.SearchIndex):
@@ -45,6 +49,38 @@ class XapianSearchSite(sites.SearchSite):
     pass
 
 
+class XapianTagsSearchIndex(indexes.SearchIndex):
+    text = indexes.CharField(document=True, use_template=True)
+    name = indexes.CharField(model_attr='author')
+    tags = indexes.MultiValueField()
+    
+    def prepare_tags(self, obj):
+        return obj.tags
+
+
+class XapianNullSearchIndex(indexes.SearchIndex):
+    text = indexes.CharField(document=True, use_template=True)
+    name = indexes.CharField(model_attr='author')
+    pub_date = indexes.DateField()
+    value = indexes.IntegerField()
+    
+    def prepare_pub_date(self, obj):
+        return obj.pub_date
+    
+    def prepare_value(self, obj):
+        return obj.value
+
+
+class XapianParallelSearchIndex(indexes.SearchIndex):
+    text = indexes.CharField(document=True, use_template=True)
+    name = indexes.CharField(model_attr='user')
+    pub_date = indexes.DateField(model_attr='pub_date')
+    value = indexes.IntegerField(model_attr='value')
+    flag = indexes.BooleanField(model_attr='flag')
+    slug = indexes.CharField(indexed=False, model_attr='slug')
+    popularity = indexes.FloatField(indexed=True, model_attr='popularity')
+
+
 class XapianSearchBackendTestCase(TestCase):
     def setUp(self):
         super(XapianSearchBackendTestCase, self).setUp()
@@ -75,8 +111,7 @@ class XapianSearchBackendTestCase(TestCase):
         self.sample_objs[2].popularity = 972.0
     
     def tearDown(self):
-        if os.path.exists(settings.HAYSTACK_XAPIAN_PATH):
-            shutil.rmtree(settings.HAYSTACK_XAPIAN_PATH)
+        self.sb.delete_index()
 
         settings.HAYSTACK_XAPIAN_PATH = self.old_xapian_path
         super(XapianSearchBackendTestCase, self).tearDown()
@@ -97,7 +132,7 @@ class XapianSearchBackendTestCase(TestCase):
         
         for match in matches:
             document = match.get_document()
-            app_label, module_name, pk, model_data = pickle.loads(document.get_data())
+            app_label, module_name, pk, model_data = XHDocumentData.decode(document.get_data())
             for key, value in model_data.iteritems():
                 model_data[key] = self.sb._marshal_value(value)
             model_data['id'] = u'%s.%s.%d' % (app_label, module_name, pk)
@@ -105,6 +140,32 @@ class XapianSearchBackendTestCase(TestCase):
 
         return document_list
     
+    def backdate_index(self, seconds=10):
+        # Handles and cached results for a database written to in the last
+        # few seconds are never trusted, so tests that count on reuse
+        # backdate the database directory and its files.
+        past = time.time() - seconds
+        for filename in [''] + os.listdir(settings.HAYSTACK_XAPIAN_PATH):
+            os.utime(os.path.join(settings.HAYSTACK_XAPIAN_PATH, filename), (past, past))
+    
+    def search_during(self, operation):
+        errors = []
+        done = threading.Event()
+        def reader():
+            sb = SearchBackend(site=self.site)
+            while not done.isSet():
+                try:
+                    sb.search('*')
+                except Exception, e:
+                    errors.append(e)
+        thread = threading.Thread(target=reader)
+        thread.start()
+        try:
+            return operation(), errors
+        finally:
+            done.set()
+            thread.join()
+    
     def test_update(self):
         self.sb.update(self.msi, self.sample_objs)
         self.sb.update(self.msi, self.sample_objs) # Duplicates should be updated, not appended -- http://github.com/notanumber/xapian-haystack/issues/#issue/6
@@ -116,6 +177,70 @@ class XapianSearchBackendTestCase(TestCase):
             {'flag': u't', 'name': u'david3', 'text': u'Indexed!\n3', 'pub_date': u'20090222000000', 'value': '000000000015', 'id': u'tests.mockmodel.3', 'slug': 'http://example.com/3', 'popularity': '\xcb\x98'}
         ])
     
+    def test_update_flush(self):
+        stats = self.sb.update(self.msi, self.sample_objs, flush_documents=2)
+        self.assertEqual(stats['documents'], 3)
+        self.assert_(stats['rate'] > 0)
+        self.assertEqual(len(self.xapian_search('')), 3)
+        
+        stats = self.sb.update(self.msi, self.sample_objs, flush_megabytes=0)
+        self.assertEqual(stats['documents'], 3)
+        self.assertEqual(len(self.xapian_search('')), 3)
+    
+    def test_update_unchanged(self):
+        stats = self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual((stats['written'], stats['skipped']), (3, 0))
+        stats = self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual((stats['documents'], stats['written'], stats['skipped']), (3, 0, 3))
+        
+        self.sample_objs[1].author = 'daniel2'
+        stats = self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual((stats['written'], stats['skipped']), (1, 2))
+        self.assertEqual(self.sb.search('name:daniel2')['hits'], 1)
+        
+        stats = self.sb.update(self.msi, self.sample_objs, force=True)
+        self.assertEqual((stats['written'], stats['skipped']), (3, 0))
+        self.assertEqual(len(self.xapian_search('')), 3)
+        
+        settings.HAYSTACK_XAPIAN_COMPRESS_THRESHOLD = 1
+        try:
+            stats = self.sb.update(self.msi, self.sample_objs)
+            self.assertEqual((stats['written'], stats['skipped']), (3, 0))
+        finally:
+            del settings.HAYSTACK_XAPIAN_COMPRESS_THRESHOLD
+        
+        self.sb.write_behind = True
+        try:
+            stats = self.sb.update(self.msi, self.sample_objs)
+            self.assertEqual((stats['documents'], stats['written'], stats['skipped']), (3, 0, 0))
+        finally:
+            XHWriteQueue.get(self.sb).stop()
+            self.sb.write_behind = False
+    
+    def test_merge_databases(self):
+        paths = []
+        for i, obj in enumerate(self.sample_objs):
+            path = os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'part%d' % i)
+            SearchBackend(site=self.site, path=path).update(self.msi, [obj])
+            paths.append(path)
+        
+        live = SearchBackend(site=self.site, path=os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'live'))
+        self.assertEqual(live._merge_databases(paths), (3, 0))
+        self.assertEqual(live.document_count(), 3)
+        self.assertEqual([result.pk for result in live.search('*', sort_by=['id'])['results']], [1, 2, 3])
+        
+        self.assertEqual(live._merge_databases(paths[:2], flush_documents=1), (0, 2))
+        self.assertEqual(live.document_count(), 3)
+        
+        # Documents and spelling data are copied into a live database that
+        # is not empty.
+        live = SearchBackend(site=self.site, path=os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'copy'))
+        live.update(self.msi, self.sample_objs[:1])
+        self.assertEqual(live._merge_databases(paths, flush_documents=1), (2, 1))
+        self.assertEqual([result.pk for result in live.search('*', sort_by=['id'])['results']], [1, 2, 3])
+        spellings = [item.term for item in xapian.Database(live.path).spellings()]
+        self.assert_('david3' in spellings)
+    
     def test_remove(self):
         self.sb.update(self.msi, self.sample_objs)
         self.assertEqual(len(self.xapian_search('')), 3)
@@ -127,20 +252,124 @@ class XapianSearchBackendTestCase(TestCase):
             {'flag': u't', 'name': u'david3', 'text': u'Indexed!\n3', 'pub_date': u'20090222000000', 'value': '000000000015', 'id': u'tests.mockmodel.3', 'slug': 'http://example.com/3', 'popularity': '\xcb\x98'}
         ])
     
+    def test_remove_many(self):
+        self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual(self.sb.remove_many(objects=self.sample_objs[:1], identifiers=['tests.mockmodel.1', 'tests.mockmodel.2'], flush_documents=1), 2)
+        self.assertEqual([doc['id'] for doc in self.xapian_search('')], [u'tests.mockmodel.3'])
+        self.assertEqual(self.sb.remove_many(identifiers=['tests.mockmodel.1']), 0)
+        
+        self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual(self.sb.remove_many(query='value:..10'), 2)
+        self.assertEqual(self.sb.remove_many(query=xapian.Query('')), 1)
+        self.assertEqual(len(self.xapian_search('')), 0)
+        
+        # Query matches are fetched flush_documents at a time.
+        self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual(self.sb.remove_many(query=xapian.Query(''), flush_documents=2), 3)
+        self.assertEqual(len(self.xapian_search('')), 0)
+        
+        self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual(self.sb.remove_many(terms=['XCONTENTTYPEtests.anothermockmodel']), 0)
+        self.assertEqual(self.sb.remove_many(terms=['XCONTENTTYPEtests.mockmodel'], flush_documents=2), 3)
+        self.assertEqual(len(self.xapian_search('')), 0)
+    
+    def test_write_queue(self):
+        queue = XHWriteQueue(self.sb, max_documents=100, max_delay=60)
+        try:
+            for obj in self.sample_objs + self.sample_objs[:1]:
+                prepared = self.sb._prepare_document(self.msi, obj)
+                queue.put(prepared[0], prepared)
+            self.assertEqual(len(queue), 3)
+            queue.put(self.sb.get_identifier(self.sample_objs[1]), None)
+            self.assertEqual(len(queue), 3)
+            self.assertEqual(queue.flush(), True)
+            self.assertEqual(len(queue), 0)
+            self.assertEqual([doc['id'] for doc in self.xapian_search('')], [u'tests.mockmodel.1', u'tests.mockmodel.3'])
+        finally:
+            queue.stop()
+        
+        queue = XHWriteQueue(self.sb, max_documents=100, max_delay=60, record_skipped=True)
+        try:
+            sequences = []
+            for obj in self.sample_objs[:2]:
+                prepared = self.sb._prepare_document(self.msi, obj)
+                sequences.append((prepared[0], queue.put(prepared[0], prepared)))
+            self.assertEqual(queue.flush(), True)
+            self.assertEqual(queue.pop_skipped(sequences), [self.sb.get_identifier(self.sample_objs[0])])
+            self.assertEqual(queue.pop_skipped(sequences), [])
+        finally:
+            queue.stop()
+        
+        class BrokenBackend(object):
+            def _write(self, writes, force=False):
+                raise IOError('No space left on device')
+        queue = XHWriteQueue(BrokenBackend(), max_documents=100, max_delay=60)
+        sequence = queue.put(self.sb.get_identifier(self.sample_objs[0]), None)
+        queue.stop()
+        self.assertEqual(queue.dropped, (0, sequence))
+        self.assert_(isinstance(queue.last_error, IOError))
+        self.assertEqual(queue.flush(), False)
+        self.assertEqual(queue.flush(since=sequence), True)
+        
+        self.sb.write_behind = True
+        try:
+            self.assertEqual(self.sb.update(self.msi, self.sample_objs)['documents'], 3)
+            self.sb.remove(self.sample_objs[2])
+            XHWriteQueue.get(self.sb).flush()
+            self.assertEqual([doc['id'] for doc in self.xapian_search('')], [u'tests.mockmodel.1', u'tests.mockmodel.2'])
+            self.sb.update(self.msi, self.sample_objs)
+            self.assertEqual(self.sb.clear(), 3)
+        finally:
+            XHWriteQueue.get(self.sb).stop()
+            self.sb.write_behind = False
+    
+    def test_writer_server(self):
+        socket_path = os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'writer.sock')
+        server = XHWriterServer(socket_path, self.sb)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            while not os.path.exists(socket_path):
+                time.sleep(0.01)
+            self.sb.writer_socket = socket_path
+            stats = self.sb.update(self.msi, self.sample_objs, flush_documents=2)
+            self.assertEqual((stats['documents'], stats['written'], stats['skipped']), (3, 3, 0))
+            self.assertEqual(len(self.xapian_search('')), 3)
+            
+            # The service skips unchanged documents unless they are forced.
+            stats = self.sb.update(self.msi, self.sample_objs, flush_documents=2)
+            self.assertEqual((stats['documents'], stats['written'], stats['skipped']), (3, 0, 3))
+            self.sample_objs[1].author = 'changed'
+            stats = self.sb.update(self.msi, self.sample_objs, flush_documents=2)
+            self.assertEqual((stats['written'], stats['skipped']), (1, 2))
+            self.assertEqual(self.sb.search('changed')['hits'], 1)
+            stats = self.sb.update(self.msi, self.sample_objs, flush_documents=2, force=True)
+            self.assertEqual((stats['written'], stats['skipped']), (3, 0))
+            
+            self.sb.remove(self.sample_objs[0])
+            self.assertEqual([doc['id'] for doc in self.xapian_search('')], [u'tests.mockmodel.2', u'tests.mockmodel.3'])
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertRaises(XHWriterError, self.sb.remove, self.sample_objs[1])
+    
     def test_clear(self):
         self.sb.update(self.msi, self.sample_objs)
         self.assertEqual(len(self.xapian_search('')), 3)
         
-        self.sb.clear()
+        self.assertEqual(self.sb.clear(), 3)
         self.assertEqual(len(self.xapian_search('')), 0)
+        self.assertEqual(self.sb.search('*')['hits'], 0)
+        self.assert_(xapian.Database(settings.HAYSTACK_XAPIAN_PATH).get_metadata('schema'))
+        self.assertEqual(self.sb.clear(), 0)
         
         self.sb.update(self.msi, self.sample_objs)
         self.assertEqual(len(self.xapian_search('')), 3)
         
-        self.sb.clear([AnotherMockModel])
+        self.assertEqual(self.sb.clear([AnotherMockModel]), 0)
         self.assertEqual(len(self.xapian_search('')), 3)
         
-        self.sb.clear([MockModel])
+        self.assertEqual(self.sb.clear([MockModel]), 3)
         self.assertEqual(len(self.xapian_search('')), 0)
         
         self.sb.update(self.msi, self.sample_objs)
@@ -149,6 +378,69 @@ class XapianSearchBackendTestCase(TestCase):
         self.sb.clear([AnotherMockModel, MockModel])
         self.assertEqual(len(self.xapian_search('')), 0)
     
+    def test_clear_generations(self):
+        self.sb.update(self.msi, self.sample_objs)
+        self.assert_(os.path.islink(settings.HAYSTACK_XAPIAN_PATH))
+        self.assertEqual(self.sb._generations().keys(), [0])
+        
+        # Lay the index out in a plain directory, as older versions did.
+        generation_path = self.sb._generation_path(0)
+        os.unlink(settings.HAYSTACK_XAPIAN_PATH)
+        os.rename(generation_path, settings.HAYSTACK_XAPIAN_PATH)
+        
+        # Another program creates a database in the gap while the plain
+        # directory is turned into a symlink.  It may hold committed writes,
+        # so it is left alone and the switch fails.
+        def intruding_place_link(generation_path, link_path):
+            if not os.path.exists(link_path):
+                database = xapian.WritableDatabase(link_path, xapian.DB_CREATE_OR_OPEN)
+                database.flush()
+                del database
+            return SearchBackend._place_link(self.sb, generation_path, link_path)
+        self.sb._place_link = intruding_place_link
+        try:
+            self.assertRaises(OSError, self.sb.clear)
+        finally:
+            del self.sb._place_link
+        self.assert_(os.path.isdir(settings.HAYSTACK_XAPIAN_PATH))
+        self.assert_(not os.path.islink(settings.HAYSTACK_XAPIAN_PATH))
+        self.assertEqual(xapian.Database(generation_path).get_doccount(), 3)
+        
+        # Writers of this backend link the gap back to generation 0.
+        shutil.rmtree(settings.HAYSTACK_XAPIAN_PATH)
+        self.sb.update(self.msi, self.sample_objs[:1])
+        self.assert_(os.path.islink(settings.HAYSTACK_XAPIAN_PATH))
+        self.assertEqual(len(self.xapian_search('')), 3)
+        
+        self.assertEqual(self.sb.clear(), 3)
+        self.assert_(os.path.islink(settings.HAYSTACK_XAPIAN_PATH))
+        self.assertEqual(self.sb._generations().keys(), [1])
+        self.assertEqual(self.sb.search('*')['hits'], 0)
+        
+        self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual(self.sb.compact()['after'] > 0, True)
+        self.assertEqual(self.sb._generations().keys(), [2])
+        self.assertEqual(len(self.xapian_search('')), 3)
+        
+        # A failed switch leaves the live database and the replacement alone.
+        replacement_path = os.path.join(os.path.dirname(settings.HAYSTACK_XAPIAN_PATH), 'replacement')
+        os.makedirs(replacement_path)
+        try:
+            def failing_place_link(generation_path, link_path):
+                raise OSError('Simulated failure')
+            self.sb._place_link = failing_place_link
+            self.assertRaises(OSError, self.sb._replace_database, replacement_path)
+        finally:
+            del self.sb._place_link
+            shutil.rmtree(replacement_path)
+        self.assertEqual(self.sb._generations().keys(), [2])
+        self.assertEqual(len(self.xapian_search('')), 3)
+    
+    def test_clear_while_searching(self):
+        for attempt in xrange(5):
+            self.sb.update(self.msi, self.sample_objs)
+            self.assertEqual(self.search_during(self.sb.clear), (3, []))
+    
     def test_search(self):
         self.sb.update(self.msi, self.sample_objs)
         self.assertEqual(len(self.xapian_search('')), 3)
@@ -180,6 +472,205 @@ class XapianSearchBackendTestCase(TestCase):
         self.assertEqual([result.pk for result in self.sb.search('index popularity:..100.0')['results']], [2])
         self.assertEqual([result.pk for result in self.sb.search('index popularity:100.0..*')['results']], [1, 3])
 
+    def test_lazy_results(self):
+        self.sb.update(self.msi, self.sample_objs)
+        
+        result = self.sb.search('*')['results'][0]
+        self.assertEqual((result.app_label, result.model_name, result.pk), ('tests', 'mockmodel', 1))
+        self.assert_('name' not in result.__dict__)
+        self.assertEqual(result.name, 'david1')
+        self.assertEqual(result.value, 5)
+        self.assertEqual(pickle.loads(pickle.dumps(result)).name, 'david1')
+        
+        result = self.sb.search('Index', highlight=True)['results'][0]
+        self.assert_('highlighted' not in result.__dict__)
+        self.assertEqual(result.highlighted['text'], '<em>Indexed</em>!\n1')
+        
+        results = self.sb.search('index')['results']
+        self.sb.remove(self.sample_objs[0])
+        self.assertEqual(self.sb.search('index')['hits'], 2)
+        self.assertEqual(results[0].pk, 1)
+        self.assertEqual(results[0].name, None)
+        self.assertEqual(results[1].name, 'david2')
+    
+    def test_stored_fields(self):
+        self.sb.update(self.msi, self.sample_objs)
+        
+        results = self.sb.search('*', fields=['name', 'value'])['results']
+        self.assertEqual([(result.pk, result.name, result.value, result.text) for result in results], [
+            (1, 'david1', 5, None), (2, 'david2', 10, None), (3, 'david3', 15, None),
+        ])
+        results = self.sb.search('*', fields='name')['results']
+        self.assertEqual([(result.name, result.value) for result in results], [
+            ('david1', None), ('david2', None), ('david3', None),
+        ])
+        
+        model_data = {'text': u'Indexed!\n' * 100, 'value': 5}
+        data = XHDocumentData.encode('tests', 'mockmodel', 1, model_data, compress_threshold=64)
+        self.assert_(len(data) < len(pickle.dumps(model_data, pickle.HIGHEST_PROTOCOL)))
+        self.assertEqual(XHDocumentData.decode(data), ('tests', 'mockmodel', 1, model_data))
+        self.assertEqual(XHDocumentData.decode(data, ['value']), ('tests', 'mockmodel', 1, {'value': 5}))
+        
+        data = pickle.dumps(('tests', 'mockmodel', 1, model_data), pickle.HIGHEST_PROTOCOL)
+        self.assertEqual(XHDocumentData.decode(data), ('tests', 'mockmodel', 1, model_data))
+        
+        model_data = {
+            'text': u'Indexed!\n1', 'name': u'david1', 'value': 5, 'flag': True,
+            'popularity': 834.0, 'pub_date': datetime.datetime(2009, 2, 24, 12, 30),
+            'slug': u'http://example.com/1', 'tags': [u'a', u'b'], 'missing': None,
+        }
+        for text in (u'Indexed!\n1', u'Indexed!\n' * 1000):
+            model_data['text'] = text
+            data = XHDocumentData.encode('tests', 'mockmodel', 1, model_data)
+            self.assert_(len(data) <= len(pickle.dumps(('tests', 'mockmodel', 1, model_data), pickle.HIGHEST_PROTOCOL)))
+            self.assertEqual(XHDocumentData.decode(data), ('tests', 'mockmodel', 1, model_data))
+        
+        data = XHDocumentData.MAGIC_V1 + marshal.dumps(('tests', 'mockmodel', 'p' + pickle.dumps(1), {'value': 'p' + pickle.dumps(5)}))
+        self.assertEqual(XHDocumentData.decode(data), ('tests', 'mockmodel', 1, {'value': 5}))
+    
+    def test_count_only(self):
+        self.sb.update(self.msi, self.sample_objs)
+        
+        results = self.sb.search('index', count_only=True)
+        self.assertEqual(results['hits'], 3)
+        self.assertEqual(results['results'], [])
+        self.assertEqual(self.sb.search('index', count_only=True, exact_hits=False)['hits'], 3)
+        self.assertEqual(self.sb.search('index', end_offset=1)['hits'], 3)
+        self.assertEqual(self.sb.search('index', count_only=True, facets=['flag'])['facets']['fields']['flag'], [(False, 1), (True, 2)])
+        
+        self.assertEqual([result.pk for result in self.sb.search('*', start_offset=2)['results']], [3])
+        self.assertEqual(self.sb.search('*', start_offset=5)['results'], [])
+        
+        sq = SearchQuery(backend=self.sb)
+        sq.add_filter('content', 'index')
+        self.assertEqual(sq.get_count(), 3)
+    
+    def test_query_filters(self):
+        self.sb.update(self.msi, self.sample_objs)
+        
+        def pks(*filters, **kwargs):
+            sq = SearchQuery(backend=self.sb)
+            for args in filters:
+                sq.add_filter(*args, **kwargs)
+            sq.run()
+            return sorted([result.pk for result in sq._results])
+        
+        self.assertEqual(pks(('name', 'david1')), [1])
+        self.assertEqual(pks(('name', 'david1'), ('name', 'david2')), [])
+        self.assertEqual(pks(('name', 'david1'), ('name', 'david2'), use_or=True), [1, 2])
+        self.assertEqual(pks(('name__startswith', 'david')), [1, 2, 3])
+        self.assertEqual(pks(('value__gt', 5)), [2, 3])
+        self.assertEqual(pks(('value__gte', '10')), [2, 3])
+        self.assertEqual(pks(('value__lt', 15)), [1, 2])
+        self.assertEqual(pks(('value__lte', 10), ('flag', True)), [1])
+        self.assertEqual(pks(('value__in', [5, 15])), [1, 3])
+        self.assertEqual(pks(('pub_date', datetime.date(2009, 2, 23))), [2])
+        self.assertEqual(pks(('pub_date__lte', datetime.date(2009, 2, 23))), [2, 3])
+        self.assertEqual(pks(('content', 'indexed'), ('popularity__gt', 100.0)), [1, 3])
+        self.assertEqual(pks(('content', 'indexed'), ('value', 5)), [1])
+        self.assertEqual(pks(('value', 5)), [1])
+        self.assertEqual(pks(('value', 5), use_not=True), [2, 3])
+        
+        sq = SearchQuery(backend=self.sb)
+        sq.add_filter('content', 'indexed')
+        sq.add_model(MockModel)
+        self.assertEqual(sq.get_count(), 3)
+        sq = SearchQuery(backend=self.sb)
+        sq.add_filter('content', 'indexed')
+        sq.add_model(AnotherMockModel)
+        self.assertEqual(sq.get_count(), 0)
+    
+    def test_query_string_values(self):
+        self.sb.update(self.msi, self.sample_objs)
+        
+        # Query strings, as used by more_like_this and narrow queries, must
+        # use the same form as the value columns.
+        sq = SearchQuery(backend=self.sb)
+        sq.add_filter('pub_date__lte', datetime.datetime(2009, 2, 23, 12, 0, 0, 500))
+        self.assertEqual(self.sb.search('index', narrow_queries=[sq.build_query()])['hits'], 2)
+        sq = SearchQuery(backend=self.sb)
+        sq.add_filter('popularity__gte', 100.5)
+        self.assertEqual(self.sb.search('index', narrow_queries=[sq.build_query()])['hits'], 2)
+        
+        # Short dates, as older query strings wrote them, are padded.
+        self.assertEqual(self.sb.search('index pub_date:20090223..20090224')['hits'], 2)
+        self.assertEqual(self.sb.search('index pub_date:20090223000000..20090224000000')['hits'], 2)
+        self.assertEqual(self.sb.search('index pub_date:200902..20090223')['hits'], 2)
+        self.assertEqual(self.sb.search('index pub_date:20090224..*')['hits'], 1)
+    
+    def test_multi_valued_facets(self):
+        site = XapianSearchSite()
+        site.register(MockModel, XapianTagsSearchIndex)
+        for obj, tags in zip(self.sample_objs, ([u'a', u'b'], [u'b'], [u'b', u'C'])):
+            obj.tags = tags
+        
+        settings.HAYSTACK_XAPIAN_EXACT_FIELDS = ['tags']
+        try:
+            sb = SearchBackend(site=site, path=os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'exact'))
+            sb.update(XapianTagsSearchIndex(MockModel, backend=sb), self.sample_objs)
+            self.assertEqual(sb.search('index', facets=['tags'])['facets']['fields']['tags'], [(u'C', 1), (u'a', 1), (u'b', 3)])
+            self.assertEqual(sb.search('index', facets=['tags'], narrow_queries=['name:david1'])['facets']['fields']['tags'], [(u'a', 1), (u'b', 1)])
+            
+            # The distinct values are kept one to a facet value column.
+            column = sb.schema_plan.facet_columns['tags']
+            self.assertEqual(sb.schema_plan.facet_values('tags', [u'b', u'C', u'b']), [(column, 'C'), (column + 1, 'b')])
+            database = xapian.Database(os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'exact'))
+            self.assertEqual(database.get_value_freq(column), 3)
+            self.assertEqual(database.get_value_freq(column + 1), 2)
+            self.assertEqual(database.get_value_freq(column + 2), 0)
+        finally:
+            del settings.HAYSTACK_XAPIAN_EXACT_FIELDS
+        
+        # The value column of a multi-valued field holds the whole list.
+        sb = SearchBackend(site=site, path=os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'text'))
+        sb.update(XapianTagsSearchIndex(MockModel, backend=sb), self.sample_objs)
+        self.assertRaises(ValueError, sb.search, 'index', facets=['tags'])
+    
+    def test_exact_fields(self):
+        settings.HAYSTACK_XAPIAN_EXACT_FIELDS = ['name']
+        try:
+            self.sample_objs[2].author = 'David Three'
+            self.sb.update(self.msi, self.sample_objs)
+            self.assert_('name' in self.sb.schema_plan.exact)
+            self.assertEqual(self.sb.schema_plan.boolean_term('name', 'David Three'), 'XNAME:David Three')
+            
+            database = xapian.Database(settings.HAYSTACK_XAPIAN_PATH)
+            self.assertEqual(database.get_termfreq('XNAMEdavid1'), 1)
+            self.assertEqual(database.get_termfreq('XNAME:David Three'), 1)
+            self.assertEqual(database.get_termfreq('XNAMEthree'), 0)
+            
+            self.assertEqual([result.pk for result in self.sb.search('index name:david1')['results']], [1])
+            self.assertEqual(self.sb.search('index name:david')['hits'], 0)
+            self.assertEqual(self.sb.search('index', narrow_queries=['name:david2'])['hits'], 1)
+            self.assertEqual(self.sb.search('david1')['hits'], 1)
+            
+            sq = SearchQuery(backend=self.sb)
+            sq.add_filter('name', 'David Three')
+            self.assertEqual(sq.get_count(), 1)
+            sq = SearchQuery(backend=self.sb)
+            sq.add_filter('name__startswith', 'david')
+            self.assertEqual(sq.get_count(), 2)
+        finally:
+            del settings.HAYSTACK_XAPIAN_EXACT_FIELDS
+    
+    def test_exact_fields_values(self):
+        settings.HAYSTACK_XAPIAN_EXACT_FIELDS = ['name', 'value']
+        try:
+            self.sb.update(self.msi, self.sample_objs)
+            database = xapian.Database(settings.HAYSTACK_XAPIAN_PATH)
+            column = self.sb.schema_plan.columns['value']
+            self.assertEqual(database.get_document(1).get_value(column), self.sb._serialise_value(5))
+            
+            self.assertEqual([result.pk for result in self.sb.search('*', sort_by=['-value'])['results']], [3, 2, 1])
+            self.assertEqual([result.pk for result in self.sb.search('*', sort_by=['-name'])['results']], [3, 2, 1])
+            
+            results = self.sb.search('index', facets=['name', 'value'])
+            self.assertEqual(results['facets']['fields']['name'], [('david1', 1), ('david2', 1), ('david3', 1)])
+            self.assertEqual(results['facets']['fields']['value'], [(5, 1), (10, 1), (15, 1)])
+            self.assertEqual(self.sb.search('index value:10..15')['hits'], 2)
+        finally:
+            del settings.HAYSTACK_XAPIAN_EXACT_FIELDS
+    
     def test_field_facets(self):
         self.sb.update(self.msi, self.sample_objs)
         self.assertEqual(len(self.xapian_search('')), 3)
@@ -192,7 +683,78 @@ class XapianSearchBackendTestCase(TestCase):
         results = self.sb.search('index', facets=['flag'])
         self.assertEqual(results['hits'], 3)
         self.assertEqual(results['facets']['fields']['flag'], [(False, 1), (True, 2)])
+        
+        results = self.sb.search('index', facets=['flag', 'value'], end_offset=1)
+        self.assertEqual(len(results['results']), 1)
+        self.assertEqual(results['facets']['fields']['flag'], [(False, 1), (True, 2)])
+        self.assertEqual(results['facets']['fields']['value'], [(5, 1), (10, 1), (15, 1)])
             
+    def test_null_facets(self):
+        site = XapianSearchSite()
+        site.register(MockModel, XapianNullSearchIndex)
+        self.sample_objs[1].pub_date = None
+        self.sample_objs[1].value = None
+        sb = SearchBackend(site=site)
+        sb.update(XapianNullSearchIndex(MockModel, backend=sb), self.sample_objs)
+        
+        results = sb.search('index', facets=['value', 'pub_date'], date_facets={'pub_date': {'start_date': datetime.datetime(2009, 2, 22), 'end_date': datetime.datetime(2009, 2, 25), 'gap_by': 'day'}})
+        self.assertEqual(results['hits'], 3)
+        self.assertEqual(results['facets']['fields']['value'], [(5, 1), (15, 1)])
+        self.assertEqual(results['facets']['fields']['pub_date'], [(datetime.datetime(2009, 2, 22), 1), (datetime.datetime(2009, 2, 24), 1)])
+        self.assertEqual(results['facets']['dates']['pub_date'], [
+            ('2009-02-24T00:00:00', 1),
+            ('2009-02-23T00:00:00', 0),
+            ('2009-02-22T00:00:00', 1),
+        ])
+        
+        # Older versions of the backend stored null values as 'None'.
+        database = xapian.WritableDatabase(settings.HAYSTACK_XAPIAN_PATH, xapian.DB_OPEN)
+        for posting in list(database.postlist('')):
+            document = database.get_document(posting.docid)
+            model_data = XHDocumentData.decode(document.get_data())[3]
+            for field_name, prefix, column in sb.schema_plan.indexed:
+                document.add_value(column, sb._marshal_value(model_data[field_name]))
+            database.replace_document(posting.docid, document)
+        database.set_metadata('value_encoding', '1')
+        database.flush()
+        del database
+        
+        results = sb.search('index', facets=['value', 'pub_date'])
+        self.assertEqual(results['facets']['fields']['value'], [(5, 1), (15, 1), (None, 1)])
+        self.assertEqual(results['facets']['fields']['pub_date'], [(datetime.datetime(2009, 2, 22), 1), (datetime.datetime(2009, 2, 24), 1), (None, 1)])
+    
+    def test_null_values(self):
+        site = XapianSearchSite()
+        site.register(MockModel, XapianNullSearchIndex)
+        self.sample_objs[1].pub_date = None
+        self.sample_objs[1].value = None
+        sb = SearchBackend(site=site)
+        sb.update(XapianNullSearchIndex(MockModel, backend=sb), self.sample_objs)
+        
+        database = xapian.Database(settings.HAYSTACK_XAPIAN_PATH)
+        self.assertEqual(database.get_document(2).get_value(sb.schema_plan.columns['value']), '')
+        self.assertEqual(sb._serialise_value(None), u'')
+        self.assertEqual(sb._unmarshal_value('', 'long'), None)
+        
+        def pks(*filters):
+            sq = SearchQuery(backend=sb)
+            for args in filters:
+                sq.add_filter(*args)
+            sq.run()
+            return sorted([result.pk for result in sq._results])
+        
+        self.assertEqual(pks(('value__lt', 100)), [1, 3])
+        self.assertEqual(pks(('value__gte', -100)), [1, 3])
+        self.assertEqual(pks(('pub_date__lte', datetime.date(2009, 3, 1))), [1, 3])
+        self.assertEqual(pks(('value', None)), [2])
+        self.assertEqual(pks(('value__gt', None)), [])
+        self.assertEqual([result.pk for result in sb.search('index value:0..100')['results']], [1, 3])
+        self.assertEqual(sb.search('index pub_date:00010101000000..99991231000000')['hits'], 2)
+        
+        # Null values sort before every other value.
+        self.assertEqual([result.pk for result in sb.search('*', sort_by=['value'])['results']], [2, 1, 3])
+        self.assertEqual([result.pk for result in sb.search('*', sort_by=['-pub_date'])['results']], [1, 3, 2])
+    
     def test_date_facets(self):
         self.sb.update(self.msi, self.sample_objs)
         self.assertEqual(len(self.xapian_search('')), 3)
@@ -215,6 +777,20 @@ class XapianSearchBackendTestCase(TestCase):
             ('2009-02-16T00:00:00', 3),
             ('2009-02-01T00:00:00', 0)
         ])
+        
+        results = self.sb.search('index', end_offset=1, date_facets={'pub_date': {'start_date': datetime.datetime(2009, 2, 23), 'end_date': datetime.datetime(2009, 2, 24, 12), 'gap_by': 'hour', 'gap_amount': 12}})
+        self.assertEqual(results['facets']['dates']['pub_date'], [
+            ('2009-02-24T00:00:00', 1),
+            ('2009-02-23T12:00:00', 0),
+            ('2009-02-23T00:00:00', 1),
+        ])
+    
+    def test__date_gap(self):
+        self.assertEqual(self.sb._date_gap(datetime.datetime(2008, 11, 30), 'month', 3), datetime.datetime(2009, 2, 28))
+        self.assertEqual(self.sb._date_gap(datetime.datetime(2008, 12, 15), 'month', 1), datetime.datetime(2009, 1, 15))
+        self.assertEqual(self.sb._date_gap(datetime.datetime(2008, 12, 15), 'month', 14), datetime.datetime(2010, 2, 15))
+        self.assertEqual(self.sb._date_gap(datetime.datetime(2008, 2, 29), 'year', 1), datetime.datetime(2009, 2, 28))
+        self.assertEqual(self.sb._date_gap(datetime.datetime(2009, 2, 1), 'hour', 6), datetime.datetime(2009, 2, 1, 6))
 
     def test_query_facets(self):
         self.sb.update(self.msi, self.sample_objs)
@@ -224,6 +800,10 @@ class XapianSearchBackendTestCase(TestCase):
         results = self.sb.search('index', query_facets={'name': 'da*'})
         self.assertEqual(results['hits'], 3)
         self.assertEqual(results['facets']['queries']['name'], ('da*', 3))
+        
+        results = self.sb.search('index', narrow_queries=['name:david1'], query_facets={'name': 'da*', 'flag': 'flag:f'})
+        self.assertEqual(results['hits'], 1)
+        self.assertEqual(results['facets']['queries'], {'name': ('da*', 1), 'flag': ('flag:f', 0)})
     
     def test_narrow_queries(self):
         self.sb.update(self.msi, self.sample_objs)
@@ -239,7 +819,25 @@ class XapianSearchBackendTestCase(TestCase):
         
         self.assertEqual(self.sb.search('', highlight=True), {'hits': 0, 'results': []})
         self.assertEqual(self.sb.search('Index', highlight=True)['hits'], 3)
-        self.assertEqual([result.highlighted['text'] for result in self.sb.search('Index', highlight=True)['results']], ['<em>Index</em>ed!\n1', '<em>Index</em>ed!\n2', '<em>Index</em>ed!\n3'])
+        self.assertEqual([result.highlighted['text'] for result in self.sb.search('Index', highlight=True)['results']], ['<em>Indexed</em>!\n1', '<em>Indexed</em>!\n2', '<em>Indexed</em>!\n3'])
+        
+        content = ' '.join(['filler'] * 100 + ['indexing', 'works'] + ['filler'] * 100)
+        highlighted = self.sb._do_highlight(content, 'index AND works')
+        self.assert_(highlighted.startswith('... '))
+        self.assert_(highlighted.endswith(' ...'))
+        self.assert_('<em>indexing</em> <em>works</em>' in highlighted)
+        self.assert_(len(highlighted) < len(content) / 2)
+        self.assertEqual(self.sb._do_highlight('nothing here', 'index'), 'nothing here')
+        
+        # Windows that touch are merged rather than joined with ' ... '.
+        settings.HAYSTACK_XAPIAN_HIGHLIGHT_CHARACTERS = 20
+        try:
+            content = ' '.join(['aa'] * 30 + ['works'] + ['bb'] * 4 + ['works'] + ['cc'] * 30)
+            self.assertEqual(self.sb._do_highlight(content, 'works'), '... aa <em>works</em> bb bb bb bb <em>works</em> cc cc cc cc ...')
+            content = ' '.join(['aa'] * 30 + ['works'] + ['bb'] * 6 + ['works'] + ['cc'] * 30)
+            self.assertEqual(self.sb._do_highlight(content, 'works'), '... aa <em>works</em> bb bb bb ... bb <em>works</em> cc cc cc ...')
+        finally:
+            del settings.HAYSTACK_XAPIAN_HIGHLIGHT_CHARACTERS
     
     def test_spelling_suggestion(self):
         self.sb.update(self.msi, self.sample_objs)
@@ -272,11 +870,188 @@ class XapianSearchBackendTestCase(TestCase):
         results = self.sb.more_like_this(self.sample_objs[0], additional_query_string='david3')
         self.assertEqual(results['hits'], 1)
         self.assertEqual([result.pk for result in results['results']], [3])
+        
+        sq = SearchQuery(backend=self.sb)
+        sq.more_like_this(self.sample_objs[0])
+        self.assertEqual(sq.get_count(), 2)
+        sq = SearchQuery(backend=self.sb)
+        sq.add_filter('content', 'david3')
+        sq.more_like_this(self.sample_objs[0])
+        self.assertEqual(sq.get_count(), 1)
     
     def test_document_count(self):
         self.sb.update(self.msi, self.sample_objs)
         self.assertEqual(self.sb.document_count(), 3)
     
+    def test_shards(self):
+        sb = SearchBackend(site=self.site, path=os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'sharded'), shards=2)
+        self.assertEqual(len(sb._shard_paths()), 2)
+        sb.update(self.msi, self.sample_objs)
+        sb.update(self.msi, self.sample_objs)
+        self.assertEqual(sb.document_count(), 3)
+        self.assertEqual(
+            sorted([xapian.Database(path).get_doccount() for path in sb._shard_paths()]),
+            sorted([[sb._shard(sb.get_identifier(obj)) for obj in self.sample_objs].count(shard) for shard in (0, 1)])
+        )
+        
+        self.assertEqual(sb.search('*')['hits'], 3)
+        self.assertEqual([result.pk for result in sb.search('*', sort_by=['-value'])['results']], [3, 2, 1])
+        self.assertEqual([result.pk for result in sb.search('index value:10..15')['results']], [2, 3])
+        self.assertEqual([result.pk for result in sb.more_like_this(self.sample_objs[0])['results']], [3, 2])
+        
+        sb.remove(self.sample_objs[0])
+        self.assertEqual(sb.search('*')['hits'], 2)
+        sb.clear()
+        self.assertEqual(sb.document_count(), 0)
+    
+    def test_shard_count(self):
+        path = os.path.join(settings.HAYSTACK_XAPIAN_PATH, 'sharded')
+        SearchBackend(site=self.site, path=path, shards=2).update(self.msi, self.sample_objs)
+        self.assertEqual(xapian.Database(os.path.join(path, 'shard0')).get_metadata('shards'), '2')
+        self.assertRaises(ImproperlyConfigured, SearchBackend(site=self.site, path=path, shards=3).update, self.msi, self.sample_objs)
+        self.assertRaises(ImproperlyConfigured, SearchBackend(site=self.site, path=path, shards=1).update, self.msi, self.sample_objs)
+        
+        # Indexes written before the count was stored are checked too.
+        database = xapian.WritableDatabase(os.path.join(path, 'shard0'), xapian.DB_OPEN)
+        database.set_metadata('shards', '')
+        database.flush()
+        del database
+        self.assertRaises(ImproperlyConfigured, SearchBackend(site=self.site, path=path, shards=3).update, self.msi, self.sample_objs)
+        stats = SearchBackend(site=self.site, path=path, shards=2).update(self.msi, self.sample_objs)
+        self.assertEqual(stats['skipped'], 3)
+        
+        # An unsharded index is not ignored when shards are turned on.
+        self.sb.update(self.msi, self.sample_objs)
+        database = xapian.WritableDatabase(settings.HAYSTACK_XAPIAN_PATH, xapian.DB_OPEN)
+        database.set_metadata('shards', '')
+        database.flush()
+        del database
+        self.assertRaises(ImproperlyConfigured, SearchBackend(site=self.site, shards=2).update, self.msi, self.sample_objs)
+        self.assertEqual(self.sb.update(self.msi, self.sample_objs)['skipped'], 3)
+    
+    def test_database_pool(self):
+        self.sb.update(self.msi, self.sample_objs)
+        database = self.sb._database()
+        self.assert_(self.sb._database() is database)
+        self.assert_(SearchBackend(site=self.site)._database() is database)
+        
+        self.sb.remove(self.sample_objs[0])
+        self.assertEqual(self.sb.search('*')['hits'], 2)
+        self.assertEqual(self.sb.document_count(), 2)
+        
+        DATABASE_POOL.discard(settings.HAYSTACK_XAPIAN_PATH)
+        self.assert_(self.sb._database() is not database)
+        
+        # A commit within the same mtime tick as the last one is still seen,
+        # as long as the database was modified within DATABASE_MTIME_WINDOW.
+        revision = DATABASE_POOL.revision(settings.HAYSTACK_XAPIAN_PATH)
+        self.assert_(DATABASE_POOL.recent((revision,)))
+        self.backdate_index(1.5)
+        self.assert_(DATABASE_POOL.recent((DATABASE_POOL.revision(settings.HAYSTACK_XAPIAN_PATH),)))
+        self.backdate_index(3)
+        self.assert_(not DATABASE_POOL.recent((DATABASE_POOL.revision(settings.HAYSTACK_XAPIAN_PATH),)))
+    
+    def test_result_cache(self):
+        self.sb.update(self.msi, self.sample_objs)
+        settings.HAYSTACK_XAPIAN_RESULT_CACHE_ENTRIES = 10
+        try:
+            # Searches against a recently written database are never cached,
+            # so backdate it.
+            self.backdate_index()
+            cache = self.sb._result_cache()
+            cache.clear()
+            
+            results = self.sb.search('index', facets=['flag'])
+            self.assertEqual(len(cache), 1)
+            cached = self.sb.search('index   ', facets=['flag'])
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(cached['hits'], results['hits'])
+            self.assertEqual(cached['facets'], results['facets'])
+            self.assertEqual([result.pk for result in cached['results']], [1, 2, 3])
+            self.assertEqual(cached['results'][0].name, 'david1')
+            
+            # The same query string with different filters or models.
+            def search(value, *models):
+                sq = SearchQuery(backend=self.sb)
+                sq.add_filter('name', value)
+                return [result.pk for result in self.sb.search(
+                    'index', query_filters=sq.query_filters, models=list(models)
+                )['results']]
+            
+            self.assertEqual(search('david1'), [1])
+            self.assertEqual(search('david2'), [2])
+            self.assertEqual(search('david2', MockModel), [2])
+            self.assertEqual(search('david2', AnotherMockModel), [])
+            self.assertEqual(search('david1'), [1])
+            self.assertEqual(cache.hits, 2)
+            
+            self.sb.remove(self.sample_objs[0])
+            self.backdate_index(5)
+            self.assertEqual(self.sb.search('index', facets=['flag'])['hits'], 2)
+            self.assertEqual(cache.hits, 2)
+            
+            # Nothing is cached within DATABASE_MTIME_WINDOW of a commit.
+            self.sb.remove(self.sample_objs[1])
+            self.backdate_index(1.5)
+            size = len(cache)
+            self.assertEqual(self.sb.search('index', facets=['flag'])['hits'], 1)
+            self.assertEqual(len(cache), size)
+        finally:
+            del settings.HAYSTACK_XAPIAN_RESULT_CACHE_ENTRIES
+    
+    def test_query_cache(self):
+        self.sb.update(self.msi, self.sample_objs)
+        # Handles on a recently written database are reopened on every
+        # search, dropping the cache, so backdate it.
+        self.backdate_index()
+        self.assertEqual(self.sb.search('index', narrow_queries=['name:david1'])['hits'], 1)
+        cache = self.sb._database_cache['parsed_queries']
+        self.assertEqual((len(cache), cache.hits), (2, 0))
+        
+        self.assertEqual(self.sb.search('index', narrow_queries=['name:david1'])['hits'], 1)
+        self.assertEqual(self.sb.search('name:david1')['hits'], 1)
+        self.assertEqual((len(cache), cache.hits), (2, 3))
+    
+    def test_compact(self):
+        self.sb.update(self.msi, self.sample_objs)
+        self.sb.update(self.msi, self.sample_objs, force=True)
+        self.sb.remove(self.sample_objs[0])
+        
+        report = self.sb.compact()
+        self.assert_(0 < report['after'] <= report['before'])
+        self.assert_('postlist' in report['tables'])
+        self.assertEqual(report['after'], sum([after for before, after in report['tables'].values()]))
+        self.assertEqual([result.pk for result in self.sb.search('index')['results']], [2, 3])
+        self.assertEqual(len(self.xapian_search('')), 2)
+        
+        for attempt in xrange(5):
+            report, errors = self.search_during(self.sb.compact)
+            self.assertEqual(errors, [])
+        self.assertEqual([result.pk for result in self.sb.search('index')['results']], [2, 3])
+    
+    def test_rebuild(self):
+        self.sb.update(self.msi, self.sample_objs)
+        parent = os.path.dirname(os.path.abspath(settings.HAYSTACK_XAPIAN_PATH))
+        try:
+            stats = self.sb.rebuild([(self.msi, self.sample_objs[:2])])
+            self.assertEqual((stats['documents'], stats['generation']), (2, 1))
+            self.assert_(os.path.islink(settings.HAYSTACK_XAPIAN_PATH))
+            self.assertEqual(self.sb.search('index')['hits'], 2)
+            
+            self.sb.update(self.msi, self.sample_objs)
+            self.assertEqual(self.sb.search('index')['hits'], 3)
+            self.assertEqual(self.sb.rebuild([(self.msi, self.sample_objs[:1])])['generation'], 2)
+            self.assertEqual(self.sb.search('index')['hits'], 1)
+            self.assertEqual(sorted(self.sb._generations().keys()), [1, 2])
+            
+            self.sb.rebuild([], keep=0)
+            self.assertEqual(self.sb._generations().keys(), [3])
+            self.assertEqual(self.sb.search('*')['hits'], 0)
+        finally:
+            self.sb.delete_index()
+        self.assert_(not os.path.lexists(settings.HAYSTACK_XAPIAN_PATH))
+        self.assertEqual(self.sb._generations(), {})
+    
     def test_delete_index(self):
         self.sb.update(self.msi, self.sample_objs)
         self.assert_(self.sb.document_count() > 0)
@@ -326,6 +1101,17 @@ class XapianSearchBackendTestCase(TestCase):
 
         results = self.sb.search('*', boost={'true': 1.5})
         self.assertEqual([result.pk for result in results['results']], [1, 3, 2])
+        
+        # Boost terms are part of the match set, so counts must use them too.
+        def query():
+            sq = SearchQuery(backend=self.sb)
+            sq.add_filter('content', 'david1')
+            sq.add_boost('david2', 2)
+            return sq
+        
+        sq = query()
+        sq.run()
+        self.assertEqual(query().get_count(), len(sq._results))
 
     def test__marshal_value(self):
         self.assertEqual(self.sb._marshal_value('abc'), u'abc')
@@ -339,16 +1125,192 @@ class XapianSearchBackendTestCase(TestCase):
         self.assertEqual(self.sb._marshal_value(datetime.datetime(2009, 5, 9, 0, 0)), u'20090509000000')
         self.assertEqual(self.sb._marshal_value(datetime.datetime(1899, 5, 18, 0, 0)), u'18990518000000')
         self.assertEqual(self.sb._marshal_value(datetime.datetime(2009, 5, 18, 1, 16, 30, 250)), u'20090518011630000250')
+    
+    def test__serialise_value(self):
+        self.assertEqual(self.sb._serialise_value('abc'), u'abc')
+        self.assertEqual(self.sb._serialise_value(True), u't')
+        self.assertEqual(self.sb._serialise_value(2653), xapian.sortable_serialise(2653))
+        self.assertEqual(self.sb._serialise_value(25.5), '\xb2`')
+        self.assertEqual(self.sb._serialise_value(datetime.datetime(2009, 5, 9, 16, 14)), xapian.sortable_serialise(20090509161400))
+        self.assertEqual(self.sb._serialise_value(datetime.date(2009, 5, 9)), xapian.sortable_serialise(20090509000000))
+        self.assert_(self.sb._serialise_value(-5) < self.sb._serialise_value(3) < self.sb._serialise_value(10 ** 13))
+        self.assertEqual(self.sb._serialise_value(1, VALUE_ENCODING - 1), '000000000001')
 
     def test_build_schema(self):
         (content_field_name, fields) = self.sb.build_schema(self.site.all_searchfields())
         self.assertEqual(content_field_name, 'text')
         self.assertEqual(len(fields), 6)
         self.assertEqual(fields, [
+            {'column': 1, 'type': 'boolean', 'field_name': 'flag', 'multi_valued': 'false'},
+            {'column': 2, 'type': 'text', 'field_name': 'name', 'multi_valued': 'false'},
+            {'column': 3, 'type': 'float', 'field_name': 'popularity', 'multi_valued': 'false'},
+            {'column': 4, 'type': 'date', 'field_name': 'pub_date', 'multi_valued': 'false'},
+            {'column': 5, 'type': 'text', 'field_name': 'text', 'multi_valued': 'false'},
+            {'column': 6, 'type': 'long', 'field_name': 'value', 'multi_valued': 'false'},
+        ])
+    
+    def test_migrate_values(self):
+        self.sb.update(self.msi, self.sample_objs)
+        
+        # Rewrite the index the way older versions of the backend did.
+        database = xapian.WritableDatabase(settings.HAYSTACK_XAPIAN_PATH, xapian.DB_OPEN)
+        for posting in list(database.postlist('')):
+            document = database.get_document(posting.docid)
+            model_data = XHDocumentData.decode(document.get_data())[3]
+            for field_name, prefix, column in self.sb.schema_plan.indexed:
+                document.add_value(column, self.sb._marshal_value(model_data[field_name]))
+            database.replace_document(posting.docid, document)
+        database.set_metadata('value_encoding', '1')
+        database.flush()
+        del database
+        
+        spellings = len(list(xapian.Database(settings.HAYSTACK_XAPIAN_PATH).spellings()))
+        self.assert_(spellings)
+        self.assertEqual([result.pk for result in self.sb.search('index value:10..*')['results']], [2, 3])
+        self.assertEqual(self.sb.schema_plan.value_encoding, 1)
+        self.assertEqual(self.sb.search('index', facets=['value'])['facets']['fields']['value'], [(5, 1), (10, 1), (15, 1)])
+        
+        self.assertEqual(self.sb.migrate_values(flush_documents=2), 3)
+        self.assertEqual(self.sb.migrate_values(), 0)
+        self.assertEqual(xapian.Database(settings.HAYSTACK_XAPIAN_PATH).get_metadata('value_encoding'), str(VALUE_ENCODING))
+        self.assertEqual([result.pk for result in self.sb.search('index value:10..*')['results']], [2, 3])
+        self.assertEqual(self.sb.schema_plan.value_encoding, VALUE_ENCODING)
+        self.assertEqual(self.sb.search('index', facets=['value'])['facets']['fields']['value'], [(5, 1), (10, 1), (15, 1)])
+        self.assertEqual(len(list(xapian.Database(settings.HAYSTACK_XAPIAN_PATH).spellings())), spellings)
+        
+        # The digests are rewritten, so unchanged documents are skipped.
+        stats = self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual((stats['written'], stats['skipped']), (0, 3))
+    
+    def test_migrate_values_layout(self):
+        self.sb.update(self.msi, self.sample_objs)
+        
+        # Rewrite the index with the fields starting in column 0, the way the
+        # earliest versions of the backend laid it out.
+        content_field_name, schema = self.sb.build_schema(self.site.all_searchfields())
+        for field_dict in schema:
+            field_dict['column'] -= 1
+        database = xapian.WritableDatabase(settings.HAYSTACK_XAPIAN_PATH, xapian.DB_OPEN)
+        for posting in list(database.postlist('')):
+            document = database.get_document(posting.docid)
+            model_data = XHDocumentData.decode(document.get_data())[3]
+            document.clear_values()
+            for field_dict in schema:
+                document.add_value(field_dict['column'], self.sb._marshal_value(model_data[field_dict['field_name']]))
+            database.replace_document(posting.docid, document)
+        database.set_metadata('schema', pickle.dumps(schema, pickle.HIGHEST_PROTOCOL))
+        database.set_metadata('schema_fingerprint', '')
+        database.set_metadata('value_encoding', '')
+        database.flush()
+        del database
+        
+        self.sb.update(self.msi, self.sample_objs[:1])
+        self.assertEqual(self.sb.schema_plan.columns['flag'], 0)
+        self.assertEqual([result.pk for result in self.sb.search('index', sort_by=['-name'])['results']], [3, 2, 1])
+        self.assertEqual(self.sb.search('index', facets=['flag'])['facets']['fields']['flag'], [(False, 1), (True, 2)])
+        
+        self.assertEqual(self.sb.migrate_values(), 3)
+        self.assertEqual(self.sb.schema_plan.columns['flag'], 6)
+        database = xapian.Database(settings.HAYSTACK_XAPIAN_PATH)
+        self.assertEqual(database.get_document(1).get_value(0), 'tests.mockmodel.1')
+        self.assertEqual([result.pk for result in self.sb.search('index', sort_by=['-name'])['results']], [3, 2, 1])
+        self.assertEqual(self.sb.search('index', facets=['flag'])['facets']['fields']['flag'], [(False, 1), (True, 2)])
+        
+        self.sb.update(self.msi, self.sample_objs)
+        self.assertEqual(self.sb.schema_plan.columns['flag'], 6)
+        self.assertEqual([result.pk for result in self.sb.search('index', sort_by=['-name'])['results']], [3, 2, 1])
+    
+    def test_schema_plan(self):
+        self.sb.update(self.msi, self.sample_objs)
+        self.sb._database()
+        plan = self.sb.schema_plan
+        self.assertEqual(plan.content_field_name, 'text')
+        self.assertEqual(plan.prefixes['pub_date'], 'XPUB_DATE')
+        self.assertEqual(plan.columns['value'], 6)
+        self.assertEqual(plan.types['popularity'], 'float')
+        self.assertEqual(plan.column('id'), 0)
+        
+        # Each field's serialiser gives what the generic one would.
+        for field_name, value in (
+            ('name', u'david1'), ('name', 'david1'), ('name', 5), ('value', 5),
+            ('value', 5L), ('value', '5'), ('popularity', 2.5), ('popularity', 2),
+            ('pub_date', datetime.date(2009, 2, 24)), ('pub_date', datetime.datetime(2009, 2, 24, 12)),
+            ('flag', True), ('flag', 0), ('value', None),
+        ):
+            self.assertEqual(plan.serialisers[field_name](value), self.sb._serialise_value(value))
+        self.assertEqual(plan.serialisers['value'](5), xapian.sortable_serialise(5))
+        
+        sb = SearchBackend(site=self.site)
+        sb._database()
+        self.assert_(sb.schema_plan is plan)
+    
+    def test_schema_metadata(self):
+        self.sb.update(self.msi, self.sample_objs)
+        database = xapian.Database(settings.HAYSTACK_XAPIAN_PATH)
+        fingerprint = database.get_metadata('schema_fingerprint')
+        self.assert_(fingerprint)
+        
+        self.sb.update(self.msi, self.sample_objs)
+        database = xapian.Database(settings.HAYSTACK_XAPIAN_PATH)
+        self.assertEqual(database.get_metadata('schema_fingerprint'), fingerprint)
+        
+        (content_field_name, fields) = self.sb.build_schema(self.site.all_searchfields())
+        stored_fields = [
             {'column': 0, 'type': 'text', 'field_name': 'name', 'multi_valued': 'false'},
-            {'column': 1, 'type': 'text', 'field_name': 'text', 'multi_valued': 'false'},
-            {'column': 2, 'type': 'float', 'field_name': 'popularity', 'multi_valued': 'false'},
-            {'column': 3, 'type': 'long', 'field_name': 'value', 'multi_valued': 'false'},
-            {'column': 4, 'type': 'boolean', 'field_name': 'flag', 'multi_valued': 'false'},
-            {'column': 5, 'type': 'date', 'field_name': 'pub_date', 'multi_valued': 'false'},
+            {'column': 7, 'type': 'long', 'field_name': 'value', 'multi_valued': 'false'},
+        ]
+        self.assertEqual([(field['field_name'], field['column']) for field in self.sb._merge_schema(stored_fields, fields)], [
+            ('flag', 8), ('name', 9), ('popularity', 10), ('pub_date', 11), ('text', 12), ('value', 7),
+        ])
+        self.assertEqual([(field['field_name'], field['column']) for field in self.sb._merge_schema(stored_fields, fields, 1)], [
+            ('flag', 8), ('name', 0), ('popularity', 9), ('pub_date', 10), ('text', 11), ('value', 7),
         ])
+
+
+class XapianParallelUpdateTestCase(TransactionTestCase):
+    def setUp(self):
+        super(XapianParallelUpdateTestCase, self).setUp()
+        
+        temp_path = os.path.join('tmp', 'test_xapian_query')
+        self.old_xapian_path = getattr(settings, 'HAYSTACK_XAPIAN_PATH', temp_path)
+        settings.HAYSTACK_XAPIAN_PATH = temp_path
+        
+        self.site = XapianSearchSite()
+        self.sb = SearchBackend(site=self.site)
+        self.index = XapianParallelSearchIndex(MockModel, backend=self.sb)
+        self.site.register(MockModel, XapianParallelSearchIndex)
+        
+        # Workers read the objects through their own database connections,
+        # so they are committed rather than kept in a test transaction.
+        self.pks = []
+        for i in xrange(1, 6):
+            mock = MockModel.objects.create(
+                user='david%s' % i, pub_date=datetime.datetime(2009, 2, 25) - datetime.timedelta(days=i),
+                value=i * 5, flag=bool(i % 2), slug='http://example.com/%d' % i, popularity=i * 10.0
+            )
+            self.pks.append(mock.pk)
+    
+    def tearDown(self):
+        self.sb.delete_index()
+        MockModel.objects.all().delete()
+        
+        settings.HAYSTACK_XAPIAN_PATH = self.old_xapian_path
+        super(XapianParallelUpdateTestCase, self).tearDown()
+    
+    def test_parallel_update(self):
+        stats = self.sb.parallel_update(self.index, MockModel.objects.all(), processes=2)
+        self.assertEqual((stats['documents'], stats['written'], stats['skipped']), (5, 5, 0))
+        self.assertEqual(self.sb.document_count(), 5)
+        self.assertEqual([result.pk for result in self.sb.search('indexed', sort_by=['value'])['results']], self.pks)
+        self.assertEqual([result.pk for result in self.sb.search('david3')['results']], [self.pks[2]])
+        
+        # The live database is no longer empty, so the second run copies
+        # the changed document in and skips the rest.
+        MockModel.objects.filter(pk=self.pks[0]).update(user='changed')
+        stats = self.sb.parallel_update(self.index, MockModel.objects.all(), processes=2)
+        self.assertEqual((stats['documents'], stats['written'], stats['skipped']), (5, 1, 4))
+        self.assertEqual(self.sb.document_count(), 5)
+        self.assertEqual([result.pk for result in self.sb.search('changed')['results']], [self.pks[0]])
+        self.assertEqual(self.sb.search('david1')['hits'], 0)
+        spellings = [item.term for item in xapian.Database(settings.HAYSTACK_XAPIAN_PATH).spellings()]
+        self.assert_('changed' in spellings)
@@ -37,13 +37,7 @@ class XapianSearchQueryTestCase(TestCase):
         self.sq = SearchQuery(backend=SearchBackend())
 
     def tearDown(self):
-        if os.path.exists(settings.HAYSTACK_XAPIAN_PATH):
-            index_files = os.listdir(settings.HAYSTACK_XAPIAN_PATH)
-
-            for index_file in index_files:
-                os.remove(os.path.join(settings.HAYSTACK_XAPIAN_PATH, index_file))
-
-            os.removedirs(settings.HAYSTACK_XAPIAN_PATH)
+        self.sq.backend.delete_index()
 
         settings.HAYSTACK_XAPIAN_PATH = self.old_xapian_path
         super(XapianSearchQueryTestCase, self).tearDown()
@@ -121,6 +115,11 @@ class XapianSearchQueryTestCase(TestCase):
         self.sq.add_filter('pub_date', datetime.datetime(2009, 5, 9, 16, 20))
         self.assertEqual(self.sq.build_query(), u'pub_date:20090509162000')
 
+    def test_build_query_with_microseconds_and_floats(self):
+        self.sq.add_filter('pub_date__lte', datetime.datetime(2009, 2, 10, 1, 59, 0, 500))
+        self.sq.add_filter('popularity__gte', 100.5)
+        self.assertEqual(self.sq.build_query(), u'pub_date:..20090210015900 AND popularity:100.5..*')
+
     def test_build_query_with_sequence_and_filter_not_in(self):
         self.sq.add_filter('id__exact', [1, 2, 3])
         self.assertEqual(self.sq.build_query(), u'id:[1, 2, 3]')
\ No newline at end of file
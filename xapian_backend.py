@@ -14,17 +14,31 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import atexit
+import bisect
+import calendar
+import copy
 import datetime
 import cPickle as pickle
+import hashlib
+import marshal
 import os
 import re
 import shutil
+import socket
+import struct
 import sys
-import warnings
+import tempfile
+import threading
+import time
+import zlib
+
+from functools import wraps
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.utils.encoding import smart_unicode, force_unicode
+from django.db.models import get_model
+from django.utils.encoding import smart_str, smart_unicode, force_unicode
 
 from haystack.backends import BaseSearchBackend, BaseSearchQuery
 from haystack.exceptions import MissingDependency
@@ -36,73 +50,1539 @@ try:
 except ImportError:
     raise MissingDependency("The 'xapian' backend requires the installation of 'xapian'. Please refer to the documentation.")
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 
 DEFAULT_MAX_RESULTS = 100000
+DEFAULT_FLUSH_DOCUMENTS = 1000
+DEFAULT_FLUSH_MEGABYTES = 16
+DEFAULT_RESULT_CACHE_MEGABYTES = 16
+DEFAULT_QUERY_CACHE_ENTRIES = 1000
+DEFAULT_QUEUE_SECONDS = 1.0
+DEFAULT_WRITER_TIMEOUT = 60
+DEFAULT_HIGHLIGHT_CHARACTERS = 200
+DEFAULT_HIGHLIGHT_SNIPPETS = 3
 
 DOCUMENT_ID_TERM_PREFIX = 'Q'
 DOCUMENT_CUSTOM_TERM_PREFIX = 'X'
 DOCUMENT_CT_TERM_PREFIX = DOCUMENT_CUSTOM_TERM_PREFIX + 'CONTENTTYPE'
 
+DOCUMENT_ID_VALUE_COLUMN = 0
+DOCUMENT_DIGEST_VALUE_COLUMN = 0xfffffffe
+
+# Each multi-valued exact field keeps its distinct values in a block of
+# value columns of its own, one value per column, from
+# FACET_VALUE_COLUMN_BASE + column * FACET_VALUE_COLUMNS on.
+FACET_VALUE_COLUMN_BASE = 0x40000000
+FACET_VALUE_COLUMNS = 0x10000
+
+MAX_TERM_LENGTH = 245
+
+# Version 2 added the facet value columns of multi-valued exact fields.
+SCHEMA_VERSION = 2
+
+# Version 1 stored integers as '%012d' and dates as YYYYMMDDHHMMSS strings;
+# version 2 stores both with `xapian.sortable_serialise`.
+VALUE_ENCODING = 2
+
+DATABASE_MODIFIED_RETRIES = 3
+DATABASE_REPLACED_RETRIES = 20
+DATABASE_REPLACED_DELAY = 0.025
+
+# Commits less than this many seconds old may share an mtime with a later
+# one on filesystems with 1 second timestamps, so they are never trusted.
+DATABASE_MTIME_WINDOW = 2.0
+
+# Files whose size and mtime change when a Xapian database is committed.
+DATABASE_VERSION_FILES = (
+    'iamglass', 'record.baseA', 'record.baseB', 'postlist.baseA', 'postlist.baseB',
+)
+
+
+class XHDatabaseHandle(object):
+    """
+    A pooled, read-only `xapian.Database` together with the revision marker
+    it was last (re)opened at and a `cache` of values derived from that
+    revision, such as the decoded schema.
+    
+    When given more than one path, the handle combines the databases with
+    `add_database` so that they are searched as one.
+    """
+    def __init__(self, paths, revision):
+        if len(paths) == 1:
+            self.database = xapian.Database(paths[0])
+        else:
+            self.database = xapian.Database()
+            for path in paths:
+                self.database.add_database(xapian.Database(path))
+        self.revision = revision
+        self.cache = {}
+    
+    def reopen(self, revision):
+        self.database.reopen()
+        self.revision = revision
+        self.cache.clear()
+
+
+class XHDatabasePool(object):
+    """
+    A pool of read-only `xapian.Database` handles shared by every
+    `SearchBackend` in the process.
+    
+    Xapian database handles are not thread-safe, so each thread keeps its own
+    handle per path.  Handles are reused across requests and are only
+    reopened when the on-disk revision appears to have changed.  The pool is
+    reset automatically in a child process after a fork.
+    
+    Wherever a path is expected, a tuple of paths may be given instead to get
+    a single handle over a sharded index.
+    """
+    def __init__(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+    
+    def get(self, path):
+        """
+        Return an open `xapian.Database` for `path`, reopening or replacing
+        the pooled handle if a writer has committed since it was last used.
+        
+        Required arguments:
+            `path` -- The path to the Xapian database
+        """
+        return self.handle(path).database
+    
+    def handle(self, path):
+        """
+        Return the `XHDatabaseHandle` for `path` in this thread, reopening or
+        replacing it if a writer has committed since it was last used.
+        
+        Required arguments:
+            `path` -- The path to the Xapian database
+        
+        A database directory that is missing, or is replaced while it is
+        being opened, is tried again for up to half a second, so that readers
+        never see the moment between the two renames of
+        `SearchBackend._replace_database`.
+        """
+        paths = self._paths(path)
+        handles = self._handles()
+        for attempt in xrange(DATABASE_REPLACED_RETRIES):
+            try:
+                revision = tuple([self.revision(path) for path in paths])
+            except OSError:
+                handles.pop(paths, None)
+                time.sleep(DATABASE_REPLACED_DELAY)
+                continue
+            try:
+                return self._handle(paths, handles, revision)
+            except xapian.DatabaseOpeningError:
+                handles.pop(paths, None)
+                if not self._replaced(paths, revision):
+                    raise
+                time.sleep(DATABASE_REPLACED_DELAY)
+        try:
+            revision = tuple([self.revision(path) for path in paths])
+        except OSError:
+            return XHDatabaseHandle(paths, None) # Raises DatabaseOpeningError
+        return self._handle(paths, handles, revision)
+    
+    def _replaced(self, paths, revision):
+        """
+        Return True if any of `paths` has gone or been replaced since
+        `revision`.
+        """
+        try:
+            return [self.revision(path)[0] for path in paths] != [marker[0] for marker in revision]
+        except OSError:
+            return True
+    
+    def _handle(self, paths, handles, revision):
+        handle = handles.get(paths)
+        if handle is None or [marker[0] for marker in handle.revision] != [marker[0] for marker in revision]:
+            # First use, or a directory has been replaced by another one.
+            handle = handles[paths] = XHDatabaseHandle(paths, revision)
+        elif handle.revision != revision or self.recent(revision):
+            # Commits within the same mtime tick are indistinguishable, so
+            # recently modified databases are always reopened.
+            handle.reopen(revision)
+        return handle
+    
+    def recent(self, revision):
+        """
+        Return True if any database in `revision`, a tuple of markers from
+        :method:`revision`, was modified less than `DATABASE_MTIME_WINDOW`
+        seconds ago, so that a later commit could leave its marker
+        unchanged.
+        """
+        modified = 0
+        for ino, mtime, files in revision:
+            modified = max([modified, mtime] + [file_mtime for name, size, file_mtime in files])
+        return time.time() - modified < DATABASE_MTIME_WINDOW
+    
+    def discard(self, path):
+        """
+        Drop the pooled handle for `path` in this thread so that the next call
+        to `get` opens a fresh one.
+        """
+        self._handles().pop(self._paths(path), None)
+    
+    def revision(self, path):
+        """
+        Return a cheap marker of the on-disk revision of the database at
+        `path`.
+        
+        Returns a tuple of the inode and modification time of the database
+        directory, and the name, size and modification time of each of the
+        `DATABASE_VERSION_FILES` in it.  Xapian commits by renaming files
+        into place, which updates the modification time of the directory
+        and replaces the version file or one of the base files of each
+        table, while replacing the directory altogether changes its inode.
+        Modification times may only have 1 second resolution, so databases
+        that :method:`recent` reports are reopened regardless.
+        """
+        stat = os.stat(path)
+        files = []
+        for name in DATABASE_VERSION_FILES:
+            try:
+                file_stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            files.append((name, file_stat.st_size, file_stat.st_mtime))
+        return (stat.st_ino, stat.st_mtime, tuple(files))
+    
+    def _paths(self, path):
+        if isinstance(path, basestring):
+            return (path,)
+        return tuple(path)
+    
+    def _handles(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._local = threading.local()
+        handles = getattr(self._local, 'handles', None)
+        if handles is None:
+            handles = self._local.handles = {}
+        return handles
+
+
+DATABASE_POOL = XHDatabasePool()
+
+
+def reopen_on_modified(method):
+    """
+    Decorator for read-only `SearchBackend` methods that reruns `method` with
+    a freshly opened database if the revision it was reading was overwritten
+    by a writer (`xapian.DatabaseModifiedError`).
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        for attempt in xrange(DATABASE_MODIFIED_RETRIES):
+            try:
+                return method(self, *args, **kwargs)
+            except xapian.DatabaseModifiedError:
+                DATABASE_POOL.discard(self._shard_paths())
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class XHLRUCache(object):
+    """
+    A thread-safe, least recently used cache bounded by both the number of
+    entries and their total size in bytes, as reported by the caller.
+    
+    `hits` and `misses` count the lookups made with `get`.
+    """
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.clear()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    @classmethod
+    def freeze(cls, value):
+        """
+        Return a hashable equivalent of `value` made from nested
+        dictionaries, lists, tuples and sets, for use in a cache key.
+        """
+        if isinstance(value, dict):
+            return tuple(sorted([(key, cls.freeze(item)) for key, item in value.iteritems()]))
+        if isinstance(value, (set, frozenset)):
+            return tuple(sorted([cls.freeze(item) for item in value]))
+        if isinstance(value, (list, tuple)):
+            return tuple([cls.freeze(item) for item in value])
+        return value
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            # Entries form a circular doubly linked list of
+            # [previous, next, key, value, size] in order of use.
+            self._root = [None, None, None, None, 0]
+            self._root[0] = self._root[1] = self._root
+            self._entries = {}
+            self.bytes = 0
+        finally:
+            self._lock.release()
+    
+    def get(self, key):
+        """
+        Return the value cached for `key` or None, marking it as the most
+        recently used.
+        """
+        self._lock.acquire()
+        try:
+            link = self._entries.get(key)
+            if link is None:
+                self.misses += 1
+                return None
+            self._unlink(link)
+            self._link(link)
+            self.hits += 1
+            return link[3]
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value, size=0):
+        """
+        Cache `value` for `key`, evicting the least recently used entries
+        until the cache is back within its bounds.
+        """
+        if self.max_entries <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(self._entries[key])
+            link = [None, None, key, value, size]
+            self._link(link)
+            self._entries[key] = link
+            self.bytes += size
+            while len(self._entries) > self.max_entries or \
+                  (self.max_bytes is not None and self.bytes > self.max_bytes):
+                self._remove(self._root[0])
+        finally:
+            self._lock.release()
+    
+    def _link(self, link):
+        first = self._root[1]
+        link[0], link[1] = self._root, first
+        first[0] = self._root[1] = link
+    
+    def _unlink(self, link):
+        link[0][1], link[1][0] = link[1], link[0]
+    
+    def _remove(self, link):
+        self._unlink(link)
+        del self._entries[link[2]]
+        self.bytes -= link[4]
+
+
+class XHCachedDocument(object):
+    """
+    A stand-in for a matching xapian.Document, holding the document ID and
+    stored data copied out of the database, so that cached results can be
+    turned back into `XHSearchResult` objects in any thread.
+    """
+    def __init__(self, identifier, data):
+        self.identifier = identifier
+        self.data = data
+    
+    def get_value(self, column):
+        if column == DOCUMENT_ID_VALUE_COLUMN:
+            return self.identifier
+        return ''
+    
+    def get_data(self):
+        return self.data
+
+
+RESULT_CACHE = None
+
+
+class XHWriteQueue(object):
+    """
+    A write-behind queue of document updates and removals for one index.
+    
+    Writes are keyed by document ID and only the latest write for each
+    document is kept.  A background thread applies the pending writes in a
+    single batch with `SearchBackend._write` whenever `max_documents` are
+    waiting, the oldest has waited `max_delay` seconds or someone is waiting
+    in :method:`flush`.  Callers that find `max_pending` writes already
+    waiting block until the thread catches up.  A batch that fails is put
+    back, behind any newer writes to the same documents, and retried after
+    `max_delay` seconds, unless the queue is stopping, when it is dropped.
+    
+    Writes are numbered in the order they are queued, and `written` is the
+    number of the last one to have been committed or dropped.  `dropped`
+    is the range `(after, through)` of the numbers of dropped writes, or
+    `(0, 0)` if none have been.
+    
+    Documents that are unchanged since they were indexed are skipped by
+    `SearchBackend._write` unless they were queued with `force`.  With
+    `record_skipped`, `skipped` maps the ID of each document skipped to the
+    number of the last write in its batch, for the caller to take with
+    :method:`pop_skipped`.
+    
+    Use `XHWriteQueue.get` to fetch the queue for an index.  Queues belong to
+    the process that created them and are drained when it exits.
+    """
+    _instances = {}
+    _lock = threading.Lock()
+    
+    def __init__(self, backend, max_documents=None, max_delay=None, max_pending=None,
+                 record_skipped=False):
+        if max_documents is None:
+            max_documents = getattr(settings, 'HAYSTACK_XAPIAN_FLUSH_DOCUMENTS', DEFAULT_FLUSH_DOCUMENTS)
+        if max_delay is None:
+            max_delay = getattr(settings, 'HAYSTACK_XAPIAN_QUEUE_SECONDS', DEFAULT_QUEUE_SECONDS)
+        self.backend = backend
+        self.max_documents = max_documents
+        self.max_delay = max_delay
+        self.max_pending = max_pending or 10 * max_documents
+        self.pid = os.getpid()
+        self.queued = 0
+        self.written = 0
+        self.dropped = (0, 0)
+        self.last_error = None
+        self.skipped = None
+        if record_skipped:
+            self.skipped = {}
+        self._pending = {}
+        self._forced = set()
+        self._oldest = None
+        self._retry_at = None
+        self._flush_target = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='xapian-write-queue')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        atexit.register(self.stop)
+    
+    def __len__(self):
+        return len(self._pending)
+    
+    @classmethod
+    def get(cls, backend, create=True):
+        """
+        Return the queue for the index of `backend`, starting one with a
+        backend of its own if there is none in this process.  With `create`
+        False, returns None instead of starting a queue.
+        """
+        key = (os.path.abspath(backend.path), backend.shards)
+        cls._lock.acquire()
+        try:
+            queue = cls._instances.get(key)
+            if queue is None or queue.pid != os.getpid() or queue._stopped:
+                if not create:
+                    return None
+                queue = cls._instances[key] = cls(SearchBackend(
+                    backend.site, backend.stemming_language,
+                    path=backend.path, shards=backend.shards
+                ))
+            return queue
+        finally:
+            cls._lock.release()
+    
+    def put(self, document_id, prepared, force=False):
+        """
+        Queue a write of `prepared`, a tuple from
+        `SearchBackend._prepare_document`, or a removal if it is None, for the
+        document `document_id`, replacing any write already waiting for it.
+        With `force`, the document is rewritten even if it is unchanged.
+        
+        Returns the number of the write.
+        """
+        self._condition.acquire()
+        try:
+            while len(self._pending) >= self.max_pending and document_id not in self._pending:
+                self._condition.wait()
+            self._pending[document_id] = prepared
+            if force:
+                self._forced.add(document_id)
+            else:
+                self._forced.discard(document_id)
+            self.queued += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            self._condition.notifyAll()
+            return self.queued
+        finally:
+            self._condition.release()
+    
+    def flush(self, timeout=None, since=0):
+        """
+        Wait until every write queued so far has been committed, or for at
+        most `timeout` seconds.
+        
+        Returns True if it has, and none of the writes numbered after
+        `since` were dropped instead.
+        """
+        if self.pid != os.getpid():
+            return False
+        self._condition.acquire()
+        try:
+            target = self.queued
+            self._flush_target = max(self._flush_target, target)
+            self._condition.notifyAll()
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.written < target:
+                if timeout is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            dropped_after, dropped_through = self.dropped
+            return not (since < dropped_through and dropped_after < target)
+        finally:
+            self._condition.release()
+    
+    def pop_skipped(self, sequences):
+        """
+        Return the IDs of the documents skipped by the writes in
+        `sequences`, a list of `(document_id, number)` tuples pairing each
+        document with the number :method:`put` returned for its write, and
+        forget that they were skipped.
+        """
+        self._condition.acquire()
+        try:
+            skipped = []
+            for document_id, sequence in sequences:
+                if self.skipped.get(document_id, 0) >= sequence:
+                    del self.skipped[document_id]
+                    skipped.append(document_id)
+            return skipped
+        finally:
+            self._condition.release()
+    
+    def stop(self):
+        """
+        Apply the pending writes and stop the background thread.  Writes
+        that still fail are dropped.
+        """
+        if self.pid != os.getpid():
+            return
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        self._thread.join()
+    
+    def _ready(self):
+        if not self._pending:
+            return False
+        if self._stopped:
+            return True
+        if self._retry_at is not None and time.time() < self._retry_at:
+            return False
+        return len(self._pending) >= self.max_documents or \
+               self.written < self._flush_target or \
+               time.time() - self._oldest >= self.max_delay
+    
+    def _timeout(self):
+        if not self._pending:
+            return None
+        wake_at = self._oldest + self.max_delay
+        if self._retry_at is not None:
+            wake_at = max(wake_at, self._retry_at)
+        return max(0, wake_at - time.time())
+    
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._ready():
+                    if self._stopped and not self._pending:
+                        return
+                    self._condition.wait(self._timeout())
+                batch = self._pending
+                forced = self._forced
+                target = self.queued
+                self._pending = {}
+                self._forced = set()
+                self._oldest = None
+                self._condition.notifyAll()
+            finally:
+                self._condition.release()
+            
+            try:
+                skipped = self.backend._write(batch.items(), forced)
+            except Exception, e:
+                self._condition.acquire()
+                try:
+                    self.last_error = e
+                    if self._stopped:
+                        sys.stderr.write('Dropped %d queued writes: %s\n' % (len(batch), e))
+                        if self.dropped[1]:
+                            self.dropped = (self.dropped[0], target)
+                        else:
+                            self.dropped = (self.written, target)
+                        self.written = target
+                    else:
+                        sys.stderr.write('Queued writes failed, retrying: %s\n' % e)
+                        for document_id, prepared in batch.iteritems():
+                            if document_id not in self._pending:
+                                self._pending[document_id] = prepared
+                                if document_id in forced:
+                                    self._forced.add(document_id)
+                        self._oldest = time.time()
+                        self._retry_at = self._oldest + self.max_delay
+                    self._condition.notifyAll()
+                finally:
+                    self._condition.release()
+                continue
+            
+            self._condition.acquire()
+            try:
+                if self.skipped is not None:
+                    for document_id in skipped:
+                        self.skipped[document_id] = target
+                self.written = target
+                self._retry_at = None
+                self._condition.notifyAll()
+            finally:
+                self._condition.release()
+
+
+class XHWriterError(Exception):
+    """
+    Raised when the index writer service could not commit a write.
+    """
+    pass
+
+
+def _send_message(sock, message):
+    """
+    Send `message` on `sock` as a pickle preceded by its length.
+    """
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _receive_message(sock):
+    """
+    Receive a message sent with `_send_message` from `sock`, or None if the
+    connection was closed first.
+    """
+    chunks = []
+    wanted = 4
+    length = None
+    while True:
+        while wanted:
+            chunk = sock.recv(min(wanted, 65536))
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            wanted -= len(chunk)
+        data = ''.join(chunks)
+        if length is not None:
+            return pickle.loads(data)
+        length = wanted = struct.unpack('!I', data)[0]
+        chunks = []
+
+
+class XHWriterServer(object):
+    """
+    A local service that owns the writable databases of an index and
+    commits the writes that `SearchBackend` sends it from other processes
+    when `HAYSTACK_XAPIAN_WRITER_SOCKET` is set.
+    
+    Clients send lists of `(document_id, prepared)` writes over the Unix
+    socket at `socket_path`.  Writes from every connection go into one
+    `XHWriteQueue`, so they are coalesced into shared commits, and each list
+    is acknowledged once it has been committed, or with an error if that
+    has not happened within `timeout` seconds or the writes were dropped
+    by a failing queue as the service stopped.  Documents that are
+    unchanged since they were indexed are skipped, unless the client asked
+    for them to be forced, and the acknowledgement lists their IDs.
+    
+    Messages are pickles, so the socket is created readable and writable
+    by its owner only.  Other operations that need the writer lock, such as
+    `clear`, must be run while the service is stopped.
+    
+    eg. XHWriterServer().serve_forever()
+    """
+    def __init__(self, socket_path=None, backend=None, timeout=None):
+        if socket_path is None:
+            socket_path = settings.HAYSTACK_XAPIAN_WRITER_SOCKET
+        if backend is None:
+            backend = SearchBackend()
+        if timeout is None:
+            timeout = getattr(settings, 'HAYSTACK_XAPIAN_WRITER_TIMEOUT', DEFAULT_WRITER_TIMEOUT)
+        self.socket_path = socket_path
+        self.backend = SearchBackend(
+            backend.site, backend.stemming_language,
+            path=backend.path, shards=backend.shards
+        )
+        self.backend.writer_socket = None
+        self.timeout = timeout
+        self.queue = None
+        self._stopped = False
+    
+    def serve_forever(self):
+        """
+        Accept connections until :method:`shutdown` is called, handling each
+        in its own thread.
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        listener.listen(128)
+        self.queue = XHWriteQueue(self.backend, record_skipped=True)
+        
+        try:
+            while not self._stopped:
+                connection, address = listener.accept()
+                if self._stopped:
+                    connection.close()
+                    break
+                thread = threading.Thread(target=self._handle, args=(connection,))
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            listener.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.queue.stop()
+    
+    def shutdown(self):
+        """
+        Stop :method:`serve_forever` after committing the pending writes.
+        """
+        self._stopped = True
+        try:
+            XHWriterClient(self.socket_path).ping()
+        except (socket.error, XHWriterError):
+            pass
+    
+    def _handle(self, connection):
+        try:
+            while True:
+                message = _receive_message(connection)
+                if message is None:
+                    break
+                writes, force = message
+                since = self.queue.queued
+                sequences = []
+                for document_id, prepared in writes:
+                    sequences.append((document_id, self.queue.put(
+                        document_id, prepared, force is True or document_id in (force or ())
+                    )))
+                if sequences:
+                    since = sequences[0][1] - 1
+                if self.queue.flush(self.timeout, since):
+                    _send_message(connection, ('ok', self.queue.pop_skipped(sequences)))
+                else:
+                    _send_message(connection, ('error', 'Writes were not committed within %s seconds, or were dropped: %s' % (
+                        self.timeout, self.queue.last_error
+                    )))
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+
+class XHWriterClient(object):
+    """
+    Sends writes to the `XHWriterServer` listening at `socket_path`.
+    """
+    def __init__(self, socket_path, timeout=None):
+        if timeout is None:
+            timeout = getattr(settings, 'HAYSTACK_XAPIAN_WRITER_TIMEOUT', DEFAULT_WRITER_TIMEOUT)
+        self.socket_path = socket_path
+        self.timeout = timeout
+    
+    def write(self, writes, force=False):
+        """
+        Send a list of `(document_id, prepared)` writes, where `prepared`
+        is None for a removal, and wait until they have been committed.
+        `force` is passed on to `SearchBackend._write`.
+        
+        Returns a list of the IDs of the documents skipped as unchanged.
+        Raises `XHWriterError` if the service could not be reached or could
+        not commit the writes.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Leave the service time to report its own timeout.
+        sock.settimeout(2 * self.timeout)
+        try:
+            try:
+                sock.connect(self.socket_path)
+                _send_message(sock, (list(writes), force))
+                reply = _receive_message(sock)
+            except socket.error, e:
+                raise XHWriterError('Could not reach the index writer at %s: %s' % (self.socket_path, e))
+        finally:
+            sock.close()
+        if reply is None:
+            raise XHWriterError('The index writer at %s closed the connection.' % self.socket_path)
+        status, detail = reply
+        if status != 'ok':
+            raise XHWriterError(detail)
+        return detail
+    
+    def ping(self):
+        """
+        Check that the service is answering.
+        """
+        return self.write([])
+
+
+# Set by `SearchBackend.parallel_update` in the parent process and inherited
+# by the forked workers, so that the index and queryset never need pickling.
+_parallel_update_state = None
+
+
+def _parallel_update_worker(args):
+    """
+    Index the objects with primary keys between `low` and `high` (inclusive)
+    into the database at `path`.  Runs in a `parallel_update` worker process.
+    """
+    path, low, high, flush_documents, flush_megabytes = args
+    parent, index, queryset = _parallel_update_state
+    backend = SearchBackend(parent.site, parent.stemming_language, path=path, shards=1)
+    # Queued writes would die with the worker, and the writer service would
+    # bypass the temporary database.
+    backend.write_behind = False
+    backend.writer_socket = None
+    return backend.update(
+        index, queryset.filter(pk__gte=low, pk__lte=high).iterator(),
+        flush_documents, flush_megabytes
+    )
+
+
+class XHSchema(object):
+    """
+    A compiled, read-only form of a schema built by `SearchBackend.build_schema`.
+    
+    It precomputes everything the indexing, query parsing and range
+    processing code would otherwise work out from the list of field
+    dictionaries each time:
+        `indexed` -- A tuple of `(field_name, prefix, column)` for each field
+        `prefixes` -- A dictionary mapping field names to term prefixes
+        `columns` -- A dictionary mapping field names to value columns
+        `types` -- A dictionary mapping field names to schema types
+        `exact` -- A set of the fields indexed as boolean terms
+        `multi_valued` -- A set of the fields that hold a list of values
+        `facet_columns` -- A dictionary mapping multi-valued exact fields to
+                           the first of their facet value columns
+        `date_range_re` -- A regular expression matching ranges on date
+                           fields in a query string, or None
+        `serialisers` -- A dictionary mapping field names to the function
+                         that converts their values for the value column
+        `value_encoding` -- The version of the encoding of the value columns
+    
+    Instances are shared between threads and must not be modified.  Use
+    `XHSchema.get` to fetch the instance for a schema fingerprint.
+    """
+    RANGE_MIN = {
+        'text': u'a', # TODO: A better way of getting a min text value?
+        'long': -sys.maxint - 1,
+        'float': float('-inf'),
+        'date': u'00010101000000',
+        'datetime': u'00010101000000',
+    }
+    
+    RANGE_MAX = {
+        'text': u'z' * 100, # TODO: A better way of getting a max text value?
+        'long': sys.maxint,
+        'float': float('inf'),
+        'date': u'99990101000000',
+        'datetime': u'99990101000000',
+    }
+    
+    RANGE_TYPES = {
+        'long': long,
+        'float': float,
+    }
+    
+    NUMBER_TYPES = ('long', 'float', 'date', 'datetime')
+    
+    _instances = {}
+    _lock = threading.Lock()
+    
+    def __init__(self, content_field_name, fields, fingerprint, value_encoding=VALUE_ENCODING):
+        self.content_field_name = content_field_name
+        self.fields = fields
+        self.fingerprint = fingerprint
+        self.value_encoding = value_encoding
+        self.indexed = tuple([
+            (
+                field_dict['field_name'],
+                DOCUMENT_CUSTOM_TERM_PREFIX + field_dict['field_name'].upper(),
+                field_dict['column'],
+            ) for field_dict in fields
+        ])
+        self.prefixes = dict([(name, prefix) for name, prefix, column in self.indexed])
+        self.columns = dict([(name, column) for name, prefix, column in self.indexed])
+        self.types = dict([(field_dict['field_name'], field_dict['type']) for field_dict in fields])
+        self.exact = frozenset([
+            field_dict['field_name'] for field_dict in fields
+            if field_dict.get('exact') == 'true'
+        ])
+        dates = [
+            re.escape(field_dict['field_name']) for field_dict in fields
+            if field_dict['type'] in ('date', 'datetime')
+        ]
+        self.date_range_re = None
+        if dates:
+            self.date_range_re = re.compile(
+                r'(?<![\w:])(%s):(\d*)\.\.(?:\1:)?(\d*)(?=[\s)]|$)' % '|'.join(dates)
+            )
+        self.multi_valued = frozenset([
+            field_dict['field_name'] for field_dict in fields
+            if field_dict.get('multi_valued') == 'true'
+        ])
+        self.facet_columns = dict([
+            (name, FACET_VALUE_COLUMN_BASE + column * FACET_VALUE_COLUMNS)
+            for name, prefix, column in self.indexed
+            if name in self.exact and name in self.multi_valued
+        ])
+        if value_encoding < VALUE_ENCODING:
+            serialise = lambda value: XHSchema.serialise(value, value_encoding)
+            self.serialisers = dict([(name, serialise) for name in self.types])
+        else:
+            self.serialisers = dict([
+                (name, getattr(self, 'serialise_' + field_type, self.serialise))
+                for name, field_type in self.types.iteritems()
+            ])
+    
+    @classmethod
+    def get(cls, content_field_name, fields, fingerprint, value_encoding=VALUE_ENCODING):
+        """
+        Return the shared `XHSchema` for `fingerprint` and `value_encoding`,
+        compiling it from `content_field_name` and `fields` the first time it
+        is seen.
+        """
+        key = (fingerprint, value_encoding)
+        schema = cls._instances.get(key)
+        if schema is None:
+            cls._lock.acquire()
+            try:
+                schema = cls._instances.setdefault(
+                    key, cls(content_field_name, fields, fingerprint, value_encoding)
+                )
+            finally:
+                cls._lock.release()
+        return schema
+    
+    @staticmethod
+    def marshal(value):
+        """
+        Convert a Python value to a string for Xapian values, as indexes
+        written before `VALUE_ENCODING` 2 store them and query strings
+        write them.
+        """
+        if isinstance(value, datetime.datetime):
+            if value.microsecond:
+                value = u'%04d%02d%02d%02d%02d%02d%06d' % (
+                    value.year, value.month, value.day, value.hour,
+                    value.minute, value.second, value.microsecond
+                )
+            else:
+                value = u'%04d%02d%02d%02d%02d%02d' % (
+                    value.year, value.month, value.day, value.hour,
+                    value.minute, value.second
+                )
+        elif isinstance(value, datetime.date):
+            value = u'%04d%02d%02d000000' % (value.year, value.month, value.day)
+        elif isinstance(value, bool):
+            if value:
+                value = u't'
+            else:
+                value = u'f'
+        elif isinstance(value, float):
+            value = xapian.sortable_serialise(value)
+        elif isinstance(value, (int, long)):
+            value = u'%012d' % value
+        else:
+            value = force_unicode(value)
+        return value
+    
+    @staticmethod
+    def date_number(value):
+        """
+        Return the date or datetime `value` as the number YYYYMMDDHHMMSS,
+        without microseconds.
+        """
+        number = value.year * 10000000000 + value.month * 100000000 + value.day * 1000000
+        if isinstance(value, datetime.datetime):
+            number += value.hour * 10000 + value.minute * 100 + value.second
+        return number
+    
+    @classmethod
+    def serialise(cls, value, value_encoding=VALUE_ENCODING):
+        """
+        Convert a Python value of any type to the string stored in its value
+        column.
+        
+        Integers, floats and dates are stored with `xapian.sortable_serialise`
+        so that they sort and compare correctly as strings, including
+        negative numbers.  Dates are stored as the number YYYYMMDDHHMMSS,
+        without microseconds.  Indexes in an older value encoding store the
+        output of `marshal`.
+        
+        None gives an empty string, which Xapian treats as no value, so
+        null fields are never inside a value range.
+        """
+        if value is None:
+            return u''
+        if value_encoding < VALUE_ENCODING:
+            return cls.marshal(value)
+        if isinstance(value, datetime.date):
+            return xapian.sortable_serialise(cls.date_number(value))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            return xapian.sortable_serialise(value)
+        return cls.marshal(value)
+    
+    # The serialisers for each field type check for the type the field
+    # normally holds and leave any other value to `serialise`.
+    
+    @classmethod
+    def serialise_text(cls, value):
+        if type(value) is unicode:
+            return value
+        return cls.serialise(value)
+    
+    @classmethod
+    def serialise_long(cls, value):
+        if type(value) in (int, long):
+            return xapian.sortable_serialise(value)
+        return cls.serialise(value)
+    
+    @classmethod
+    def serialise_float(cls, value):
+        if type(value) is float:
+            return xapian.sortable_serialise(value)
+        return cls.serialise(value)
+    
+    @classmethod
+    def serialise_date(cls, value):
+        if type(value) in (datetime.datetime, datetime.date):
+            return xapian.sortable_serialise(cls.date_number(value))
+        return cls.serialise(value)
+    
+    @classmethod
+    def serialise_boolean(cls, value):
+        if value is True:
+            return u't'
+        if value is False:
+            return u'f'
+        return cls.serialise(value)
+    
+    def column(self, field_name):
+        """
+        Return the value column for `field_name`, or the document ID column
+        for `id` and any field not in the schema.
+        """
+        return self.columns.get(field_name, DOCUMENT_ID_VALUE_COLUMN)
+    
+    def boolean_term(self, field_name, value):
+        """
+        Return the boolean term for `value` in the exact field `field_name`.
+        
+        As in Xapian's query parser, a colon separates the prefix from
+        values that start with a capital letter.
+        """
+        value = smart_str(force_unicode(value))
+        if value[:1].isupper():
+            return self.prefixes[field_name] + ':' + value
+        return self.prefixes[field_name] + value
+    
+    def facet_values(self, field_name, value):
+        """
+        Return a list of `(column, value)` tuples for the distinct values in
+        the list `value` of the multi-valued exact field `field_name`, in
+        value order and one to a facet value column, so that each can be
+        counted by a xapian.ValueCountMatchSpy.
+        """
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        values = sorted(set([smart_str(force_unicode(item)) for item in value if item is not None]))
+        values = [item for item in values if item][:FACET_VALUE_COLUMNS]
+        first = self.facet_columns[field_name]
+        return [(first + offset, item) for offset, item in enumerate(values)]
+    
+    def pad_date_ranges(self, query_string):
+        """
+        Return `query_string` with the bounds of ranges on date fields,
+        such as the YYYYMMDD dates older query strings used, padded with
+        zeros to the 14 digits of the number YYYYMMDDHHMMSS stored in
+        their value columns.
+        """
+        if self.date_range_re is None:
+            return query_string
+        def pad(match):
+            field_name, begin, end = match.groups()
+            return u'%s:%s..%s' % (field_name, begin and begin.ljust(14, '0'), end and end.ljust(14, '0'))
+        return self.date_range_re.sub(pad, query_string)
+    
+    def query_parser(self, database, stemmer):
+        """
+        Return a new xapian.QueryParser for `database` with stemming and a
+        prefix for each field in the schema.  Exact fields have boolean
+        prefixes, so the parser filters on them without adding weight.
+        """
+        qp = xapian.QueryParser()
+        qp.set_database(database)
+        qp.set_stemmer(stemmer)
+        qp.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
+        qp.add_boolean_prefix('django_ct', DOCUMENT_CT_TERM_PREFIX)
+        for name, prefix, column in self.indexed:
+            if name in self.exact:
+                qp.add_boolean_prefix(name, prefix)
+            else:
+                qp.add_prefix(name, prefix)
+        return qp
+    
+    def range_processors(self, sb):
+        """
+        Return a list of xapian.ValueRangeProcessor for the fields in the
+        schema.
+        
+        Indexes in the current value encoding use Xapian's own number and
+        string range processors, one per field and prefixed with the field
+        name, so ranges are handled without calling back into Python.  Older
+        indexes use `XHValueRangeProcessor`.
+        """
+        if self.value_encoding < VALUE_ENCODING:
+            return [XHValueRangeProcessor(sb, self)]
+        processors = []
+        for name, prefix, column in self.indexed:
+            if self.types[name] in self.NUMBER_TYPES:
+                processor = xapian.NumberValueRangeProcessor(column, name + ':', True)
+            else:
+                processor = xapian.StringValueRangeProcessor(column, name + ':', True)
+            processors.append(processor)
+        return processors
+
+
+class XHValueRangeProcessor(xapian.ValueRangeProcessor):
+    """
+    A value range processor for indexes written before `VALUE_ENCODING` 2.
+    """
+    def __init__(self, sb, schema):
+        self.sb = sb
+        self.schema = schema
+        xapian.ValueRangeProcessor.__init__(self)
+    
+    def __call__(self, begin, end):
+        """
+        Construct a tuple for value range processing.
+        
+        `begin` -- a string in the format '<field_name>:[low_range]'
+                   If 'low_range' is omitted, assume the smallest possible value.
+        `end` -- a string in the the format '[high_range|*]'.  If '*', assume
+                 the highest possible value.
+        
+        Return a tuple of three strings: (column, low, high)
+        """
+        colon = begin.find(':')
+        field_name = begin[:colon]
+        begin = begin[colon + 1:len(begin)]
+        field_type = self.schema.types.get(field_name)
+        if field_type is not None:
+            if not begin:
+                begin = XHSchema.RANGE_MIN.get(field_type, begin)
+            if end == '*':
+                end = XHSchema.RANGE_MAX.get(field_type, end)
+            if field_type in XHSchema.RANGE_TYPES:
+                convert = XHSchema.RANGE_TYPES[field_type]
+                begin = self.sb._marshal_value(convert(begin))
+                end = self.sb._marshal_value(convert(end))
+            return self.schema.columns[field_name], str(begin), str(end)
+
+
+class XHExpandDecider(xapian.ExpandDecider):
+    def __call__(self, term):
+        """
+        Return True if the term should be used for expanding the search
+        query, False otherwise.
+        
+        Currently, we only want to ignore terms beginning with `DOCUMENT_CT_TERM_PREFIX`
+        """
+        if term.startswith(DOCUMENT_CT_TERM_PREFIX):
+            return False
+        return True
+
+
+class XHHighlighter(object):
+    """
+    Highlights the terms of a parsed query in document content.
+    
+    The terms are taken from the xapian.Query once, when the highlighter is
+    created, and each document is scanned a single time.  A word is
+    highlighted when it is one of the query's terms or its stem is one of
+    the query's stemmed terms, so a search for `index` highlights `Indexed`.
+    
+    Only the parts of the content around the matches are returned: up to
+    `snippets` windows of about `characters` characters each.
+    """
+    WORD_RE = re.compile(r'\w+', re.UNICODE)
+    PREFIX_RE = re.compile(r'^(?:X[^a-z0-9]*|[A-Z])?:?')
+    MAX_CACHED_WORDS = 10000
+    
+    def __init__(self, query, stemmer, tag='em', characters=None, snippets=None):
+        """
+        Required arguments:
+            `query` -- The parsed xapian.Query
+            `stemmer` -- The xapian.Stem used to parse `query`
+        
+        Optional arguments:
+            `tag` -- The html tag to wrap matches in (default = 'em')
+            `characters` -- The length of each snippet (default =
+                            `HAYSTACK_XAPIAN_HIGHLIGHT_CHARACTERS` or 200)
+            `snippets` -- The most snippets to return (default =
+                          `HAYSTACK_XAPIAN_HIGHLIGHT_SNIPPETS` or 3)
+        """
+        if characters is None:
+            characters = getattr(settings, 'HAYSTACK_XAPIAN_HIGHLIGHT_CHARACTERS', DEFAULT_HIGHLIGHT_CHARACTERS)
+        if snippets is None:
+            snippets = getattr(settings, 'HAYSTACK_XAPIAN_HIGHLIGHT_SNIPPETS', DEFAULT_HIGHLIGHT_SNIPPETS)
+        self.stemmer = stemmer
+        self.open_tag = '<%s>' % tag
+        self.close_tag = '</%s>' % tag
+        self.characters = max(1, characters)
+        self.snippets = max(1, snippets)
+        self.words = set()
+        self.stems = set()
+        self._matches = {}
+        
+        for term in query:
+            if term.startswith(DOCUMENT_ID_TERM_PREFIX) or term.startswith(DOCUMENT_CT_TERM_PREFIX):
+                continue
+            if term.startswith('Z'):
+                self.stems.add(self.PREFIX_RE.sub('', term[1:]))
+            else:
+                self.words.add(self.PREFIX_RE.sub('', term))
+        self.words.discard('')
+        self.stems.discard('')
+    
+    def __nonzero__(self):
+        return bool(self.words or self.stems)
+    
+    def matches(self, word):
+        """
+        Return True if `word` (a unicode string) should be highlighted.
+        """
+        key = word.lower().encode('utf-8')
+        matched = self._matches.get(key)
+        if matched is None:
+            matched = key in self.words or (bool(self.stems) and self.stemmer(key) in self.stems)
+            if len(self._matches) >= self.MAX_CACHED_WORDS:
+                self._matches.clear()
+            self._matches[key] = matched
+        return matched
+    
+    def highlight(self, content):
+        """
+        Return the snippets of `content` around the matching words, with
+        each match wrapped in the highlighter's tag.
+        
+        Snippets are separated by ` ... `, and the result starts or ends
+        with `...` when content before the first or after the last snippet
+        was left out.  A window that would start where the previous one
+        ends is merged into it, so ` ... ` always marks omitted content.
+        Content without a match gives its first snippet.
+        """
+        if content is None:
+            return content
+        content = force_unicode(content)
+        length = len(content)
+        windows = []
+        used = 0
+        
+        if self:
+            for match in self.WORD_RE.finditer(content):
+                start, end = match.span()
+                in_window = windows and start < windows[-1][1]
+                if not in_window and used == self.snippets:
+                    break
+                if not self.matches(match.group()):
+                    continue
+                if in_window:
+                    windows[-1][1] = max(windows[-1][1], end)
+                    windows[-1][2].append((start, end))
+                    continue
+                used += 1
+                window_start = max(windows and windows[-1][1] or 0, start - self.characters // 4)
+                if windows and window_start == windows[-1][1]:
+                    # The window would start where the last one ends, so
+                    # the last one is extended instead of leaving a gap.
+                    windows[-1][1] = max(end, window_start + self.characters)
+                    windows[-1][2].append((start, end))
+                    continue
+                if window_start > 0:
+                    space = content.find(' ', window_start, start)
+                    if space != -1:
+                        window_start = space + 1
+                windows.append([window_start, max(end, window_start + self.characters), [(start, end)]])
+        
+        if not windows:
+            windows = [[0, self.characters, []]]
+        
+        snippets = []
+        for window_start, window_end, spans in windows:
+            window_end = min(window_end, length)
+            if window_end < length:
+                space = content.rfind(' ', spans and spans[-1][1] or window_start, window_end)
+                if space != -1:
+                    window_end = space
+            pieces = []
+            position = window_start
+            for start, end in spans:
+                pieces.append(content[position:start])
+                pieces.append(self.open_tag + content[start:end] + self.close_tag)
+                position = end
+            pieces.append(content[position:window_end])
+            snippets.append((window_start, window_end, ''.join(pieces)))
+        
+        text = ' ... '.join([snippet for window_start, window_end, snippet in snippets])
+        if snippets[0][0] > 0:
+            text = '... ' + text
+        if snippets[-1][1] < length:
+            text = text + ' ...'
+        return text
+
 
-class XHValueRangeProcessor(xapian.ValueRangeProcessor):
-    def __init__(self, sb):
-        self.sb = sb
-        xapian.ValueRangeProcessor.__init__(self)
+class XHDocumentData(object):
+    """
+    The format of the data stored with each document.
     
-    def __call__(self, begin, end):
+    Documents are stored as `MAGIC` followed by a marshalled tuple of
+    `(app_label, module_name, pk, fields)`.  Values that marshal can store
+    exactly, such as strings, numbers and lists of them, are stored as they
+    are.  Naive dates and datetimes are stored as `('d', state)` or
+    `('t', state)` tuples of their pickled state, and anything else as a
+    `('p', pickle)` tuple, or `('z', compressed pickle)` when the value is at
+    least `compress_threshold` long.  Stored this way a document is no
+    larger than a pickle of it, and decoding a field never unpickles more
+    than that field.
+    
+    Data written by older versions of the backend, a plain pickle of
+    `(app_label, module_name, pk, model_data)` or `MAGIC_V1` followed by
+    flagged pickles of each value, can still be decoded.
+    """
+    MAGIC = 'XH\x02'
+    MAGIC_V1 = 'XH\x01'
+    MARSHAL_TYPES = (type(None), bool, int, long, float, str, unicode)
+    
+    @classmethod
+    def encode(cls, app_label, module_name, pk, model_data, compress_threshold=None):
         """
-        Construct a tuple for value range processing.
+        Encode a document.  Strings at least `compress_threshold` characters
+        long, and other values whose pickles are at least that many bytes
+        long, are compressed.
+        """
+        return cls.MAGIC + marshal.dumps((
+            app_label, module_name, cls.encode_value(pk),
+            dict([
+                (key, cls.encode_value(value, compress_threshold))
+                for key, value in model_data.iteritems()
+            ]),
+        ))
+    
+    @classmethod
+    def encode_value(cls, value, compress_threshold=None):
+        value_type = type(value)
+        if value_type in cls.MARSHAL_TYPES:
+            if compress_threshold and value_type in (str, unicode) and len(value) >= compress_threshold:
+                return ('z', zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+            return value
+        if value_type is datetime.datetime and value.tzinfo is None:
+            return ('t', value.__reduce__()[1][0])
+        if value_type is datetime.date:
+            return ('d', value.__reduce__()[1][0])
+        if value_type in (list, dict):
+            try:
+                marshal.dumps(value)
+                return value
+            except ValueError:
+                pass
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if compress_threshold and len(data) >= compress_threshold:
+            return ('z', zlib.compress(data))
+        return ('p', data)
+    
+    @classmethod
+    def decode_value(cls, encoded, version=2):
+        """
+        Decode a value encoded by `encode_value`, or by version 1 of the
+        format if `version` is 1.
+        """
+        if version == 1:
+            if encoded[0] == 'z':
+                return pickle.loads(zlib.decompress(encoded[1:]))
+            return pickle.loads(encoded[1:])
+        if type(encoded) is not tuple:
+            return encoded
+        flag, data = encoded
+        if flag == 'z':
+            return pickle.loads(zlib.decompress(data))
+        if flag == 't':
+            return datetime.datetime(data)
+        if flag == 'd':
+            return datetime.date(data)
+        return pickle.loads(data)
+    
+    @classmethod
+    def split(cls, data):
+        """
+        Split encoded document data without decoding any of the fields.
         
-        `begin` -- a string in the format '<field_name>:[low_range]'
-                   If 'low_range' is omitted, assume the smallest possible value.
-        `end` -- a string in the the format '[high_range|*]'.  If '*', assume
-                 the highest possible value.
+        Returns a tuple of `(app_label, module_name, pk, fields, encoded)`.
+        `encoded` is the version of the format, which the values in `fields`
+        still need to be passed to `decode_value` with, or 0 if the data was
+        a plain pickle and they are already decoded.
+        """
+        if data.startswith(cls.MAGIC):
+            app_label, module_name, pk, fields = marshal.loads(data[len(cls.MAGIC):])
+            return app_label, module_name, cls.decode_value(pk), fields, 2
+        if data.startswith(cls.MAGIC_V1):
+            app_label, module_name, pk, fields = marshal.loads(data[len(cls.MAGIC_V1):])
+            return app_label, module_name, cls.decode_value(pk, 1), fields, 1
+        app_label, module_name, pk, model_data = pickle.loads(data)
+        return app_label, module_name, pk, model_data, 0
+    
+    @classmethod
+    def decode(cls, data, fields=None):
+        """
+        Decode document data, optionally limited to the field names in
+        `fields`.
         
-        Return a tuple of three strings: (column, low, high)
+        Returns a tuple of `(app_label, module_name, pk, model_data)`.
         """
-        colon = begin.find(':')
-        field_name = begin[:colon]
-        begin = begin[colon + 1:len(begin)]
-        for field_dict in self.sb.schema:
-            if field_dict['field_name'] == field_name:
-                if not begin:
-                    if field_dict['type'] == 'text':
-                        begin = u'a' # TODO: A better way of getting a min text value?
-                    elif field_dict['type'] == 'long':
-                        begin = -sys.maxint - 1
-                    elif field_dict['type'] == 'float':
-                        begin = float('-inf')
-                    elif field_dict['type'] == 'date' or field_dict['type'] == 'datetime':
-                        begin = u'00010101000000'
-                elif end == '*':
-                    if field_dict['type'] == 'text':
-                        end = u'z' * 100 # TODO: A better way of getting a max text value?
-                    elif field_dict['type'] == 'long':
-                        end = sys.maxint
-                    elif field_dict['type'] == 'float':
-                        end = float('inf')
-                    elif field_dict['type'] == 'date' or field_dict['type'] == 'datetime':
-                        end = u'99990101000000'
-                if field_dict['type'] == 'float':
-                    begin = self.sb._marshal_value(float(begin))
-                    end = self.sb._marshal_value(float(end))
-                elif field_dict['type'] == 'long':
-                    begin = self.sb._marshal_value(long(begin))
-                    end = self.sb._marshal_value(long(end))
-                return field_dict['column'], str(begin), str(end)
+        app_label, module_name, pk, stored, encoded = cls.split(data)
+        model_data = {}
+        for key, value in stored.iteritems():
+            if fields is None or key in fields:
+                if encoded:
+                    value = cls.decode_value(value, encoded)
+                model_data[key] = value
+        return app_label, module_name, pk, model_data
 
 
-class XHExpandDecider(xapian.ExpandDecider):
-    def __call__(self, term):
+class XHSearchResult(SearchResult):
+    """
+    A `SearchResult` that is built from a matching xapian.Document without
+    decoding its stored data.
+    
+    `app_label`, `model_name` and `pk` are read from the document ID value
+    column, and `score` from the match weight.  The stored data is only
+    fetched the first time any other attribute is accessed, and each stored
+    field is only decoded when it is accessed itself.
+    
+    Indexes with an older value encoding keep a field in the ID column, so
+    their stored data is fetched straight away instead.
+    """
+    def __init__(self, backend, document, score, highlight=None, fields=None):
         """
-        Return True if the term should be used for expanding the search
-        query, False otherwise.
+        Required arguments:
+            `backend` -- The `SearchBackend` that produced the match
+            `document` -- The matching xapian.Document
+            `score` -- The match weight
         
-        Currently, we only want to ignore terms beginning with `DOCUMENT_CT_TERM_PREFIX`
+        Optional arguments:
+            `highlight` -- A callable that is given the value of the content
+                           field and returns the value of `highlighted`
+                           (default = None)
+            `fields` -- The names of the stored fields to expose, or None for
+                        all of them (default = None)
         """
-        if term.startswith(DOCUMENT_CT_TERM_PREFIX):
-            return False
-        return True
+        identifier = None
+        if backend.schema_plan.value_encoding >= VALUE_ENCODING:
+            identifier = document.get_value(DOCUMENT_ID_VALUE_COLUMN)
+        self.__dict__['_xh_pending'] = (backend, document)
+        self.__dict__['_xh_identifier'] = identifier
+        self.__dict__['_xh_highlight'] = highlight
+        self.__dict__['_xh_fields'] = fields
+        
+        if identifier:
+            app_label, module_name, pk = identifier.split('.', 2)
+            model = get_model(app_label, module_name)
+            if model is not None:
+                pk = model._meta.pk.to_python(pk)
+        else:
+            # Older indexes keep a field in the ID column.
+            app_label, module_name, pk = self._xh_fetch()
+        SearchResult.__init__(self, app_label, module_name, pk, score)
+    
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        if '_xh_pending' in self.__dict__:
+            self._xh_fetch()
+        if attr in self._xh_stored:
+            self.__dict__[attr] = XHDocumentData.decode_value(self._xh_stored.pop(attr), self._xh_encoded)
+        elif attr == 'highlighted' and self._xh_highlight is not None:
+            self.__dict__[attr] = self._xh_highlight(self._xh_content())
+        return self.__dict__.get(attr, None)
+    
+    def __getstate__(self):
+        if '_xh_pending' in self.__dict__:
+            self._xh_fetch()
+        for attr in self._xh_stored.keys():
+            getattr(self, attr)
+        if self._xh_highlight is not None:
+            getattr(self, 'highlighted')
+        state = self.__dict__.copy()
+        state['_xh_highlight'] = None
+        return state
+    
+    def _xh_fetch(self):
+        """
+        Fetch and split the stored data, returning `(app_label, module_name, pk)`.
+        """
+        backend, document = self.__dict__.pop('_xh_pending')
+        try:
+            data = document.get_data()
+        except (xapian.DatabaseModifiedError, xapian.DocNotFoundError):
+            identifier = self.__dict__['_xh_identifier']
+            if not identifier:
+                raise
+            data = backend._document_data(DOCUMENT_ID_TERM_PREFIX + identifier)
+        
+        app_label, module_name, pk, stored, encoded = XHDocumentData.split(data)
+        self.__dict__['_xh_encoded'] = encoded
+        fields = self.__dict__['_xh_fields']
+        content_field_name = backend.content_field_name
+        self.__dict__['_xh_content_field'] = content_field_name
+        self.__dict__['_xh_stored'] = {}
+        
+        for key, value in stored.iteritems():
+            if key == content_field_name and self._xh_highlight is not None:
+                self.__dict__['_xh_content'] = (value, encoded)
+            if (fields is None or key in fields) and key not in self.__dict__:
+                if encoded:
+                    self._xh_stored[key] = value
+                else:
+                    self.__dict__[key] = value
+        
+        return app_label, module_name, pk
+    
+    def _xh_content(self):
+        content, encoded = self.__dict__.get('_xh_content', (None, 0))
+        if encoded:
+            return XHDocumentData.decode_value(content, encoded)
+        return content
 
 
 class SearchBackend(BaseSearchBackend):
@@ -136,30 +1616,49 @@ class SearchBackend(BaseSearchBackend):
         '[', ']', '^', '"', '~', '*', '?', ':',
     )
     
-    def __init__(self, site=None, stemming_language='english'):
+    def __init__(self, site=None, stemming_language='english', path=None, shards=None):
         """
         Instantiates an instance of `SearchBackend`.
         
         Optional arguments:
             `site` -- The site to associate the backend with (default = None)
             `stemming_language` -- The stemming language (default = 'english')
+            `path` -- The location of the index (default =
+                      `HAYSTACK_XAPIAN_PATH`)
+            `shards` -- The number of shards to split the index into
+                        (default = `HAYSTACK_XAPIAN_SHARDS` or 1)
         
         Also sets the stemming language to be used to `stemming_language`.
+        
+        When there is more than one shard, each shard is a separate Xapian
+        database in a `shard<n>` directory under `path`.  Documents are
+        assigned to shards by a hash of their identifier and searches run
+        over all of the shards at once.
         """
         super(SearchBackend, self).__init__(site)
         
-        if not hasattr(settings, 'HAYSTACK_XAPIAN_PATH'):
-            raise ImproperlyConfigured('You must specify a HAYSTACK_XAPIAN_PATH in your settings.')
+        if path is None:
+            if not hasattr(settings, 'HAYSTACK_XAPIAN_PATH'):
+                raise ImproperlyConfigured('You must specify a HAYSTACK_XAPIAN_PATH in your settings.')
+            path = settings.HAYSTACK_XAPIAN_PATH
+        self.path = path
         
-        if not os.path.exists(settings.HAYSTACK_XAPIAN_PATH):
-            os.makedirs(settings.HAYSTACK_XAPIAN_PATH)
+        if shards is None:
+            shards = getattr(settings, 'HAYSTACK_XAPIAN_SHARDS', 1)
+        self.shards = shards
         
+        for shard_path in self._shard_paths():
+            self._create_database(shard_path)
+        
+        self.stemming_language = stemming_language
         self.stemmer = xapian.Stem(stemming_language)
+        self.write_behind = getattr(settings, 'HAYSTACK_XAPIAN_WRITE_BEHIND', False)
+        self.writer_socket = getattr(settings, 'HAYSTACK_XAPIAN_WRITER_SOCKET', None)
     
     def get_identifier(self, obj_or_string):
         return DOCUMENT_ID_TERM_PREFIX + super(SearchBackend, self).get_identifier(obj_or_string)
     
-    def update(self, index, iterable):
+    def update(self, index, iterable, flush_documents=None, flush_megabytes=None, force=False):
         """
         Updates the `index` with any objects in `iterable` by adding/updating
         the database as needed.
@@ -168,6 +1667,16 @@ class SearchBackend(BaseSearchBackend):
             `index` -- The `SearchIndex` to process
             `iterable` -- An iterable of model instances to index
         
+        Optional arguments:
+            `flush_documents` -- Commit after this many documents
+                                 (default = `HAYSTACK_XAPIAN_FLUSH_DOCUMENTS`
+                                 or 1,000)
+            `flush_megabytes` -- Commit after roughly this many megabytes of
+                                 document data (default =
+                                 `HAYSTACK_XAPIAN_FLUSH_MEGABYTES` or 16)
+            `force` -- Rewrite documents even if they are unchanged
+                       (default = False)
+        
         For each object in `iterable`, a document is created containing all
         of the terms extracted from `index.prepare(obj)` with stemming prefixes,
         field prefixes, and 'as-is'.
@@ -187,45 +1696,833 @@ class SearchBackend(BaseSearchBackend):
         This is useful for querying for a specific document corresponding to
         a model instance.
         
-        The document also contains a pickled version of the object itself and
-        the document ID in the document data field.
+        The document also contains an encoded version of the object itself
+        and the document ID in the document data field (see `XHDocumentData`).
         
         Finally, we also store field values to be used for sorting data.  We
-        store these in the document value slots (position zero is reserver
-        for the document ID).  All values are stored as unicode strings with
-        conversion of float, int, double, values being done by Xapian itself
-        through the use of the :method:xapian.sortable_serialise method.
+        store these in the document value slots (position zero is reserved
+        for the document ID in the format `<app_name>.<model_name>.<pk>`).
+        All values are stored as unicode strings with conversion of float,
+        int, double, values being done by Xapian itself through the use of
+        the :method:xapian.sortable_serialise method.
+        
+        Documents are written in transactions which are committed whenever
+        `flush_documents` documents or `flush_megabytes` megabytes have been
+        written, and once more at the end.  On a sharded index each shard has
+        its own transaction and they are committed together.
+        
+        Each document stores a digest of its prepared data and of the schema
+        in `DOCUMENT_DIGEST_VALUE_COLUMN`.  Unless `force` is set, an object
+        whose digest matches the indexed document is skipped without
+        building or writing a new document.
+        
+        If `HAYSTACK_XAPIAN_WRITE_BEHIND` is set, the documents are only
+        prepared and handed to the index's `XHWriteQueue`, which commits them
+        in the background.  If `HAYSTACK_XAPIAN_WRITER_SOCKET` is set, they
+        are prepared and sent to the `XHWriterServer` in batches of
+        `flush_documents`, each of which is committed before the next is
+        sent.  Either way the digests are compared when the documents are
+        written.
+        
+        Returns a dictionary with the following keys:
+            `documents` -- The number of documents committed, skipped or
+                           queued
+            `written` -- The number of documents committed (always 0 with
+                         `HAYSTACK_XAPIAN_WRITE_BEHIND`)
+            `skipped` -- The number of unchanged documents skipped (always
+                         0 with `HAYSTACK_XAPIAN_WRITE_BEHIND`)
+            `seconds` -- The time taken
+            `rate` -- The number of documents processed per second
         """
-        database = self._database(writable=True)
+        if self.write_behind:
+            started = time.time()
+            queue = XHWriteQueue.get(self)
+            documents = 0
+            for obj in iterable:
+                prepared = self._prepare_document(index, obj)
+                queue.put(prepared[0], prepared, force)
+                documents += 1
+            seconds = time.time() - started
+            return {
+                'documents': documents,
+                'written': 0,
+                'skipped': 0,
+                'seconds': seconds,
+                'rate': seconds and documents / seconds or float(documents),
+            }
+        
+        if flush_documents is None:
+            flush_documents = getattr(settings, 'HAYSTACK_XAPIAN_FLUSH_DOCUMENTS', DEFAULT_FLUSH_DOCUMENTS)
+        if flush_megabytes is None:
+            flush_megabytes = getattr(settings, 'HAYSTACK_XAPIAN_FLUSH_MEGABYTES', DEFAULT_FLUSH_MEGABYTES)
+        flush_bytes = flush_megabytes * 1024 * 1024
+        
+        started = time.time()
+        committed = skipped = pending = pending_bytes = 0
+        
+        if self.writer_socket:
+            writes = []
+            for obj in iterable:
+                prepared = self._prepare_document(index, obj)
+                writes.append((prepared[0], prepared))
+                if len(writes) >= flush_documents:
+                    skipped += len(self._write(writes, force))
+                    committed += len(writes)
+                    writes = []
+            if writes:
+                skipped += len(self._write(writes, force))
+                committed += len(writes)
+            committed -= skipped
+            documents = committed + skipped
+            seconds = time.time() - started
+            return {
+                'documents': documents,
+                'written': committed,
+                'skipped': skipped,
+                'seconds': seconds,
+                'rate': seconds and documents / seconds or float(documents),
+            }
+        
+        databases = self._writable_databases()
+        for database in databases:
+            database.begin_transaction()
         try:
             for obj in iterable:
-                document = xapian.Document()
-                term_generator = self._term_generator(database, document)
-                document_id = self.get_identifier(obj)
-                model_data = index.prepare(obj)
-                
-                for field in self.schema:
-                    if field['field_name'] in model_data.keys():
-                        prefix = DOCUMENT_CUSTOM_TERM_PREFIX + field['field_name'].upper()
-                        value = model_data[field['field_name']]
-                        term_generator.index_text(force_unicode(value))
-                        term_generator.index_text(force_unicode(value), 1, prefix)
-                        document.add_value(field['column'], self._marshal_value(value))
-                
-                document.set_data(pickle.dumps(
-                    (obj._meta.app_label, obj._meta.module_name, obj.pk, model_data),
-                    pickle.HIGHEST_PROTOCOL
-                ))
-                document.add_term(document_id)
-                document.add_term(
-                    DOCUMENT_CT_TERM_PREFIX + u'%s.%s' %
-                    (obj._meta.app_label, obj._meta.module_name)
-                )
+                prepared = self._prepare_document(index, obj)
+                database = databases[self._shard(prepared[0])]
+                digest = self._digest(prepared)
+                if not force and self._indexed_digest(database, prepared[0]) == digest:
+                    skipped += 1
+                    continue
+                document_id, document, size = self._document(database, prepared, digest)
                 database.replace_document(document_id, document)
+                pending += 1
+                pending_bytes += size
+                
+                if pending >= flush_documents or pending_bytes >= flush_bytes:
+                    for database in databases:
+                        database.commit_transaction()
+                        database.begin_transaction()
+                    committed += pending
+                    pending = pending_bytes = 0
         
         except UnicodeDecodeError:
             sys.stderr.write('Chunk failed.\n')
             pass
+        
+        except:
+            for database in databases:
+                database.cancel_transaction()
+            raise
+        
+        for database in databases:
+            database.commit_transaction()
+        committed += pending
+        
+        documents = committed + skipped
+        seconds = time.time() - started
+        return {
+            'documents': documents,
+            'written': committed,
+            'skipped': skipped,
+            'seconds': seconds,
+            'rate': seconds and documents / seconds or float(documents),
+        }
+    
+    def _write(self, writes, force=False):
+        """
+        Private method that applies a list of `(document_id, prepared)`
+        writes, in one transaction per shard.  `prepared` is a tuple from
+        :method:`_prepare_document`, or None to remove the document.
+        
+        Optional arguments:
+            `force` -- Rewrite documents even if they are unchanged: True
+                       for every document, or a set of document IDs
+                       (default = False)
+        
+        As in :method:`update`, a document whose digest matches the indexed
+        one is skipped.  If `HAYSTACK_XAPIAN_WRITER_SOCKET` is set, the
+        writes are sent to the `XHWriterServer` instead, and this returns
+        once it has committed them.
+        
+        Returns a list of the IDs of the documents skipped.
+        """
+        if self.writer_socket:
+            return XHWriterClient(self.writer_socket).write(writes, force)
+        
+        skipped = []
+        databases = self._writable_databases()
+        for database in databases:
+            database.begin_transaction()
+        try:
+            for document_id, prepared in writes:
+                database = databases[self._shard(document_id)]
+                if prepared is None:
+                    database.delete_document(document_id)
+                    continue
+                digest = self._digest(prepared)
+                if force is not True and document_id not in (force or ()) and \
+                   self._indexed_digest(database, document_id) == digest:
+                    skipped.append(document_id)
+                    continue
+                database.replace_document(document_id, self._document(database, prepared, digest)[1])
+        except:
+            for database in databases:
+                database.cancel_transaction()
+            raise
+        for database in databases:
+            database.commit_transaction()
+        return skipped
+    
+    def _flush_write_queue(self):
+        """
+        Private method that waits for any writes queued for this index by
+        this process to be committed.
+        """
+        queue = XHWriteQueue.get(self, create=False)
+        if queue is not None:
+            queue.flush()
+    
+    def _prepare_document(self, index, obj):
+        """
+        Private method that runs `index.prepare` on `obj`.
+        
+        Returns a tuple of `(document_id, app_label, module_name, pk, model_data)`
+        that can be turned into a document by :method:`_document`.
+        """
+        return (
+            self.get_identifier(obj), obj._meta.app_label,
+            obj._meta.module_name, obj.pk, index.prepare(obj)
+        )
+    
+    def _digest(self, prepared):
+        """
+        Private method that returns a digest of a prepared document together
+        with everything else that decides how it is indexed.
+        """
+        document_id, app_label, module_name, pk, model_data = prepared
+        return hashlib.md5(pickle.dumps((
+            SCHEMA_VERSION, self.schema_plan.fingerprint, self.schema_plan.value_encoding,
+            self.stemming_language, getattr(settings, 'HAYSTACK_INCLUDE_SPELLING', False),
+            getattr(settings, 'HAYSTACK_XAPIAN_COMPRESS_THRESHOLD', None),
+            document_id, app_label, module_name, pk, sorted(model_data.items()),
+        ), pickle.HIGHEST_PROTOCOL)).digest()
+    
+    def _indexed_digest(self, database, document_id):
+        """
+        Private method that returns the digest stored with the document
+        `document_id` in `database`, or None if it is not indexed.
+        """
+        for posting in database.postlist(document_id):
+            return database.get_document(posting.docid).get_value(DOCUMENT_DIGEST_VALUE_COLUMN)
+        return None
+    
+    def _document(self, database, prepared, digest=None):
+        """
+        Private method that builds a xapian.Document from the output of
+        :method:`_prepare_document`.
+        
+        Required arguments:
+            `database` -- The writable database the document is destined for
+            `prepared` -- The prepared document tuple
+        
+        Optional arguments:
+            `digest` -- The digest of `prepared`, if already known
+        
+        Returns a tuple of `(document_id, document, size)` where `size` is
+        a rough estimate of the number of bytes the document will add to
+        the database.
+        """
+        document_id, app_label, module_name, pk, model_data = prepared
+        document = xapian.Document()
+        term_generator = self._term_generator(database, document)
+        size = 0
+        
+        for field_name, prefix, column in self.schema_plan.indexed:
+            if field_name in model_data:
+                value = model_data[field_name]
+                text = force_unicode(value)
+                term_generator.index_text(text)
+                if field_name in self.schema_plan.exact:
+                    if isinstance(value, (list, tuple)):
+                        items = value
+                    else:
+                        items = [value]
+                    for item in items:
+                        term = self.schema_plan.boolean_term(field_name, item)
+                        if len(term) <= MAX_TERM_LENGTH:
+                            document.add_term(term, 0)
+                else:
+                    term_generator.index_text(text, 1, prefix)
+                size += 2 * len(text)
+                marshalled = self.schema_plan.serialisers[field_name](value)
+                if marshalled:
+                    # A null field has no value, so it is left out of
+                    # facets, sorts first and never falls inside a range.
+                    document.add_value(column, marshalled)
+                    size += len(marshalled)
+                if field_name in self.schema_plan.facet_columns:
+                    for facet_column, facet_value in self.schema_plan.facet_values(field_name, value):
+                        document.add_value(facet_column, facet_value)
+                        size += len(facet_value)
+        
+        if self.schema_plan.value_encoding >= VALUE_ENCODING:
+            # Older indexes keep a field in this column.
+            document.add_value(
+                DOCUMENT_ID_VALUE_COLUMN,
+                document_id[len(DOCUMENT_ID_TERM_PREFIX):]
+            )
+        document.add_value(DOCUMENT_DIGEST_VALUE_COLUMN, digest or self._digest(prepared))
+        data = XHDocumentData.encode(
+            app_label, module_name, pk, model_data,
+            getattr(settings, 'HAYSTACK_XAPIAN_COMPRESS_THRESHOLD', None)
+        )
+        document.set_data(data)
+        document.add_term(document_id)
+        document.add_term(
+            DOCUMENT_CT_TERM_PREFIX + u'%s.%s' %
+            (app_label, module_name)
+        )
+        
+        return document_id, document, size + len(data)
+    
+    def parallel_update(self, index, queryset, processes=None,
+                        flush_documents=None, flush_megabytes=None):
+        """
+        Updates the `index` with the objects in `queryset` using a pool of
+        worker processes.
+        
+        Required arguments:
+            `index` -- The `SearchIndex` to process
+            `queryset` -- A `QuerySet` of the model instances to index
+        
+        Optional arguments:
+            `processes` -- The number of worker processes (default = the
+                           number of CPUs)
+            `flush_documents` -- Passed on to :method:`update`
+            `flush_megabytes` -- Passed on to :method:`update`
+        
+        The primary keys in `queryset` are split into one contiguous range
+        per worker.  Each worker forks with its own database connection and
+        indexes its range into a temporary database next to
+        `HAYSTACK_XAPIAN_PATH` that has been seeded with the live schema.
+        
+        The temporary databases are then merged.  If the live database is
+        empty and unsharded they are compacted together with
+        `xapian.Compactor` and the result replaces the live database;
+        otherwise their documents and spelling data are copied into the
+        right shards in transactions, skipping documents that are unchanged.
+        The writer locks on the live database are held throughout the merge.
+        
+        Returns a dictionary in the same format as :method:`update`.
+        """
+        if multiprocessing is None:
+            raise MissingDependency("Parallel updates require the 'multiprocessing' module (Python 2.6+).")
+        
+        global _parallel_update_state
+        
+        started = time.time()
+        processes = processes or multiprocessing.cpu_count()
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+        chunk_size = max(1, -(-len(pks) // processes))
+        chunks = [pks[i:i + chunk_size] for i in xrange(0, len(pks), chunk_size)]
+        
+        database = self._writable_databases()[0]
+        metadata = [
+            (key, database.get_metadata(key))
+            for key in ('schema', 'content', 'schema_fingerprint', 'value_encoding')
+        ]
+        del database
+        
+        parent_path = os.path.dirname(os.path.abspath(self.path))
+        paths = []
+        try:
+            for chunk in chunks:
+                path = tempfile.mkdtemp(prefix='.xapian-parallel-', dir=parent_path)
+                paths.append(path)
+                part = xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
+                for key, value in metadata:
+                    part.set_metadata(key, value)
+                part.flush()
+                del part
+            
+            # Workers must not share the parent's database connection.
+            from django.db import connection
+            connection.close()
+            
+            _parallel_update_state = (self, index, queryset)
+            pool = multiprocessing.Pool(processes)
+            try:
+                pool.map(_parallel_update_worker, [
+                    (path, chunk[0], chunk[-1], flush_documents, flush_megabytes)
+                    for path, chunk in zip(paths, chunks)
+                ])
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                # The workers must have exited, and closed their databases,
+                # before the databases are merged or removed.
+                pool.join()
+                _parallel_update_state = None
+            
+            written, skipped = self._merge_databases(paths, flush_documents)
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+        
+        documents = written + skipped
+        seconds = time.time() - started
+        return {
+            'documents': documents,
+            'written': written,
+            'skipped': skipped,
+            'seconds': seconds,
+            'rate': seconds and documents / seconds or float(documents),
+        }
+    
+    def _document_identifier(self, document):
+        """
+        Private method that returns the `Q` term identifying `document`.
+        """
+        if self.schema_plan.value_encoding >= VALUE_ENCODING:
+            return DOCUMENT_ID_TERM_PREFIX + document.get_value(DOCUMENT_ID_VALUE_COLUMN)
+        for item in document.termlist():
+            if item.term.startswith(DOCUMENT_ID_TERM_PREFIX):
+                return item.term
+        return None
+    
+    def _merge_databases(self, paths, flush_documents=None):
+        """
+        Private method that merges the databases in `paths` into the live
+        database, replacing any documents with the same identifier.
+        
+        Documents whose digest matches the one already indexed are skipped,
+        as in :method:`update`.  The spelling data of each database is added
+        to the first shard.
+        
+        Returns a tuple of the number of documents written and skipped.
+        """
+        if not paths:
+            return 0, 0
+        if flush_documents is None:
+            flush_documents = getattr(settings, 'HAYSTACK_XAPIAN_FLUSH_DOCUMENTS', DEFAULT_FLUSH_DOCUMENTS)
+        
+        databases = self._writable_databases()
+        
+        if len(databases) == 1 and databases[0].get_doccount() == 0:
+            compacted_path = tempfile.mkdtemp(prefix='.xapian-compact-', dir=os.path.dirname(paths[0]))
+            os.rmdir(compacted_path)
+            try:
+                self._compact(paths, compacted_path)
+                documents = xapian.Database(compacted_path).get_doccount()
+                self._replace_database(compacted_path)
+            finally:
+                if os.path.exists(compacted_path):
+                    shutil.rmtree(compacted_path)
+            return documents, 0
+        
+        written = skipped = 0
+        for database in databases:
+            database.begin_transaction()
+        try:
+            for path in paths:
+                source = xapian.Database(path)
+                for item in source.spellings():
+                    databases[0].add_spelling(item.term, item.termfreq)
+                for posting in source.postlist(''):
+                    document = source.get_document(posting.docid)
+                    document_id = self._document_identifier(document)
+                    database = databases[self._shard(document_id)]
+                    if self._indexed_digest(database, document_id) == \
+                       document.get_value(DOCUMENT_DIGEST_VALUE_COLUMN):
+                        skipped += 1
+                        continue
+                    database.replace_document(document_id, document)
+                    written += 1
+                    if written % flush_documents == 0:
+                        for database in databases:
+                            database.commit_transaction()
+                            database.begin_transaction()
+        except:
+            for database in databases:
+                database.cancel_transaction()
+            raise
+        for database in databases:
+            database.commit_transaction()
+        return written, skipped
+    
+    def rebuild(self, updates, keep=None):
+        """
+        Rebuilds the index as a new generation and switches searches over to
+        it all at once.
+        
+        Required arguments:
+            `updates` -- A list of `(index, iterable)` pairs to pass to
+                         :method:`update`
+        
+        Optional arguments:
+            `keep` -- The number of earlier generations to keep (default =
+                      `HAYSTACK_XAPIAN_KEEP_GENERATIONS` or 1)
+        
+        A rebuilt index is a symlink at `HAYSTACK_XAPIAN_PATH` to the live
+        generation, a directory named `<path>.gen<n>` beside it.  The new
+        generation is written while searches keep using the live one, then
+        a new symlink is renamed over the old one, which is atomic.  Readers
+        move to the new generation when they next reopen.  New indexes
+        start out as generation 0, and an index written by an older version
+        of the backend, in a plain directory, becomes generation 0 the first
+        time it is switched, as described in :method:`_link_generation`.
+        
+        Writes made to the live generation during the rebuild are not
+        carried over to the new one.
+        
+        Returns a dictionary in the same format as :method:`update`, with
+        the number of the new generation in `generation`.
+        """
+        if keep is None:
+            keep = getattr(settings, 'HAYSTACK_XAPIAN_KEEP_GENERATIONS', 1)
+        self._flush_write_queue()
+        started = time.time()
+        
+        generation = max([0] + self._generations().keys()) + 1
+        generation_path = self._generation_path(generation)
+        # The generation is a plain directory, not a link to one of its own.
+        os.makedirs(generation_path)
+        backend = SearchBackend(
+            self.site, self.stemming_language, path=generation_path, shards=self.shards
+        )
+        backend.write_behind = False
+        backend.writer_socket = None
+        written = skipped = 0
+        try:
+            for database in backend._writable_databases():
+                database.flush()
+            for index, iterable in updates:
+                stats = backend.update(index, iterable, force=True)
+                written += stats['written']
+                skipped += stats['skipped']
+        except:
+            shutil.rmtree(generation_path)
+            raise
+        del backend
+        
+        link_path = self.path.rstrip(os.sep)
+        self._link_generation(generation_path, link_path)
+        
+        live_path = os.path.realpath(link_path)
+        earlier = sorted([
+            path for path in self._generations().values()
+            if os.path.realpath(path) != live_path
+        ], key=lambda path: -int(path[len(link_path) + len('.gen'):]))
+        for path in earlier[keep:]:
+            shutil.rmtree(path)
+        
+        documents = written + skipped
+        seconds = time.time() - started
+        return {
+            'documents': documents,
+            'written': written,
+            'skipped': skipped,
+            'generation': generation,
+            'seconds': seconds,
+            'rate': seconds and documents / seconds or float(documents),
+        }
+    
+    def _generation_path(self, generation, link_path=None):
+        """
+        Private method that returns the path of generation `generation` of
+        the index, or of the shard at `link_path`.
+        """
+        return '%s.gen%d' % ((link_path or self.path).rstrip(os.sep), generation)
+    
+    def _generations(self, link_path=None):
+        """
+        Private method that returns a dictionary mapping the number of each
+        generation of the index, or of the shard at `link_path`, on disk to
+        its path.
+        """
+        link_path = (link_path or self.path).rstrip(os.sep)
+        parent, name = os.path.split(os.path.abspath(link_path))
+        generations = {}
+        for filename in os.listdir(parent):
+            suffix = filename[len(name) + len('.gen'):]
+            if filename.startswith(name + '.gen') and suffix.isdigit():
+                generations[int(suffix)] = self._generation_path(int(suffix), link_path)
+        return generations
+    
+    def _link_generation(self, generation_path, link_path):
+        """
+        Private method that points the symlink at `link_path` to the
+        directory at `generation_path` with a single rename.  Returns the
+        path of the directory `link_path` led to before.
+        
+        Databases are created as a symlink to generation 0 by
+        :method:`_create_database`, so this is a single rename.  Only an
+        index written by an older version of the backend, in a plain
+        directory, is first moved to generation 0, which leaves `link_path`
+        missing until the symlink is renamed into place.  Writers of this
+        backend that open it meanwhile link it back to generation 0.  If
+        the symlink cannot be placed, the directory is put back, unless
+        something else has been created at `link_path`.  That is left
+        alone, as it may hold committed writes, and the error is raised
+        with the old directory still at generation 0.
+        """
+        if os.path.islink(link_path):
+            previous_path = os.path.realpath(link_path)
+            self._place_link(generation_path, link_path)
+            return previous_path
+        
+        previous_path = self._generation_path(0, link_path)
+        os.rename(link_path, previous_path)
+        try:
+            self._place_link(generation_path, link_path)
+        except:
+            if not os.path.lexists(link_path):
+                os.rename(previous_path, link_path)
+            raise
+        return previous_path
+    
+    def _create_database(self, link_path):
+        """
+        Private method that lays out a new database at `link_path` as a
+        symlink to a directory for generation 0 beside it, so that swapping
+        in a new database later is a single rename of the symlink.  Does
+        nothing if `link_path` already exists.
+        
+        If generation 0 already exists, `link_path` is linked to it: that
+        is an older plain directory part way through being switched by
+        :method:`_link_generation`.  Creators racing each other all link to
+        the same directory.
+        """
+        link_path = link_path.rstrip(os.sep)
+        if os.path.lexists(link_path):
+            return
+        generation_path = self._generation_path(0, link_path)
+        try:
+            os.makedirs(generation_path)
+        except OSError:
+            if not os.path.isdir(generation_path):
+                raise
+        try:
+            os.symlink(os.path.basename(generation_path), link_path)
+        except OSError:
+            if not os.path.lexists(link_path):
+                raise
+    
+    def _place_link(self, generation_path, link_path):
+        """
+        Private method that renames a new symlink to `generation_path` over
+        `link_path`.
+        
+        The link is made inside a private directory, so that its name
+        cannot be taken by anyone else before it is renamed into place.
+        """
+        temporary_dir = tempfile.mkdtemp(prefix='.xapian-link-', dir=os.path.dirname(os.path.abspath(link_path)))
+        try:
+            temporary_path = os.path.join(temporary_dir, 'link')
+            os.symlink(os.path.basename(generation_path), temporary_path)
+            os.rename(temporary_path, link_path)
+        finally:
+            shutil.rmtree(temporary_dir)
+    
+    def compact(self):
+        """
+        Compacts each shard of the index into a new database and swaps it in.
+        
+        The writer lock on every shard is held throughout, so writes are
+        blocked for the whole compaction: other writers fail with
+        `xapian.DatabaseLockError`, and the write queue retries their
+        batches, or drops them if it is stopping.  Readers keep the old
+        database until they notice the new one and reopen.  Each shard is swapped in by
+        :method:`_replace_database` with a single rename of a symlink.
+        Compaction rewrites each table with full blocks, removing the free
+        space left behind by replaced and deleted documents.
+        
+        Returns a dictionary with the following keys:
+            `before` -- The size of the index on disk beforehand, in bytes
+            `after` -- The size of the index on disk afterwards, in bytes
+            `tables` -- A dictionary mapping each table name (`postlist`,
+                        `termlist`, ...) to a tuple of its size in bytes
+                        before and after
+            `seconds` -- The time taken
+        """
+        self._flush_write_queue()
+        started = time.time()
+        databases = self._writable_databases()
+        for database in databases:
+            database.flush()
+        
+        tables = {}
+        for path in self._shard_paths():
+            before = self._table_sizes(path)
+            compacted_path = tempfile.mkdtemp(prefix='.xapian-compact-', dir=os.path.dirname(os.path.abspath(path)))
+            os.rmdir(compacted_path)
+            try:
+                self._compact([path], compacted_path)
+                after = self._table_sizes(compacted_path)
+                self._replace_database(compacted_path, path)
+            finally:
+                if os.path.exists(compacted_path):
+                    shutil.rmtree(compacted_path)
+            for table in set(before) | set(after):
+                total_before, total_after = tables.get(table, (0, 0))
+                tables[table] = (total_before + before.get(table, 0), total_after + after.get(table, 0))
+        
+        return {
+            'before': sum([size for size, __unused__ in tables.values()]),
+            'after': sum([size for __unused__, size in tables.values()]),
+            'tables': tables,
+            'seconds': time.time() - started,
+        }
+    
+    def _table_sizes(self, path):
+        """
+        Private method that returns a dictionary mapping the name of each
+        table of the database at `path` to the size of its file in bytes.
+        """
+        sizes = {}
+        for filename in os.listdir(path):
+            table, extension = os.path.splitext(filename)
+            if extension in ('.DB', '.glass'):
+                sizes[table] = os.path.getsize(os.path.join(path, filename))
+        return sizes
+    
+    def _compact(self, paths, destination):
+        """
+        Private method that compacts the databases in `paths` into a single
+        database at `destination`.
+        """
+        if hasattr(xapian.Database, 'compact'):
+            sources = xapian.Database()
+            for path in paths:
+                sources.add_database(xapian.Database(path))
+            sources.compact(destination)
+        else:
+            compactor = xapian.Compactor()
+            for path in paths:
+                compactor.add_source(path)
+            compactor.set_destdir(destination)
+            compactor.compact()
+    
+    def _replace_database(self, path, live_path=None):
+        """
+        Private method that moves the database at `path` into place as the
+        live database, or the shard at `live_path`.
+        
+        `path` becomes the next generation of `live_path`, a directory named
+        `<live_path>.gen<n>` beside it, and `live_path` is switched to it by
+        :method:`_link_generation`, so that readers and writers see either
+        the old database or the new one.  The old directory is then removed;
+        readers holding it keep using it until their handles notice the new
+        directory and reopen.  If the switch fails, the database is moved
+        back to `path`.
+        """
+        live_path = (live_path or self.path).rstrip(os.sep)
+        generation_path = self._generation_path(max([0] + self._generations(live_path).keys()) + 1, live_path)
+        os.rename(path, generation_path)
+        try:
+            previous_path = self._link_generation(generation_path, live_path)
+        except:
+            os.rename(generation_path, path)
+            raise
+        shutil.rmtree(previous_path)
+    
+    def migrate_values(self, flush_documents=None):
+        """
+        Rewrites the value columns of an index written by an older version
+        of the backend in the current `VALUE_ENCODING`.
+        
+        Optional arguments:
+            `flush_documents` -- The number of documents to write in each
+                                 transaction (default =
+                                 `HAYSTACK_XAPIAN_FLUSH_DOCUMENTS` or 1000)
+        
+        Each value is re-encoded from the document's stored data.  A field
+        kept in `DOCUMENT_ID_VALUE_COLUMN` is moved to a new column and the
+        document identifier is stored there instead, and the digest used by
+        :method:`update` is recomputed for the new encoding.
+        
+        Every shard is copied into a new database beside it in transactions
+        of `flush_documents`, together with its metadata and spelling data,
+        and the copy is switched in with :method:`_replace_database`, so
+        readers see either the old or the new encoding of a shard and never
+        a mix.  The writer locks on the shards are held throughout.  The
+        first shard, whose metadata decides the encoding of the whole index,
+        is switched last.
+        
+        Returns the number of documents rewritten.
+        """
+        if flush_documents is None:
+            flush_documents = getattr(settings, 'HAYSTACK_XAPIAN_FLUSH_DOCUMENTS', DEFAULT_FLUSH_DOCUMENTS)
+        self._flush_write_queue()
+        
+        databases = self._writable_databases()
+        if self.schema_plan.value_encoding >= VALUE_ENCODING:
+            return 0
+        for database in databases:
+            database.flush()
+        
+        content_field_name = self.content_field_name
+        schema = self._merge_schema(self.schema, self.schema)
+        fingerprint = self._schema_fingerprint(content_field_name, schema)
+        self._use_schema(XHSchema.get(content_field_name, schema, fingerprint))
+        metadata = {
+            'schema': pickle.dumps(schema, pickle.HIGHEST_PROTOCOL),
+            'content': pickle.dumps(content_field_name, pickle.HIGHEST_PROTOCOL),
+            'schema_fingerprint': fingerprint,
+            'value_encoding': str(VALUE_ENCODING),
+        }
+        
+        documents = 0
+        for path, database in reversed(zip(self._shard_paths(), databases)):
+            migrated_path = tempfile.mkdtemp(prefix='.xapian-migrate-', dir=os.path.dirname(os.path.abspath(path)))
+            try:
+                migrated = xapian.WritableDatabase(migrated_path, xapian.DB_CREATE_OR_OPEN)
+                for item in database.metadata_keys():
+                    migrated.set_metadata(item.term, database.get_metadata(item.term))
+                for key, value in metadata.iteritems():
+                    migrated.set_metadata(key, value)
+                for item in database.spellings():
+                    migrated.add_spelling(item.term, item.termfreq)
+                
+                migrated.begin_transaction()
+                try:
+                    for posting in database.postlist(''):
+                        document = database.get_document(posting.docid)
+                        app_label, module_name, pk, model_data = XHDocumentData.decode(document.get_data())
+                        document_id = self.get_identifier(u'%s.%s.%s' % (app_label, module_name, pk))
+                        document.clear_values()
+                        for field_name, prefix, column in self.schema_plan.indexed:
+                            if model_data.get(field_name) is not None:
+                                document.add_value(column, self.schema_plan.serialisers[field_name](model_data[field_name]))
+                                if field_name in self.schema_plan.facet_columns:
+                                    for facet_column, facet_value in self.schema_plan.facet_values(field_name, model_data[field_name]):
+                                        document.add_value(facet_column, facet_value)
+                        document.add_value(DOCUMENT_ID_VALUE_COLUMN, document_id[len(DOCUMENT_ID_TERM_PREFIX):])
+                        document.add_value(DOCUMENT_DIGEST_VALUE_COLUMN, self._digest(
+                            (document_id, app_label, module_name, pk, model_data)
+                        ))
+                        migrated.replace_document(posting.docid, document)
+                        documents += 1
+                        if documents % flush_documents == 0:
+                            migrated.commit_transaction()
+                            migrated.begin_transaction()
+                except:
+                    migrated.cancel_transaction()
+                    raise
+                migrated.commit_transaction()
+                migrated.flush()
+                del migrated
+                self._replace_database(migrated_path, path)
+            finally:
+                if os.path.exists(migrated_path):
+                    shutil.rmtree(migrated_path)
+        
+        self._database_cache = {}
+        return documents
     
     def remove(self, obj):
         """
@@ -233,9 +2530,91 @@ class SearchBackend(BaseSearchBackend):
         
         We delete all instances of `Q<app_name>.<model_name>.<pk>` which
         should be unique to this object.
+        
+        If `HAYSTACK_XAPIAN_WRITE_BEHIND` is set, the removal is queued
+        instead, like :method:`update`, and if `HAYSTACK_XAPIAN_WRITER_SOCKET`
+        is set it is sent to the `XHWriterServer`.
+        """
+        document_id = self.get_identifier(obj)
+        if self.write_behind:
+            XHWriteQueue.get(self).put(document_id, None)
+            return
+        self._write([(document_id, None)])
+    
+    def remove_many(self, objects=None, identifiers=None, query=None, flush_documents=None,
+                    terms=None):
         """
-        database = self._database(writable=True)
-        database.delete_document(self.get_identifier(obj))
+        Remove many documents from the database at once.
+        
+        Optional arguments:
+            `objects` -- Model instances to remove (default = None)
+            `identifiers` -- Document identifiers, such as `app.model.pk`, to
+                             remove (default = None)
+            `query` -- Remove every document matching this query string or
+                       xapian.Query (default = None)
+            `flush_documents` -- The number of documents to remove in each
+                                 transaction (default =
+                                 `HAYSTACK_XAPIAN_FLUSH_DOCUMENTS` or 1000)
+            `terms` -- Remove every document with one of these terms, such
+                       as `XCONTENTTYPE<app_name>.<model_name>` (default = None)
+        
+        The writable databases are opened once and documents are deleted in
+        transactions of `flush_documents`, so other writers are only kept
+        waiting for as long as the whole removal takes and readers see it in
+        batches.  Documents are found through the posting lists of their `Q`
+        terms and of `terms`, and matches of `query` are fetched, unranked
+        and without their documents, `flush_documents` at a time.  They are
+        then deleted by document id.
+        
+        Returns the number of documents removed.
+        """
+        if flush_documents is None:
+            flush_documents = getattr(settings, 'HAYSTACK_XAPIAN_FLUSH_DOCUMENTS', DEFAULT_FLUSH_DOCUMENTS)
+        self._flush_write_queue()
+        
+        document_ids = set([self.get_identifier(obj) for obj in objects or []])
+        document_ids.update([self.get_identifier(identifier) for identifier in identifiers or []])
+        
+        databases = self._writable_databases()
+        removals = [set() for database in databases]
+        for document_id in document_ids:
+            shard = self._shard(document_id)
+            removals[shard].update([
+                posting.docid for posting in databases[shard].postlist(document_id)
+            ])
+        for database, docids in zip(databases, removals):
+            for term in terms or []:
+                docids.update([posting.docid for posting in database.postlist(term)])
+        if query is not None:
+            for database, docids in zip(databases, removals):
+                shard_query = query
+                if isinstance(query, basestring):
+                    shard_query = self._query(database, query)[0]
+                enquire = self._enquire(database, shard_query)
+                enquire.set_weighting_scheme(xapian.BoolWeight())
+                offset = 0
+                while True:
+                    matches = enquire.get_mset(offset, flush_documents)
+                    docids.update([match.docid for match in matches])
+                    if matches.size() < flush_documents:
+                        break
+                    offset += flush_documents
+        
+        removed = 0
+        for database, docids in zip(databases, removals):
+            database.begin_transaction()
+            try:
+                for docid in sorted(docids):
+                    database.delete_document(docid)
+                    removed += 1
+                    if removed % flush_documents == 0:
+                        database.commit_transaction()
+                        database.begin_transaction()
+            except:
+                database.cancel_transaction()
+                raise
+            database.commit_transaction()
+        return removed
     
     def clear(self, models=[]):
         """
@@ -245,29 +2624,59 @@ class SearchBackend(BaseSearchBackend):
         Optional Arguments:
             `models` -- Models to clear from the database (default = [])
         
-        If `models` is empty, an empty query is executed which matches all
-        documents in the database.  Afterwards, each match is deleted.
+        If `models` is empty, each shard is replaced by a new, empty database
+        with the same schema, while the writer lock on the old one is held.
+        Readers keep the old database until they notice the new one and
+        reopen, so no reader ever sees a partly cleared index.
         
-        Otherwise, for each model, a `delete_document` call is issued with
-        the term `XCONTENTTYPE<app_name>.<model_name>`.  This will delete
-        all documents with the specified model type.
+        Otherwise, every document with one of the terms
+        `XCONTENTTYPE<app_name>.<model_name>` is deleted through
+        :method:`remove_many`, which reads their posting lists, in batched
+        transactions.
+        
+        Returns the number of documents removed.
         """
-        database = self._database(writable=True)
-        if not models:
-            query, __unused__ = self._query(database, '*')
-            enquire = self._enquire(database, query)
-            for match in enquire.get_mset(0, DEFAULT_MAX_RESULTS):
-                database.delete_document(match.docid)
-        else:
-            for model in models:
-                database.delete_document(
-                    DOCUMENT_CT_TERM_PREFIX + '%s.%s' %
-                    (model._meta.app_label, model._meta.module_name)
-                )
+        self._flush_write_queue()
+        if models:
+            return self.remove_many(terms=[
+                DOCUMENT_CT_TERM_PREFIX + '%s.%s' %
+                (model._meta.app_label, model._meta.module_name)
+                for model in models
+            ])
+        
+        databases = self._writable_databases()
+        # An empty database takes the current layout, so a field kept in
+        # the ID column by an older index is moved out of it.
+        schema = self._merge_schema(self.schema, self.schema)
+        metadata = {
+            'schema': pickle.dumps(schema, pickle.HIGHEST_PROTOCOL),
+            'content': pickle.dumps(self.content_field_name, pickle.HIGHEST_PROTOCOL),
+            'schema_fingerprint': self._schema_fingerprint(self.content_field_name, schema),
+            'value_encoding': str(VALUE_ENCODING),
+        }
+        removed = 0
+        for path, database in zip(self._shard_paths(), databases):
+            database.flush()
+            removed += database.get_doccount()
+            empty_path = tempfile.mkdtemp(prefix='.xapian-clear-', dir=os.path.dirname(os.path.abspath(path)))
+            try:
+                empty = xapian.WritableDatabase(empty_path, xapian.DB_CREATE_OR_OPEN)
+                for key, value in metadata.iteritems():
+                    empty.set_metadata(key, value)
+                empty.flush()
+                del empty
+                self._replace_database(empty_path, path)
+            finally:
+                if os.path.exists(empty_path):
+                    shutil.rmtree(empty_path)
+        return removed
     
+    @reopen_on_modified
     def search(self, query_string, sort_by=None, start_offset=0, end_offset=DEFAULT_MAX_RESULTS,
                fields='', highlight=False, facets=None, date_facets=None, query_facets=None,
-               narrow_queries=None, boost=None, **kwargs):
+               narrow_queries=None, boost=None, count_only=False, check_at_least=None,
+               exact_hits=None, percent_cutoff=None, query_filters=None, models=None,
+               **kwargs):
         """
         Executes the search as defined in `query_string`.
         
@@ -277,14 +2686,33 @@ class SearchBackend(BaseSearchBackend):
         Optional arguments:
             `sort_by` -- Sort results by specified field (default = None)
             `start_offset` -- Slice results from `start_offset` (default = 0)
-            `end_offset` -- Slice results at `end_offset` (default = 10,000)
-            `fields` -- Filter results on `fields` (default = '')
+            `end_offset` -- The maximum number of results to return
+                            (default = 100,000)
+            `fields` -- Only load the named stored fields into the results,
+                        as a list or a comma separated string (default = '',
+                        all fields)
             `highlight` -- Highlight terms in results (default = False)
             `facets` -- Facet results on fields (default = None)
             `date_facets` -- Facet results on date ranges (default = None)
             `query_facets` -- Facet results on queries (default = None)
             `narrow_queries` -- Narrow queries (default = None)
             `boost` -- Dictionary of terms and weights to boost results
+            `count_only` -- Only count the hits, returning no results
+                            (default = False)
+            `check_at_least` -- The minimum number of matches the matcher
+                                should look at before estimating `hits`,
+                                when `exact_hits` is False (default =
+                                `HAYSTACK_XAPIAN_CHECK_AT_LEAST` or 0)
+            `exact_hits` -- Look at every match so that `hits` is exact
+                            (default = `HAYSTACK_XAPIAN_EXACT_HITS` or True)
+            `percent_cutoff` -- Leave out matches scoring less than this
+                                percentage of the best match (default = None)
+            `query_filters` -- Build the query from these `SearchQuery`
+                               filters instead of parsing `query_string`,
+                               which is then only used for highlighting
+                               (default = None)
+            `models` -- Only match these models, with `query_filters`
+                        (default = None)
         
         Returns:
             A dictionary with the following keys:
@@ -305,8 +2733,23 @@ class SearchBackend(BaseSearchBackend):
         Afterwards, executes the Xapian query parser to create a query from
         `query_string` that is then passed to a new `enquire` instance.
         
-        The resulting match set is passed to :method:`_process_results` for
-        further processing prior to returning a dictionary with the results.
+        Each match in the resulting match set becomes an `XHSearchResult`,
+        which only decodes the stored document data when its fields are
+        first accessed.  The match set is never asked for more results than
+        the database holds past `start_offset`.
+        
+        If `HAYSTACK_XAPIAN_RESULT_CACHE_ENTRIES` is set, the stored data of
+        each match is copied out and the results are kept in `RESULT_CACHE`,
+        keyed on the arguments and the revision of the database, so that
+        repeated searches skip parsing and matching until the next write.
+        Searches of a database modified within `DATABASE_MTIME_WINDOW`
+        seconds are not cached, as a later commit in the same mtime tick
+        could leave its revision marker unchanged.
+        
+        `hits` is exact unless `exact_hits` is False, when it is Xapian's
+        estimate of the number of matches after looking at `check_at_least`
+        of them.  Estimates are cheaper for large result sets, but make page
+        counts approximate.  Faceting always looks at every match.
         
         If `HAYSTACK_INCLUDE_SPELLING` was enabled in `settings.py`, the
         extra flag `FLAG_SPELLING_CORRECTION` will be passed to the query parser
@@ -319,12 +2762,25 @@ class SearchBackend(BaseSearchBackend):
                 'hits': 0,
             }
         
-        if query_facets is not None:
-            warnings.warn("Query faceting has not been implemented yet.", Warning, stacklevel=2)
-        
         database = self._database()
+        
+        cache = self._result_cache()
+        cache_key = None
+        if cache is not None and not DATABASE_POOL.recent(self._database_revision):
+            cache_key = (
+                self._shard_paths(), self._database_revision, self.stemming_language,
+                ' '.join(query_string.split()), XHLRUCache.freeze((
+                    sort_by, start_offset, end_offset, fields, highlight, facets,
+                    date_facets, query_facets, narrow_queries, boost, count_only,
+                    check_at_least, exact_hits, percent_cutoff
+                )), self._filter_key(query_filters, models)
+            )
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return self._cached_search(cached, query_string, highlight, fields)
+        
         query, spelling_suggestion = self._query(
-            database, query_string, narrow_queries, boost
+            database, query_string, narrow_queries, boost, query_filters, models
         )
         enquire = self._enquire(database, query)
         
@@ -332,49 +2788,129 @@ class SearchBackend(BaseSearchBackend):
             sorter = self._sorter(sort_by)
             enquire.set_sort_by_key_then_relevance(sorter, True)
         
-        results = []
         facets_dict = {
             'fields': {},
             'dates': {},
             'queries': {},
         }
-        matches = enquire.get_mset(start_offset, end_offset)
         
-        for match in matches:
-            app_label, module_name, pk, model_data = pickle.loads(match.document.get_data())
-            if highlight and (len(query_string) > 0):
-                model_data['highlighted'] = {
-                    self.content_field_name: self._do_highlight(
-                        model_data.get(self.content_field_name), query_string
-                    )
-                }
-            results.append(
-                SearchResult(app_label, module_name, pk, match.weight, **model_data)
+        if percent_cutoff:
+            enquire.set_cutoff(percent_cutoff)
+        
+        if check_at_least is None:
+            check_at_least = getattr(settings, 'HAYSTACK_XAPIAN_CHECK_AT_LEAST', 0)
+        if exact_hits is None:
+            exact_hits = getattr(settings, 'HAYSTACK_XAPIAN_EXACT_HITS', True)
+        if exact_hits:
+            check_at_least = database.get_doccount()
+        
+        if facets or date_facets:
+            field_spies = self._add_field_spies(
+                database, enquire, list(facets or []) + list(date_facets or [])
             )
+            check_at_least = database.get_doccount()
+        
+        if count_only:
+            start_offset = end_offset = 0
+        else:
+            end_offset = max(0, min(end_offset, database.get_doccount() - start_offset))
+        
+        matches = enquire.get_mset(start_offset, end_offset, check_at_least)
+        
+        documents = [(match.document, match.weight) for match in matches]
+        if cache_key is not None:
+            documents = [
+                (XHCachedDocument(document.get_value(DOCUMENT_ID_VALUE_COLUMN), document.get_data()), weight)
+                for document, weight in documents
+            ]
+        results = self._search_results(documents, query_string, highlight, fields)
         
         if facets:
-            facets_dict['fields'] = self._do_field_facets(results, facets)
+            facets_dict['fields'] = self._do_field_facets(field_spies, facets)
         if date_facets:
-            facets_dict['dates'] = self._do_date_facets(results, date_facets)
+            facets_dict['dates'] = self._do_date_facets(field_spies, date_facets)
         if query_facets:
-            facets_dict['queries'] = self._do_query_facets(results, query_facets)
+            facets_dict['queries'] = self._do_query_facets(database, query, query_facets)
+        
+        hits = matches.get_matches_estimated()
+        
+        if cache_key is not None:
+            cache.set(
+                cache_key, (documents, hits, facets_dict, spelling_suggestion),
+                sum([len(document.data) + 64 for document, weight in documents]) + 512
+            )
+            facets_dict = copy.deepcopy(facets_dict)
         
         return {
             'results': results,
-            'hits': matches.get_matches_estimated(),
+            'hits': hits,
             'facets': facets_dict,
             'spelling_suggestion': spelling_suggestion,
         }
     
+    def _search_results(self, documents, query_string, highlight, fields):
+        """
+        Private method that returns a list of `XHSearchResult` for a list of
+        `(document, weight)` tuples.
+        """
+        highlighter = None
+        if highlight and (len(query_string) > 0):
+            content_field_name = self.content_field_name
+            compiled = self._highlighter(query_string)
+            highlighter = lambda content: {
+                content_field_name: compiled.highlight(content)
+            }
+        
+        fields = self._stored_fields(fields)
+        return [
+            XHSearchResult(self, document, weight, highlighter, fields)
+            for document, weight in documents
+        ]
+    
+    def _cached_search(self, cached, query_string, highlight, fields):
+        """
+        Private method that rebuilds the return value of `search` from an
+        entry in the result cache.
+        """
+        documents, hits, facets_dict, spelling_suggestion = cached
+        return {
+            'results': self._search_results(documents, query_string, highlight, fields),
+            'hits': hits,
+            'facets': copy.deepcopy(facets_dict),
+            'spelling_suggestion': spelling_suggestion,
+        }
+    
+    def _result_cache(self):
+        """
+        Private method that returns the process wide result cache, or None if
+        `HAYSTACK_XAPIAN_RESULT_CACHE_ENTRIES` is not set.
+        """
+        global RESULT_CACHE
+        
+        max_entries = getattr(settings, 'HAYSTACK_XAPIAN_RESULT_CACHE_ENTRIES', 0)
+        if not max_entries:
+            return None
+        max_bytes = getattr(settings, 'HAYSTACK_XAPIAN_RESULT_CACHE_MEGABYTES', DEFAULT_RESULT_CACHE_MEGABYTES) * 1024 * 1024
+        if RESULT_CACHE is None or (RESULT_CACHE.max_entries, RESULT_CACHE.max_bytes) != (max_entries, max_bytes):
+            RESULT_CACHE = XHLRUCache(max_entries, max_bytes)
+        return RESULT_CACHE
+    
     def delete_index(self):
         """
         Delete the index.
         
-        This removes all indexes files and the `HAYSTACK_XAPIAN_PATH` folder.
+        This removes all indexes files and the `HAYSTACK_XAPIAN_PATH` folder,
+        or the symlink and every generation left by :method:`rebuild`,
+        :method:`clear` or :method:`compact`.
         """
-        if os.path.exists(settings.HAYSTACK_XAPIAN_PATH):
-            shutil.rmtree(settings.HAYSTACK_XAPIAN_PATH)
+        if os.path.islink(self.path):
+            os.unlink(self.path)
+            for generation_path in self._generations().values():
+                shutil.rmtree(generation_path)
+        elif os.path.exists(self.path):
+            shutil.rmtree(self.path)
     
+    @reopen_on_modified
     def document_count(self):
         """
         Retrieves the total document count for the search index.
@@ -385,8 +2921,9 @@ class SearchBackend(BaseSearchBackend):
             return 0
         return database.get_doccount()
     
+    @reopen_on_modified
     def more_like_this(self, model_instance, additional_query_string=None,
-                       start_offset=0, end_offset=DEFAULT_MAX_RESULTS, **kwargs):
+                       start_offset=0, end_offset=DEFAULT_MAX_RESULTS, fields='', **kwargs):
         """
         Given a model instance, returns a result set of similar documents.
         
@@ -399,6 +2936,8 @@ class SearchBackend(BaseSearchBackend):
                                          results
             `start_offset` -- The starting offset (default=0)
             `end_offset` -- The ending offset (default=None)
+            `fields` -- Only load the named stored fields into the results
+                        (default = '', all fields)
         
         Returns:
             A dictionary with the following keys:
@@ -420,7 +2959,7 @@ class SearchBackend(BaseSearchBackend):
         query = xapian.Query(self.get_identifier(model_instance))
         enquire = self._enquire(database, query)
         rset = xapian.RSet()
-        for match in enquire.get_mset(0, DEFAULT_MAX_RESULTS):
+        for match in enquire.get_mset(0, database.get_termfreq(self.get_identifier(model_instance))):
             rset.add_document(match.docid)
         query = xapian.Query(xapian.Query.OP_OR,
             [expand.term for expand in enquire.get_eset(DEFAULT_MAX_RESULTS, rset, XHExpandDecider())]
@@ -438,13 +2977,13 @@ class SearchBackend(BaseSearchBackend):
         enquire.set_query(query)
         
         results = []
+        end_offset = max(0, min(end_offset, database.get_doccount() - start_offset))
         matches = enquire.get_mset(start_offset, end_offset)
         
+        fields = self._stored_fields(fields)
         for match in matches:
-            document = match.get_document()
-            app_label, module_name, pk, model_data = pickle.loads(document.get_data())
             results.append(
-                SearchResult(app_label, module_name, pk, match.weight, **model_data)
+                XHSearchResult(self, match.document, match.weight, fields=fields)
             )
         
         return {
@@ -458,6 +2997,31 @@ class SearchBackend(BaseSearchBackend):
             'spelling_suggestion': None,
         }
     
+    def _stored_fields(self, fields):
+        """
+        Private method that normalises the `fields` argument of `search` and
+        `more_like_this` into a set of field names, or None for all fields.
+        """
+        if not fields:
+            return None
+        if isinstance(fields, basestring):
+            fields = fields.replace(',', ' ').split()
+        return set(fields)
+    
+    def _document_data(self, document_id):
+        """
+        Private method that returns the stored data of the document with the
+        identifier `document_id` from a freshly opened database.
+        
+        Used by `XHSearchResult` when the revision it was matched against is
+        no longer available, or the document has since been deleted.
+        """
+        DATABASE_POOL.discard(self._shard_paths())
+        database = self._database()
+        for posting in database.postlist(document_id):
+            return database.get_document(posting.docid).get_data()
+        return XHDocumentData.encode(None, None, None, {})
+    
     def build_schema(self, fields):
         """
         Build the schema from fields.
@@ -467,12 +3031,20 @@ class SearchBackend(BaseSearchBackend):
         
         Returns a list of fields in dictionary format ready for inclusion in
         an indexed meta-data.
+        
+        Fields are assigned value columns in field name order, starting after
+        `DOCUMENT_ID_VALUE_COLUMN`, so that the same fields always produce the
+        same columns.
+        
+        Fields named in `HAYSTACK_XAPIAN_EXACT_FIELDS` are marked `exact` and
+        are indexed as a single boolean term per value instead of as text.
         """
         content_field_name = ''
         schema_fields = []
-        column = 0
+        column = DOCUMENT_ID_VALUE_COLUMN + 1
+        exact_fields = getattr(settings, 'HAYSTACK_XAPIAN_EXACT_FIELDS', ())
         
-        for field_name, field_class in fields.items():
+        for field_name, field_class in sorted(fields.items()):
             if field_class.document is True:
                 content_field_name = field_name
             
@@ -495,6 +3067,9 @@ class SearchBackend(BaseSearchBackend):
                 elif isinstance(field_class, MultiValueField):
                     field_data['multi_valued'] = 'true'
                 
+                if field_name in exact_fields:
+                    field_data['exact'] = 'true'
+                
                 schema_fields.append(field_data)
                 column += 1
         
@@ -510,41 +3085,111 @@ class SearchBackend(BaseSearchBackend):
         
         Required arguments:
             `content` -- Content to search for instances of `text`
-            `text` -- The text to be highlighted
+            `text` -- The query string to be highlighted
+        
+        Returns snippets of `content`, as described in `XHHighlighter`.  To
+        highlight many documents for one query, use :method:`_highlighter`.
         """
-        for term in [term.replace('*', '') for term in text.split()]:
-            if term not in ('AND','OR'):
-                term_re = re.compile(re.escape(term), re.IGNORECASE)
-                content = term_re.sub('<%s>%s</%s>' % (tag, term, tag), content)
-        return content
+        return self._highlighter(text, tag).highlight(content)
     
-    def _do_field_facets(self, results, field_facets):
+    def _highlighter(self, query_string, tag='em'):
+        """
+        Private method that returns an `XHHighlighter` for the terms of
+        `query_string`, as parsed for the current database.
+        """
+        query, spelling_suggestion = self._parse_query(self._database(), query_string)
+        return XHHighlighter(query, self.stemmer, tag)
+    
+    def _add_field_spies(self, database, enquire, field_facets):
+        """
+        Private method that adds a xapian.ValueCountMatchSpy to `enquire` for
+        each field in `field_facets`.
+        
+        Returns a dictionary mapping field names to match spies.  Fields that
+        do not have a value column are left out.  The value column of a
+        multi-valued field holds the whole list, so multi-valued exact fields
+        get a list of spies instead, one for each of their facet value
+        columns that `database` has values in, and other multi-valued fields
+        raise ValueError.
+        """
+        field_spies = {}
+        
+        for field in field_facets:
+            if field in field_spies:
+                continue
+            if field in self.schema_plan.multi_valued:
+                if field not in self.schema_plan.exact:
+                    raise ValueError(
+                        "Cannot facet on the multi-valued field '%s' unless it is "
+                        "listed in HAYSTACK_XAPIAN_EXACT_FIELDS." % field
+                    )
+                field_spies[field] = []
+                column = self.schema_plan.facet_columns[field]
+                while len(field_spies[field]) < FACET_VALUE_COLUMNS and database.get_value_freq(column):
+                    field_spies[field].append(xapian.ValueCountMatchSpy(column))
+                    enquire.add_matchspy(field_spies[field][-1])
+                    column += 1
+            elif field in self.schema_plan.columns:
+                field_spies[field] = xapian.ValueCountMatchSpy(self.schema_plan.columns[field])
+                enquire.add_matchspy(field_spies[field])
+        
+        return field_spies
+    
+    def _do_field_facets(self, field_spies, field_facets):
         """
         Private method that facets a document by field name.
         
         Required arguments:
-            `results` -- A list SearchResults to facet
+            `field_spies` -- A dictionary of match spies from
+                             :method:`_add_field_spies`
             `field_facets` -- A list of fields to facet on
+        
+        The counts come from the value columns of every document in the
+        match set, not only the page of results returned.  Documents whose
+        field is null have no value and are not counted.  Multi-valued
+        exact fields are counted from their facet value columns with
+        :method:`_do_term_facets`.
+        Each field facet is a list of `(value, count)` tuples in value order.
         """
         facet_dict = {}
         
         for field in field_facets:
-            facet_list = {}
-            
-            for result in results:
-                field_value = getattr(result, field)
-                facet_list[field_value] = facet_list.get(field_value, 0) + 1
-            
-            facet_dict[field] = facet_list.items()
+            if field not in field_spies:
+                continue
+            if field in self.schema_plan.multi_valued:
+                facet_dict[field] = self._do_term_facets(field_spies[field])
+                continue
+            field_type = self.schema_plan.types[field]
+            facet_dict[field] = [
+                (self._unmarshal_value(item.term, field_type), item.termfreq)
+                for item in field_spies[field].values()
+            ]
         
         return facet_dict
     
-    def _do_date_facets(self, results, date_facets):
+    def _do_term_facets(self, field_spies):
+        """
+        Private method that facets a multi-valued exact field by its values.
+        
+        Each distinct value of the field in a document is stored in one of
+        its facet value columns, so the counts of `field_spies`, one
+        xapian.ValueCountMatchSpy for each column, add up to the number of
+        documents in the match set with each value.  Returns a list of
+        `(value, count)` tuples in value order.
+        """
+        counts = {}
+        for field_spy in field_spies:
+            for item in field_spy.values():
+                counts[item.term] = counts.get(item.term, 0) + item.termfreq
+        return [(smart_unicode(value), count) for value, count in sorted(counts.iteritems())]
+    
+    def _do_date_facets(self, field_spies, date_facets):
         """
         Private method that facets a document by date ranges
         
         Required arguments:
-            `results` -- A list SearchResults to facet
+            `field_spies` -- A dictionary of match spies from
+                             :method:`_add_field_spies`
             `date_facets` -- A dictionary containing facet parameters:
                 {'field': {'start_date': ..., 'end_date': ...: 'gap_by': '...', 'gap_amount': n}}
                 nb., gap must be one of the following:
@@ -552,7 +3197,13 @@ class SearchBackend(BaseSearchBackend):
         
         For each date facet field in `date_facets`, generates a list
         of date ranges (from `start_date` to `end_date` by `gap_by`) then
-        iterates through `results` and tallies the count for each date_facet.
+        tallies the count of documents in the match set falling within each
+        range.  Each range includes its start date and runs up to, but not
+        including, the start of the next range or `end_date`.
+        
+        The counts are taken from the distinct values of the field's value
+        column across the whole match set, each of which is placed in its
+        range with a binary search over the marshalled range boundaries.
         
         Returns a dictionary of date facets (fields) containing a list with
         entries for each range and a count of documents matching the range.
@@ -571,128 +3222,365 @@ class SearchBackend(BaseSearchBackend):
         
         for date_facet, facet_params in date_facets.iteritems():
             gap_type = facet_params.get('gap_by')
-            gap_value = facet_params.get('gap_amount', 1)
+            gap_value = int(facet_params.get('gap_amount', 1))
+            end_date = facet_params['end_date']
             date_range = facet_params['start_date']
-            facet_list = []
-            while date_range < facet_params['end_date']:
-                facet_list.append((date_range.isoformat(), 0))
-                if gap_type == 'year':
-                    date_range = date_range.replace(
-                        year=date_range.year + int(gap_value)
-                    )
-                elif gap_type == 'month':
-                    if date_range.month == 12:
-                        date_range = date_range.replace(
-                            month=1, year=date_range.year + int(gap_value)
-                        )
-                    else:
-                        date_range = date_range.replace(
-                            month=date_range.month + int(gap_value)
-                        )
-                elif gap_type == 'day':
-                    date_range += datetime.timedelta(days=int(gap_value))
-                elif gap_type == 'hour':
-                    date_range += datetime.timedelta(hours=int(gap_value))
-                elif gap_type == 'minute':
-                    date_range += datetime.timedelta(minutes=int(gap_value))
-                elif gap_type == 'second':
-                    date_range += datetime.timedelta(seconds=int(gap_value))
             
-            facet_list = sorted(facet_list, key=lambda n:n[0], reverse=True)
+            starts = []
+            while date_range < end_date:
+                starts.append(date_range)
+                date_range = self._date_gap(date_range, gap_type, gap_value)
             
-            for result in results:
-                result_date = getattr(result, date_facet)
-                if result_date:
-                    if not isinstance(result_date, datetime.datetime):
-                        result_date = datetime.datetime(
-                            year=result_date.year,
-                            month=result_date.month,
-                            day=result_date.day,
-                        )
-                    for n, facet_date in enumerate(facet_list):
-                        if result_date > datetime.datetime.strptime(facet_date[0], '%Y-%m-%dT%H:%M:%S'):
-                            facet_list[n] = (facet_list[n][0], (facet_list[n][1] + 1))
-                            break
+            boundaries = [self._serialise_value(start) for start in starts]
+            end = self._serialise_value(end_date)
+            counts = [0] * len(starts)
             
-            facet_dict[date_facet] = facet_list
+            if date_facet in field_spies:
+                for item in field_spies[date_facet].values():
+                    if item.term >= end:
+                        continue
+                    n = bisect.bisect_right(boundaries, item.term) - 1
+                    if n >= 0:
+                        counts[n] += item.termfreq
+            
+            facet_list = [
+                (start.isoformat(), count) for start, count in zip(starts, counts)
+            ]
+            facet_dict[date_facet] = sorted(facet_list, key=lambda n:n[0], reverse=True)
         
         return facet_dict
     
-    def _do_query_facets(self, results, query_facets):
+    def _date_gap(self, date, gap_type, gap_value):
+        """
+        Private method that returns `date` moved forward by `gap_value`
+        units of `gap_type` (year|month|day|hour|minute|second).
+        
+        Moving by years or months keeps the day of the month where possible
+        and otherwise uses the last day of the resulting month.
+        """
+        if gap_type in ('year', 'month'):
+            months = gap_value
+            if gap_type == 'year':
+                months = 12 * gap_value
+            months += date.month - 1
+            year = date.year + months // 12
+            month = months % 12 + 1
+            day = min(date.day, calendar.monthrange(year, month)[1])
+            return date.replace(year=year, month=month, day=day)
+        elif gap_type == 'day':
+            return date + datetime.timedelta(days=gap_value)
+        elif gap_type == 'hour':
+            return date + datetime.timedelta(hours=gap_value)
+        elif gap_type == 'minute':
+            return date + datetime.timedelta(minutes=gap_value)
+        elif gap_type == 'second':
+            return date + datetime.timedelta(seconds=gap_value)
+        raise ValueError("Unknown date facet gap '%s'." % gap_type)
+    
+    def _do_query_facets(self, database, query, query_facets):
         """
         Private method that facets a document by query
         
         Required arguments:
-            `results` -- A list SearchResults to facet
+            `database` -- The database the main query is run against
+            `query` -- The main xapian.Query, including any narrow queries
             `query_facets` -- A dictionary containing facet parameters:
                 {'field': 'query', [...]}
         
         For each query in `query_facets`, generates a dictionary entry with
         the field name as the key and a tuple with the query and result count
-        as the value.
+        as the value.  The count is the number of documents matching both the
+        main query and the facet query, and is found without retrieving any
+        documents.
         
         eg. {'name': ('a*', 5)}
         """
         facet_dict = {}
+        check_at_least = database.get_doccount()
         
-        for field, query in query_facets.iteritems():
-            facet_dict[field] = (query, self.search(query)['hits'])
+        for field, facet_query in query_facets.iteritems():
+            enquire = self._enquire(database, xapian.Query(
+                xapian.Query.OP_FILTER, query, self._query(database, facet_query)[0]
+            ))
+            matches = enquire.get_mset(0, 0, check_at_least)
+            facet_dict[field] = (facet_query, matches.get_matches_estimated())
         
         return facet_dict
     
     def _marshal_value(self, value):
         """
         Private method that converts Python values to a string for Xapian values.
+        
+        This is the form values take in query strings.  Value columns use
+        :method:`_serialise_value`, which only falls back to this for
+        indexes written before `VALUE_ENCODING` 2.  See `XHSchema.marshal`.
+        """
+        return XHSchema.marshal(value)
+    
+    def _query_value(self, value):
+        """
+        Private method that converts a Python value to a string for a query
+        string.
+        
+        Indexes in the current `VALUE_ENCODING` are searched through number
+        range processors for numbers and dates, so dates become the number
+        YYYYMMDDHHMMSS that :method:`_serialise_value` stores, without
+        microseconds, and floats are written out in full.
+        Older indexes use :method:`_marshal_value`.
         """
+        if getattr(self, 'schema_plan', None) is not None and \
+           self.schema_plan.value_encoding < VALUE_ENCODING:
+            return self._marshal_value(value)
         if isinstance(value, datetime.datetime):
-            if value.microsecond:
-                value = u'%04d%02d%02d%02d%02d%02d%06d' % (
-                    value.year, value.month, value.day, value.hour,
-                    value.minute, value.second, value.microsecond
-                )
+            return u'%04d%02d%02d%02d%02d%02d' % (
+                value.year, value.month, value.day, value.hour,
+                value.minute, value.second
+            )
+        elif isinstance(value, float):
+            return force_unicode(repr(value))
+        return self._marshal_value(value)
+    
+    def _serialise_value(self, value, value_encoding=None):
+        """
+        Private method that converts a Python value to the string stored in
+        its value column.
+        
+        Optional arguments:
+            `value_encoding` -- The value encoding to use (default = the
+                                encoding of the current schema)
+        
+        See `XHSchema.serialise`.  Indexing uses the serialiser the schema
+        plan resolved for each field instead.
+        """
+        if value_encoding is None:
+            value_encoding = VALUE_ENCODING
+            if getattr(self, 'schema_plan', None) is not None:
+                value_encoding = self.schema_plan.value_encoding
+        return XHSchema.serialise(value, value_encoding)
+    
+    def _unmarshal_value(self, value, field_type):
+        """
+        Private method that converts a Xapian value produced by
+        :method:`_serialise_value` back to Python for a field of `field_type`.
+        
+        An empty value is a null field and is returned as None, as is the
+        string `'None'` that older versions of the backend stored instead.
+        """
+        legacy = self.schema_plan.value_encoding < VALUE_ENCODING
+        if field_type != 'text' and (not value or legacy and value == 'None'):
+            return None
+        if field_type == 'boolean':
+            return value == 't'
+        elif field_type == 'long':
+            if legacy:
+                return long(value)
+            return long(xapian.sortable_unserialise(value))
+        elif field_type == 'float':
+            return xapian.sortable_unserialise(value)
+        elif field_type in ('date', 'datetime'):
+            if not legacy:
+                value = '%014d' % xapian.sortable_unserialise(value)
+            if len(value) > 14:
+                return datetime.datetime.strptime(value, '%Y%m%d%H%M%S%f')
+            return datetime.datetime.strptime(value, '%Y%m%d%H%M%S')
+        return smart_unicode(value)
+    
+    def _database(self):
+        """
+        Private method that returns a read-only xapian.Database for use and
+        sets up schema and content_field definitions.
+        
+        Returns an instance of a xapian.Database
+        
+        Databases are taken from `DATABASE_POOL`, so the handle returned may
+        be shared with other calls in the same thread.  On a sharded index
+        the handle covers every shard.
+        """
+        handle = DATABASE_POOL.handle(self._shard_paths())
+        database = handle.database
+        
+        if 'schema' not in handle.cache:
+            content_field_name = pickle.loads(database.get_metadata('content'))
+            schema = pickle.loads(database.get_metadata('schema'))
+            fingerprint = database.get_metadata('schema_fingerprint') or \
+                          self._schema_fingerprint(content_field_name, schema)
+            value_encoding = int(database.get_metadata('value_encoding') or 1)
+            handle.cache['schema'] = XHSchema.get(
+                content_field_name, schema, fingerprint, value_encoding
+            )
+        self._use_schema(handle.cache['schema'])
+        self._database_cache = handle.cache
+        self._database_revision = handle.revision
+        
+        return database
+    
+    def _writable_databases(self):
+        """
+        Private method that returns a list of xapian.WritableDatabase, one per
+        shard, and sets up schema and content_field definitions.
+        
+        Every shard is given the same schema, based on the schema stored in
+        the first shard.  The schema metadata is only rewritten in shards
+        whose `schema_fingerprint` differs.
+        
+        New and empty databases are given the current `VALUE_ENCODING`.
+        Databases written by an older version of the backend keep their
+        value encoding, and their value columns, until :method:`migrate_values`
+        is run.
+        
+        The number of shards is stored in the first shard, and
+        `ImproperlyConfigured` is raised if it differs from `shards`.
+        """
+        for path in self._shard_paths():
+            self._create_database(path)
+        databases = [
+            xapian.WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)
+            for path in self._shard_paths()
+        ]
+        
+        shards = databases[0].get_metadata('shards')
+        if shards != str(self.shards):
+            if shards:
+                shards = int(shards)
             else:
-                value = u'%04d%02d%02d%02d%02d%02d' % (
-                    value.year, value.month, value.day, value.hour,
-                    value.minute, value.second
+                shards = self._indexed_shards()
+            if shards is not None and shards != self.shards:
+                raise ImproperlyConfigured(
+                    "The index at '%s' has %d shard(s) but HAYSTACK_XAPIAN_SHARDS is %d.  "
+                    "Set it back, or rebuild() the index with the new number of shards." %
+                    (self.path, shards, self.shards)
                 )
-        elif isinstance(value, datetime.date):
-            value = u'%04d%02d%02d000000' % (value.year, value.month, value.day)
-        elif isinstance(value, bool):
-            if value:
-                value = u't'
-            else:
-                value = u'f'
-        elif isinstance(value, float):
-            value = xapian.sortable_serialise(value)
-        elif isinstance(value, (int, long)):
-            value = u'%012d' % value
+            databases[0].set_metadata('shards', str(self.shards))
+        
+        content_field_name, schema = self.build_schema(self.site.all_searchfields())
+        stored_schema = databases[0].get_metadata('schema')
+        value_encoding = databases[0].get_metadata('value_encoding')
+        if value_encoding:
+            value_encoding = int(value_encoding)
+        elif stored_schema and sum([database.get_doccount() for database in databases]):
+            value_encoding = 1
         else:
-            value = force_unicode(value)
-        return value
+            value_encoding = VALUE_ENCODING
+        if stored_schema:
+            schema = self._merge_schema(pickle.loads(stored_schema), schema, value_encoding)
+        fingerprint = self._schema_fingerprint(content_field_name, schema)
+        
+        for database in databases:
+            if database.get_metadata('schema_fingerprint') != fingerprint:
+                database.set_metadata('schema', pickle.dumps(schema, pickle.HIGHEST_PROTOCOL))
+                database.set_metadata('content', pickle.dumps(content_field_name, pickle.HIGHEST_PROTOCOL))
+                database.set_metadata('schema_fingerprint', fingerprint)
+            if database.get_metadata('value_encoding') != str(value_encoding):
+                database.set_metadata('value_encoding', str(value_encoding))
+        
+        self._use_schema(XHSchema.get(content_field_name, schema, fingerprint, value_encoding))
+        self._database_cache = {}
+        return databases
+    
+    def _use_schema(self, schema_plan):
+        """
+        Private method that makes `schema_plan` (an `XHSchema`) the current
+        schema.  `schema` and `content_field_name` are kept for compatibility.
+        """
+        self.schema_plan = schema_plan
+        self.schema = schema_plan.fields
+        self.content_field_name = schema_plan.content_field_name
+    
+    def _shard_paths(self):
+        """
+        Private method that returns a tuple of the paths to each shard.
+        """
+        if self.shards <= 1:
+            return (self.path,)
+        return tuple([
+            os.path.join(self.path, 'shard%d' % shard) for shard in xrange(self.shards)
+        ])
+    
+    def _indexed_shards(self):
+        """
+        Private method that works out the number of shards of an index
+        written before the number was stored in its metadata.
+        
+        An unsharded index is a database at `path` with documents in it,
+        and a sharded one has a database in each `shard<n>` directory under
+        `path`.  Empty shards may have just been created for the current
+        setting, so the count goes up to the last shard with documents.
+        Returns None if there are no documents at `path`.
+        """
+        try:
+            if xapian.Database(self.path).get_doccount():
+                return 1
+        except xapian.DatabaseOpeningError:
+            pass
+        shard = shards = 0
+        while True:
+            try:
+                database = xapian.Database(os.path.join(self.path, 'shard%d' % shard))
+            except xapian.DatabaseOpeningError:
+                break
+            shard += 1
+            if database.get_doccount():
+                shards = shard
+        return shards or None
+    
+    def _shard(self, document_id):
+        """
+        Private method that returns the number of the shard that the
+        document identified by `document_id` belongs in.
+        """
+        if self.shards <= 1:
+            return 0
+        return (zlib.crc32(smart_str(document_id)) & 0xffffffff) % self.shards
     
-    def _database(self, writable=False):
+    def _merge_schema(self, stored_schema, schema, value_encoding=VALUE_ENCODING):
         """
-        Private method that returns a xapian.Database for use and sets up
-        schema and content_field definitions.
+        Private method that reconciles a freshly built `schema` with the
+        `stored_schema` already in the database.
         
         Optional arguments:
-            ``writable`` -- Open the database in read/write mode (default=False)
+            `value_encoding` -- The value encoding of the database (default =
+                                `VALUE_ENCODING`)
         
-        Returns an instance of a xapian.Database or xapian.WritableDatabase
+        Fields that are already in the database keep their value columns, and
+        new fields are given columns after the highest column in use, so
+        values that have already been indexed never change slots.  A field
+        stored in `DOCUMENT_ID_VALUE_COLUMN` by an older version of the backend
+        keeps it while the database has an older `value_encoding`, and is only
+        moved to a new column by :method:`migrate_values`.
+        
+        Returns a new schema list.
         """
-        if writable:
-            self.content_field_name, self.schema = self.build_schema(self.site.all_searchfields())
-            
-            database = xapian.WritableDatabase(settings.HAYSTACK_XAPIAN_PATH, xapian.DB_CREATE_OR_OPEN)
-            database.set_metadata('schema', pickle.dumps(self.schema, pickle.HIGHEST_PROTOCOL))
-            database.set_metadata('content', pickle.dumps(self.content_field_name, pickle.HIGHEST_PROTOCOL))
-        else:
-            database = xapian.Database(settings.HAYSTACK_XAPIAN_PATH)
-            
-            self.schema = pickle.loads(database.get_metadata('schema'))
-            self.content_field_name = pickle.loads(database.get_metadata('content'))
+        legacy = value_encoding < VALUE_ENCODING
+        stored_columns = dict(
+            (field_dict['field_name'], field_dict['column']) for field_dict in stored_schema
+            if legacy or field_dict['column'] != DOCUMENT_ID_VALUE_COLUMN
+        )
+        column = max([DOCUMENT_ID_VALUE_COLUMN] + stored_columns.values()) + 1
+        merged_schema = []
         
-        return database
+        for field_dict in schema:
+            field_dict = field_dict.copy()
+            if field_dict['field_name'] in stored_columns:
+                field_dict['column'] = stored_columns[field_dict['field_name']]
+            else:
+                field_dict['column'] = column
+                column += 1
+            merged_schema.append(field_dict)
+        
+        return merged_schema
+    
+    def _schema_fingerprint(self, content_field_name, schema):
+        """
+        Private method that returns a digest identifying a schema.
+        
+        The digest includes `SCHEMA_VERSION` so that changes to the way the
+        backend interprets a schema are also picked up.
+        """
+        return hashlib.md5(pickle.dumps((
+            SCHEMA_VERSION,
+            content_field_name,
+            [sorted(field_dict.items()) for field_dict in schema],
+        ), pickle.HIGHEST_PROTOCOL)).hexdigest()
     
     def _term_generator(self, database, document):
         """
@@ -712,7 +3600,8 @@ class SearchBackend(BaseSearchBackend):
         term_generator.set_document(document)
         return term_generator
     
-    def _query(self, database, query_string, narrow_queries=None, boost=None):
+    def _query(self, database, query_string, narrow_queries=None, boost=None,
+               query_filters=None, models=None):
         """
         Private method that takes a query string and returns a xapian.Query.
         
@@ -722,27 +3611,25 @@ class SearchBackend(BaseSearchBackend):
         Optional arguments:
             `narrow_queries` -- A list of queries to narrow the query with
             `boost` -- A dictionary of terms to boost with values
+            `query_filters` -- A list of `SearchQuery` filters to compile
+                               instead of parsing `query_string`
+            `models` -- A list of models to restrict `query_filters` to
         
         Returns a xapian.Query instance with prefixes and ranges properly
         setup as pulled from the `query_string`.
         """
-        spelling_suggestion = None
-        
-        if query_string == '*':
+        if query_filters is not None:
+            query, spelling_suggestion = self._filter_query(database, query_filters, models)
+        elif query_string == '*':
             query = xapian.Query('') # Make '*' match everything
+            spelling_suggestion = None
         else:
-            qp = self._query_parser(database)
-            vrp = XHValueRangeProcessor(self)
-            qp.add_valuerangeprocessor(vrp)
-            query = qp.parse_query(query_string, self._flags(query_string))
-            if getattr(settings, 'HAYSTACK_INCLUDE_SPELLING', False) is True:
-                spelling_suggestion = qp.get_corrected_query_string()
+            query, spelling_suggestion = self._parse_query(database, query_string)
         
         if narrow_queries:
             subqueries = [
-                qp.parse_query(
-                    narrow_query, self._flags(narrow_query)
-                ) for narrow_query in narrow_queries
+                self._parse_query(database, narrow_query)[0]
+                for narrow_query in narrow_queries
             ]
             query = xapian.Query(
                 xapian.Query.OP_FILTER,
@@ -761,6 +3648,273 @@ class SearchBackend(BaseSearchBackend):
         
         return query, spelling_suggestion
     
+    def _filter_key(self, query_filters, models=None):
+        """
+        Private method that returns a hashable key for `query_filters` and
+        `models`, as passed to :method:`search`, for the result cache.
+        """
+        if query_filters is None:
+            return None
+        return (
+            tuple([
+                (
+                    the_filter.field, the_filter.filter_type, XHLRUCache.freeze(the_filter.value),
+                    the_filter.is_and(), the_filter.is_or(), the_filter.is_not()
+                ) for the_filter in query_filters
+            ]),
+            tuple(sorted([
+                u'%s.%s' % (model._meta.app_label, model._meta.module_name)
+                for model in models or []
+            ])),
+        )
+    
+    def _filter_query(self, database, query_filters, models=None):
+        """
+        Private method that compiles a list of `SearchQuery` filters into a
+        xapian.Query without a round trip through the query parser.
+        
+        Required arguments:
+            `database` -- The database to be queried
+            `query_filters` -- A list of haystack `QueryFilter`
+        
+        Optional arguments:
+            `models` -- Only match documents of these models (default = None)
+        
+        Filters are grouped the way the query parser reads the string from
+        :method:`SearchQuery.build_query`, with `AND` binding tighter than
+        `OR`, so each `OR` filter starts a new group of filters that must
+        all match.  Only `content` filters are parsed, as free text, and
+        only they add to the weight of a match; field filters are applied
+        with `OP_FILTER`.
+        
+        Returns a tuple of the xapian.Query and the spelling suggestion.
+        """
+        groups = []
+        suggestions = []
+        
+        for the_filter in query_filters:
+            if not groups or the_filter.is_or():
+                groups.append(([], [], []))
+            scored, filters, excluded = groups[-1]
+            
+            if the_filter.field == 'content':
+                value = the_filter.value
+                if isinstance(value, (list, tuple)):
+                    value = u' '.join([force_unicode(item) for item in value])
+                else:
+                    value = self._query_value(value)
+                if ' ' in value:
+                    value = u'"%s"' % value
+                query, suggestion = self._parse_query(database, value)
+                suggestions.append((suggestion, value))
+            else:
+                query = self._field_query(
+                    database, the_filter.field, the_filter.filter_type, the_filter.value
+                )
+            
+            if the_filter.is_not():
+                excluded.append(query)
+            elif the_filter.field == 'content':
+                scored.append(query)
+            else:
+                filters.append(query)
+        
+        subqueries = []
+        for scored, filters, excluded in groups:
+            if scored:
+                query = xapian.Query(xapian.Query.OP_AND, scored)
+                if filters:
+                    query = xapian.Query(
+                        xapian.Query.OP_FILTER,
+                        query, xapian.Query(xapian.Query.OP_AND, filters)
+                    )
+            elif filters:
+                query = xapian.Query(xapian.Query.OP_AND, filters)
+            else:
+                query = xapian.Query('')
+            if excluded:
+                query = xapian.Query(
+                    xapian.Query.OP_AND_NOT,
+                    query, xapian.Query(xapian.Query.OP_OR, excluded)
+                )
+            subqueries.append(query)
+        
+        if subqueries:
+            query = xapian.Query(xapian.Query.OP_OR, subqueries)
+        else:
+            query = xapian.Query('')
+        
+        if models:
+            query = xapian.Query(
+                xapian.Query.OP_FILTER, query,
+                xapian.Query(xapian.Query.OP_OR, [
+                    xapian.Query(
+                        DOCUMENT_CT_TERM_PREFIX + '%s.%s' %
+                        (model._meta.app_label, model._meta.module_name)
+                    ) for model in models
+                ])
+            )
+        
+        spelling_suggestion = None
+        if getattr(settings, 'HAYSTACK_INCLUDE_SPELLING', False) is True:
+            spelling_suggestion = u''
+            if [suggestion for suggestion, value in suggestions if suggestion]:
+                spelling_suggestion = u' '.join([
+                    suggestion or value for suggestion, value in suggestions
+                ])
+        return query, spelling_suggestion
+    
+    def _field_query(self, database, field, filter_type, value):
+        """
+        Private method that returns a xapian.Query matching one field filter.
+        
+        Required arguments:
+            `database` -- The database to be queried
+            `field` -- The field name
+            `filter_type` -- The haystack filter type, such as `exact`,
+                             `gte` or `in`
+            `value` -- The value to filter on
+        
+        Exact and `startswith` filters on exact fields match their boolean
+        terms, and on other text fields match the terms the field was
+        indexed with.  Every other filter compares the marshalled
+        value in the field's value column.  An exact filter on None
+        matches the documents where the field is null, and other filters
+        on None match nothing.  Fields that are not in the schema are left
+        to the query parser.
+        """
+        if filter_type == 'in':
+            return xapian.Query(xapian.Query.OP_OR, [
+                self._field_query(database, field, 'exact', item)
+                for item in value
+            ])
+        
+        prefix = self.schema_plan.prefixes.get(field)
+        if prefix is None:
+            return self._parse_query(
+                database, u'%s:%s' % (field, self._query_value(value))
+            )[0]
+        
+        field_type = self.schema_plan.types[field]
+        if field in self.schema_plan.exact and filter_type in ('exact', 'startswith'):
+            term = self.schema_plan.boolean_term(field, value)
+            if filter_type == 'startswith':
+                terms = [item.term for item in database.allterms(term)]
+                return xapian.Query(xapian.Query.OP_OR, terms or [term])
+            return xapian.Query(term)
+        if field_type == 'text' and filter_type in ('exact', 'startswith'):
+            text = force_unicode(value)
+            if filter_type == 'startswith':
+                term_prefix = prefix + smart_str(text.lower())
+                terms = [item.term for item in database.allterms(term_prefix)]
+                return xapian.Query(xapian.Query.OP_OR, terms or [term_prefix])
+            return self._phrase_query(prefix, text)
+        
+        if field_type in XHSchema.RANGE_TYPES and isinstance(value, basestring):
+            try:
+                value = XHSchema.RANGE_TYPES[field_type](value)
+            except ValueError:
+                pass
+        column = self.schema_plan.columns[field]
+        value = smart_str(self._serialise_value(value))
+        if not value:
+            if filter_type != 'exact':
+                return xapian.Query()
+            # Only documents where the field is null have no value.
+            null = xapian.Query(
+                xapian.Query.OP_AND_NOT, xapian.Query(''),
+                xapian.Query(xapian.Query.OP_VALUE_GE, column, '\x00')
+            )
+            if self.schema_plan.value_encoding < VALUE_ENCODING:
+                # Older versions of the backend stored nulls as 'None'.
+                null = xapian.Query(xapian.Query.OP_OR, null, xapian.Query(
+                    xapian.Query.OP_VALUE_RANGE, column, 'None', 'None'
+                ))
+            return null
+        
+        if filter_type == 'startswith':
+            return xapian.Query(xapian.Query.OP_VALUE_RANGE, column, value, value + '\xff')
+        exact = xapian.Query(xapian.Query.OP_VALUE_RANGE, column, value, value)
+        if filter_type == 'gte':
+            return xapian.Query(xapian.Query.OP_VALUE_GE, column, value)
+        if filter_type == 'lte':
+            return xapian.Query(xapian.Query.OP_VALUE_LE, column, value)
+        if filter_type == 'gt':
+            return xapian.Query(
+                xapian.Query.OP_AND_NOT,
+                xapian.Query(xapian.Query.OP_VALUE_GE, column, value), exact
+            )
+        if filter_type == 'lt':
+            return xapian.Query(
+                xapian.Query.OP_AND_NOT,
+                xapian.Query(xapian.Query.OP_VALUE_LE, column, value), exact
+            )
+        return exact
+    
+    def _phrase_query(self, prefix, text):
+        """
+        Private method that returns a xapian.Query matching `text` as a
+        phrase in a field indexed with `prefix`.
+        
+        The text is split into terms by a `xapian.TermGenerator`, exactly as
+        it was when the field was indexed, but without stemming.
+        """
+        document = xapian.Document()
+        term_generator = xapian.TermGenerator()
+        term_generator.set_document(document)
+        term_generator.index_text(text, 1, prefix)
+        
+        positions = {}
+        for item in document.termlist():
+            for position in item.positer:
+                positions[position] = item.term
+        terms = [positions[position] for position in sorted(positions)]
+        
+        if not terms:
+            return xapian.Query(prefix + smart_str(text))
+        if len(terms) == 1:
+            return xapian.Query(terms[0])
+        return xapian.Query(xapian.Query.OP_PHRASE, terms)
+    
+    def _parse_query(self, database, query_string):
+        """
+        Private method that parses `query_string` with the query parser for
+        `database` and returns a tuple of the xapian.Query and the spelling
+        suggestion, if spelling is enabled.
+        
+        Required arguments:
+            `database` -- The database to be queried
+            `query_string` -- The query string to parse
+        
+        Parsed queries for pooled databases are kept in a bounded cache
+        alongside the database handle, keyed on the query string, parser
+        flags, stemming language and schema fingerprint.  Partial and
+        wildcard terms expand against the database at parse time, so the
+        cache is dropped whenever the handle is reopened.
+        """
+        if self.schema_plan.value_encoding >= VALUE_ENCODING:
+            # Xapian's range processors take an empty end for an open range.
+            query_string = re.sub(r'\.\.\*(?=[\s)]|$)', '..', query_string)
+            # Dates are compared as the number YYYYMMDDHHMMSS.
+            query_string = self.schema_plan.pad_date_ranges(query_string)
+        flags = self._flags(query_string)
+        cache = self._database_cache.get('parsed_queries')
+        if cache is None:
+            cache = self._database_cache['parsed_queries'] = XHLRUCache(
+                getattr(settings, 'HAYSTACK_XAPIAN_QUERY_CACHE_ENTRIES', DEFAULT_QUERY_CACHE_ENTRIES)
+            )
+        key = (query_string, flags, self.stemming_language, self.schema_plan.fingerprint)
+        parsed = cache.get(key)
+        if parsed is None or parsed[0] is not database:
+            qp = self._query_parser(database)
+            query = qp.parse_query(query_string, flags)
+            spelling_suggestion = None
+            if flags & xapian.QueryParser.FLAG_SPELLING_CORRECTION:
+                spelling_suggestion = qp.get_corrected_query_string()
+            parsed = (database, query, spelling_suggestion)
+            cache.set(key, parsed)
+        return parsed[1], parsed[2]
+    
     def _flags(self, query_string):
         """
         Private method that returns an appropriate xapian.QueryParser flags
@@ -813,19 +3967,22 @@ class SearchBackend(BaseSearchBackend):
             `database` -- The database to be queried
         
         The query parser returned will have stemming enabled, a boolean prefix
-        for `django_ct`, and prefixes for all of the fields in the `self.schema`.
+        for `django_ct`, prefixes for all of the fields in the `self.schema`
+        and the range processors from `XHSchema.range_processors`.
+        
+        Query parsers for pooled databases are cached alongside the database
+        handle and reused until it is reopened.
         """
-        qp = xapian.QueryParser()
-        qp.set_database(database)
-        qp.set_stemmer(self.stemmer)
-        qp.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
-        qp.add_boolean_prefix('django_ct', DOCUMENT_CT_TERM_PREFIX)
-        for field_dict in self.schema:
-            qp.add_prefix(
-                field_dict['field_name'],
-                DOCUMENT_CUSTOM_TERM_PREFIX + field_dict['field_name'].upper()
-            )
-        return qp
+        key = ('query_parser', self.stemming_language)
+        cached = self._database_cache.get(key)
+        if cached is None or cached[0] is not database:
+            qp = self.schema_plan.query_parser(database, self.stemmer)
+            processors = self.schema_plan.range_processors(self)
+            for processor in processors:
+                qp.add_valuerangeprocessor(processor)
+            # The range processors are kept with the parser to keep them alive.
+            cached = self._database_cache[key] = (database, qp, processors)
+        return cached[1]
     
     def _enquire(self, database, query):
         """
@@ -851,12 +4008,10 @@ class SearchBackend(BaseSearchBackend):
         Required arguemnts:
             `field` -- The field to lookup
         
-        Returns an integer with the column location (0 indexed).
+        Returns an integer with the column location (0 indexed).  The `id`
+        field, and any field not in the schema, map to the document ID column.
         """
-        for field_dict in self.schema:
-            if field_dict['field_name'] == field:
-                return field_dict['column']
-        return 0
+        return self.schema_plan.column(field)
 
 
 class SearchQuery(BaseSearchQuery):
@@ -906,7 +4061,7 @@ class SearchQuery(BaseSearchQuery):
                 
                 if not isinstance(value, (list, tuple)):
                     # Convert whatever we find to what xapian wants.
-                    value = self.backend._marshal_value(value)
+                    value = self.backend._query_value(value)
                 
                 # Check to see if it's a phrase for an exact match.
                 if ' ' in value:
@@ -969,6 +4124,10 @@ class SearchQuery(BaseSearchQuery):
     def run(self):
         """
         Builds and executes the query. Returns a list of search results.
+        
+        The query itself is compiled straight from the filters by the
+        backend; the string from :method:`build_query` is only used for
+        highlighting.
         """
         final_query = self.build_query()
         kwargs = {
@@ -999,12 +4158,47 @@ class SearchQuery(BaseSearchQuery):
         if self.boost:
             kwargs['boost'] = self.boost
         
+        kwargs['query_filters'] = self.query_filters
+        if self.models:
+            kwargs['models'] = self.models
+        
         results = self.backend.search(final_query, **kwargs)
         self._results = results.get('results', [])
         self._hit_count = results.get('hits', 0)
         self._facet_counts = results.get('facets', {})
         self._spelling_suggestion = results.get('spelling_suggestion', None)
     
+    def get_count(self):
+        """
+        Returns the number of results the query matches.
+        
+        If the results have not been fetched yet, runs a count-only search
+        rather than retrieving them.  More-like-this queries are counted by
+        running them, as the backend has no count-only form of them.
+        """
+        if self._more_like_this:
+            if self._hit_count is None:
+                self.run_mlt()
+            return self._hit_count
+        if self._hit_count is None:
+            kwargs = {
+                'count_only': True,
+                'query_filters': self.query_filters,
+            }
+            
+            if self.models:
+                kwargs['models'] = self.models
+            
+            if self.narrow_queries:
+                kwargs['narrow_queries'] = self.narrow_queries
+            
+            if self.boost:
+                kwargs['boost'] = self.boost
+            
+            results = self.backend.search(self.build_query(), **kwargs)
+            self._hit_count = results.get('hits', 0)
+        return self._hit_count
+    
     def run_mlt(self):
         """
         Builds and executes the query. Returns a list of search results.